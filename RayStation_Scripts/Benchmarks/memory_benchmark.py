@@ -0,0 +1,113 @@
+# Measure peak memory (RSS) of a cached run: the loads PrimitiveTractography.py does for a case that was processed before
+# Compares the typed loaders (load_masks/load_volume) with the old float64 loads (get_fdata)
+# Usage: python memory_benchmark.py <base_dir> [<base_dir> ...]
+
+## Import necessary packages
+import sys
+import json
+import time
+import datetime
+import argparse
+import threading
+from pathlib import Path
+from multiprocessing import get_context
+import psutil
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+
+# Folder results are saved to
+results_dir = Path(__file__).parent / "Results"
+
+# Class sampling RSS of this process in the background to catch the peak
+class PeakRSS:
+    def __init__(self, interval=0.01):
+        # Initialize by defining stuff
+        self.process = psutil.Process()
+        self.interval = interval
+        self.peak = self.process.memory_info().rss
+        self.running = True
+        self.thread = threading.Thread(target=self._sample, daemon=True)
+
+    def _sample(self):
+        while self.running:
+            self.peak = max(self.peak, self.process.memory_info().rss)
+            time.sleep(self.interval)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.running = False
+        self.thread.join()
+        self.peak = max(self.peak, self.process.memory_info().rss)
+
+# Function to import the modules both runs use, so their memory is part of the baseline instead of the peak
+def warm_up():
+    import nibabel
+    import Subscripts.Tractography_Utils, Subscripts.RS_ROI_Utils, Subscripts.WMPL_Utils, Subscripts.Mask_Utils
+
+# Function to do the loads of a cached run with the typed loaders. Returns everything loaded
+def typed_run(base_dir):
+    from Subscripts.Tractography_Utils import get_tracts
+    from Subscripts.RS_ROI_Utils import get_white_matter_mask, load_rois
+    from Subscripts.WMPL_Utils import get_wmpl
+    tracts = get_tracts(base_dir)
+    masks = [get_white_matter_mask(base_dir), *load_rois(base_dir)]
+    wmpl = get_wmpl(base_dir)
+    return tracts, masks, wmpl
+
+# Function to do the same loads the old way (every volume expanded to float64). Returns everything loaded
+def float64_run(base_dir):
+    import nibabel as nib
+    from Subscripts.Tractography_Utils import get_tracts
+    from Subscripts.Mask_Utils import find_labels, legacy_mask_path
+    tracts = get_tracts(base_dir)
+    labels_file = find_labels(base_dir)
+    if labels_file is not None: # one float64 copy per mask, like the separate mask files gave
+        masks = [nib.load(labels_file).get_fdata() for _ in range(4)]
+    else:
+        masks = [nib.load(legacy_mask_path(base_dir, name)).get_fdata()
+                 for name in ["white_matter", "gtv", "external", "brain"]]
+    wmpl = nib.load(base_dir / "WMPL/NIfTI/WMPL_map.nii.gz").get_fdata()
+    return tracts, masks, wmpl
+
+# Function run in a fresh process for every measurement, so peaks don't carry over
+# Both runs keep what they loaded until the peak is read, like a case run holds its volumes
+def measure(mode, base_dir):
+    warm_up()
+    run = typed_run if mode == "typed" else float64_run
+    baseline = psutil.Process().memory_info().rss
+    start = time.perf_counter()
+    with PeakRSS() as peak:
+        loaded = run(base_dir)
+    del loaded # released once the peak has been read
+    return {"mode": mode, "seconds": time.perf_counter() - start,
+            "peak_rss_mb": peak.peak / 2**20, "peak_above_baseline_mb": (peak.peak - baseline) / 2**20}
+
+# Only run when executed directly
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Measure peak memory of a cached run.")
+    parser.add_argument("base_dirs", nargs="+", type=Path, help="Base directories of processed cases")
+    args = parser.parse_args()
+
+    results_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    results = []
+    context = get_context("spawn")
+    for base_dir in args.base_dirs:
+        print(f"Measuring memory of cached run of {base_dir}...")
+        case_result = {"case": str(base_dir)}
+        for mode in ["float64", "typed", "typed"]: # second typed run reads the uncompressed copies made by the first
+            with context.Pool(1) as pool:
+                result = pool.apply(measure, (mode, base_dir))
+            key = mode if mode not in case_result else "typed_warm"
+            case_result[key] = result
+            print(f"  {key}: peak {result['peak_rss_mb']:.0f} MB ({result['peak_above_baseline_mb']:.0f} MB above "
+                  f"baseline) in {result['seconds']:.1f} s")
+        results.append(case_result)
+
+    out_path = results_dir / f"memory_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    out_path.write_text(json.dumps(results, indent=2), encoding='utf-8')
+    print(f"Results saved to {out_path}")
@@ -0,0 +1,103 @@
+# Synthetic diffusion phantoms for benchmarks
+# A phantom case is laid out like a patient folder (NIfTI/ with DWI, bval and bvec, RayStation/ROIs_NIfTI/ with masks),
+# so the pipeline functions can run on it unchanged
+
+## Import necessary packages
+import sys
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Subscripts.Mask_Utils import save_masks
+
+# Diffusivities (mm^2/s)
+fiber_diffusivities = (1.7e-3, 0.3e-3) # along and across fibers
+isotropic_diffusivity = 0.8e-3 # grey matter / CSF-like tissue
+b_value = 1000 # s/mm^2
+
+# Fiber configurations. Each gives the fiber directions (and weights) of a voxel from its position
+fiber_configs = ["straight", "crossing", "curved"]
+
+# Function to spread n directions evenly over the sphere (Fibonacci lattice)
+def sphere_directions(n):
+    i = np.arange(n) + 0.5
+    z = 1 - 2 * i / n
+    r = np.sqrt(1 - z**2)
+    phi = np.pi * (1 + 5**0.5) * i
+    return np.stack([r * np.cos(phi), r * np.sin(phi), z], axis=1)
+
+# Function to make b-values and b-vectors with n gradient directions plus b0 volumes (one per 10 directions)
+def gradient_scheme(n_gradients):
+    n_b0 = max(1, n_gradients // 10)
+    bvals = np.concatenate([np.zeros(n_b0), np.full(n_gradients, b_value)])
+    bvecs = np.concatenate([np.zeros((n_b0, 3)), sphere_directions(n_gradients)])
+    return bvals, bvecs
+
+# Function to get fiber populations of a configuration: list of (direction field (X,Y,Z,3), weight field (X,Y,Z))
+def fiber_populations(config, grid):
+    x, y, z = grid # voxel coordinates scaled to [-1, 1]
+    ones = np.ones_like(x)
+    along_x = np.stack([ones, 0 * ones, 0 * ones], axis=-1)
+    along_y = np.stack([0 * ones, ones, 0 * ones], axis=-1)
+    if config == "straight":
+        return [(along_x, ones)]
+    if config == "crossing": # x fibers everywhere, y fibers crossing them in a central band
+        band = (np.abs(x) < 0.4).astype(float)
+        return [(along_x, 1 - 0.5 * band), (along_y, 0.5 * band)]
+    if config == "curved": # concentric arcs around the z axis
+        angle = np.arctan2(y, x)
+        tangent = np.stack([-np.sin(angle), np.cos(angle), 0 * ones], axis=-1)
+        return [(tangent, ones)]
+    raise ValueError(f"Unknown fiber configuration '{config}'. Use one of {fiber_configs}.")
+
+# Function to simulate DWI signal, brain mask, white matter mask and GTV of a phantom
+def simulate_phantom(shape, n_gradients, config="crossing", snr=20, seed=0):
+    rng = np.random.default_rng(seed)
+    bvals, bvecs = gradient_scheme(n_gradients)
+    grid = np.meshgrid(*[np.linspace(-1, 1, n) for n in shape], indexing='ij')
+    x, y, z = grid
+
+    # Brain is an ellipsoid. White matter is a slab inside it. GTV is a sphere inside the white matter
+    radius = np.sqrt(x**2 + y**2 + z**2)
+    brain = radius < 0.9
+    white_matter = brain & (np.abs(z) < 0.5) & (np.sqrt(x**2 + y**2) > 0.2)
+    gtv = np.sqrt((x - 0.45)**2 + y**2 + z**2) < 0.15
+
+    # Signal slab by slab (z), so memory stays at one slab of (X, Y, gradients)
+    lambda_par, lambda_perp = fiber_diffusivities
+    populations = fiber_populations(config, grid)
+    data = np.zeros(shape + (len(bvals),), dtype=np.float32)
+    for k in range(shape[2]):
+        signal = np.zeros(shape[:2] + (len(bvals),))
+        for directions, weights in populations:
+            cos2 = (directions[:, :, k] @ bvecs.T)**2
+            signal += weights[:, :, k, None] * np.exp(-bvals * (lambda_perp + (lambda_par - lambda_perp) * cos2))
+        isotropic = np.exp(-bvals * isotropic_diffusivity) * np.ones(shape[:2] + (1,))
+        signal = np.where(white_matter[:, :, k, None], signal, isotropic) * 100 * brain[:, :, k, None]
+
+        # Rician noise
+        sigma = 100 / snr
+        data[:, :, k] = np.hypot(signal + rng.normal(0, sigma, signal.shape), rng.normal(0, sigma, signal.shape))
+
+    return data, bvals, bvecs, brain, white_matter, gtv
+
+# Function to write a phantom case to base_dir. Returns file name of the DWI (as get_fname would)
+def make_phantom_case(base_dir, shape=(64, 64, 32), n_gradients=32, config="crossing", voxel_size=2.0, snr=20, seed=0):
+    base_dir = Path(base_dir)
+    nifti_dir = base_dir / "NIfTI"
+    nifti_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    fname = "phantom"
+
+    data, bvals, bvecs, brain, white_matter, gtv = simulate_phantom(tuple(shape), n_gradients, config, snr, seed)
+    affine = np.diag([voxel_size, voxel_size, voxel_size, 1.0])
+    affine[:3, 3] = -voxel_size * (np.array(shape) - 1) / 2 # centred on the origin
+    nib.save(nib.Nifti1Image(data, affine), nifti_dir / (fname + ".nii.gz"))
+    np.savetxt(nifti_dir / (fname + ".bval"), bvals[None], fmt="%d")
+    np.savetxt(nifti_dir / (fname + ".bvec"), bvecs.T, fmt="%.6f")
+
+    # Masks are flipped in x and y, the same as get_wm_mask and load_rois give them
+    flip = lambda mask: mask[::-1, ::-1, :]
+    save_masks(base_dir, [flip(gtv), flip(brain), flip(brain), flip(white_matter)], affine)
+    return fname
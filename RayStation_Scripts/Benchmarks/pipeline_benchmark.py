@@ -0,0 +1,132 @@
+# Time every stage of the tractography pipeline on synthetic phantoms of several sizes
+# Usage: python pipeline_benchmark.py [--sizes 64x64x32 96x96x48] [--gradients 32 64] [--configs crossing]
+#                                     [--compare Results/pipeline_<older>.json]
+# Results are saved as JSON in Benchmarks/Results, so runs of different versions can be compared
+
+## Import necessary packages
+import sys
+import json
+import time
+import shutil
+import platform
+import datetime
+import argparse
+import tempfile
+import subprocess
+from pathlib import Path
+import numpy as np
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Subscripts.Tractography_Utils import get_data, get_wm_mask, csa_and_sc, seed_gen, streamline_gen, save_tracts
+from Subscripts.WMPL_Utils import get_wmpl
+from Subscripts.Mask_Utils import load_masks
+from Subscripts.Volume_Utils import clear_volume_cache
+from Subscripts.Brain_Mask_Utils import brain_mask_dir
+from phantom import make_phantom_case, fiber_configs
+
+# Folder results are saved to
+results_dir = Path(__file__).parent / "Results"
+
+# Stages timed (in pipeline order). get_data makes the brain mask, get_data_cached loads it again from BrainMask
+# (what every later run of a case does)
+stages = ["get_data", "get_data_cached", "get_wm_mask", "csa_and_sc", "seed_gen", "streamline_gen", "save_tracts",
+          "get_wmpl"]
+
+# Function to get the version of the code being benchmarked
+def code_version():
+    try:
+        return subprocess.run(["git", "describe", "--always", "--dirty"], capture_output=True, text=True,
+                              cwd=Path(__file__).parent).stdout.strip()
+    except OSError:
+        return "unknown"
+
+# Function to run the pipeline stages on a phantom case, timing each one
+def time_stages(base_dir, fname):
+    times = {}
+    def timed(name, function, *args):
+        start = time.perf_counter()
+        result = function(*args)
+        times[name] = time.perf_counter() - start
+        return result
+
+    nifti_dir = base_dir / "NIfTI"
+    (gtv_mask,), _ = load_masks(base_dir, ["gtv"], dtype=np.uint8)
+    timed("get_data", get_data, nifti_dir, fname)
+    data_masked, mask, gtab, affine, hardi_img = timed("get_data_cached", get_data, nifti_dir, fname)
+    white_matter_mask, FA = timed("get_wm_mask", get_wm_mask, data_masked, gtab)
+    csa_peaks, stopping_criterion = timed("csa_and_sc", csa_and_sc, gtab, data_masked, white_matter_mask, FA)
+    seeds_wm, seeds_gtv = timed("seed_gen", seed_gen, gtv_mask, white_matter_mask, affine, 1)
+    streamlines_wm, streamlines_gtv = timed("streamline_gen", streamline_gen, seeds_wm, seeds_gtv, csa_peaks,
+                                            stopping_criterion, affine)
+    timed("save_tracts", save_tracts, base_dir, streamlines_wm, streamlines_gtv, hardi_img)
+    timed("get_wmpl", get_wmpl, base_dir)
+
+    counts = {"seeds": len(seeds_wm) + len(seeds_gtv), "streamlines_wm": len(streamlines_wm),
+              "streamlines_gtv": len(streamlines_gtv), "white_matter_voxels": int(white_matter_mask.sum())}
+    return times, counts
+
+# Function to benchmark one phantom configuration (median time per stage over repeats)
+def benchmark_config(shape, n_gradients, config, repeats):
+    work_dir = Path(tempfile.mkdtemp(prefix="phantom_"))
+    try:
+        fname = make_phantom_case(work_dir, shape=shape, n_gradients=n_gradients, config=config)
+        runs = []
+        for _ in range(repeats):
+            shutil.rmtree(work_dir / "Tracts", ignore_errors=True) # outputs of previous repeat
+            shutil.rmtree(work_dir / "WMPL", ignore_errors=True)
+            shutil.rmtree(brain_mask_dir(work_dir / "NIfTI"), ignore_errors=True) # so get_data makes it every time
+            times, counts = time_stages(work_dir, fname)
+            runs.append(times)
+    finally:
+        clear_volume_cache() # release memory-mapped masks before removing the case
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    stage_times = {stage: float(np.median([run[stage] for run in runs])) for stage in stages}
+    return {"shape": list(shape), "n_gradients": n_gradients, "config": config, "repeats": repeats,
+            "stages": stage_times, "total": sum(stage_times.values()), "counts": counts}
+
+# Function to print how stage times changed from an older results file
+def compare(results, old_path):
+    old = {(tuple(r["shape"]), r["n_gradients"], r["config"]): r for r in json.loads(Path(old_path).read_text())["results"]}
+    print(f"\nCompared with {old_path} (ratio new/old, above 1 is slower):")
+    for result in results:
+        key = (tuple(result["shape"]), result["n_gradients"], result["config"])
+        if key not in old:
+            continue
+        ratios = ", ".join(f"{stage} {result['stages'][stage] / old[key]['stages'][stage]:.2f}" for stage in stages
+                           if old[key]['stages'].get(stage))
+        print(f"  {'x'.join(map(str, key[0]))}, {key[1]} gradients, {key[2]}: {ratios}")
+
+# Only run when executed directly
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark pipeline stages on synthetic diffusion phantoms.")
+    parser.add_argument("--sizes", nargs="+", default=["64x64x32", "96x96x48"], help="Matrix sizes (XxYxZ)")
+    parser.add_argument("--gradients", nargs="+", type=int, default=[32], help="Numbers of gradient directions")
+    parser.add_argument("--configs", nargs="+", default=["crossing"], choices=fiber_configs, help="Fiber configurations")
+    parser.add_argument("--repeats", type=int, default=1, help="Runs per configuration (median time is kept)")
+    parser.add_argument("--compare", type=Path, default=None, help="Older results file to compare with")
+    args = parser.parse_args()
+
+    results = []
+    for size in args.sizes:
+        shape = tuple(int(n) for n in size.lower().split("x"))
+        for n_gradients in args.gradients:
+            for config in args.configs:
+                print(f"Benchmarking {size}, {n_gradients} gradients, {config} fibers...")
+                result = benchmark_config(shape, n_gradients, config, args.repeats)
+                results.append(result)
+                print("  " + ", ".join(f"{stage} {seconds:.2f} s" for stage, seconds in result["stages"].items()))
+
+    results_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    out_path = results_dir / f"pipeline_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    out_path.write_text(json.dumps({
+        "version": code_version(), "timestamp": datetime.datetime.now().isoformat(),
+        "machine": {"platform": platform.platform(), "processor": platform.processor(), "python": platform.python_version()},
+        "results": results
+    }, indent=2), encoding='utf-8')
+    print(f"Results saved to {out_path}")
+
+    if args.compare is not None:
+        compare(results, args.compare)
@@ -0,0 +1,97 @@
+# Compare fast and full CT to MR registration (time and accuracy) on processed cases
+# Usage: python registration_benchmark.py <base_dir> [<base_dir> ...]
+# Cases need RayStation/CT_NIfTI and RayStation/MR_NIfTI (made by roi_interp)
+
+## Import necessary packages
+import sys
+import json
+import time
+import datetime
+import argparse
+from pathlib import Path
+import numpy as np
+import ants
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Subscripts.Registration_Utils import register_ct_to_mr, identity_transform, frame_of_reference_uid
+from Subscripts.Preliminaries import get_fname
+
+# Folder results are saved to
+results_dir = Path(__file__).parent / "Results"
+
+# Function to map physical points (N,3) with a saved affine transform file from ANTs
+def apply_transform_file(transform_path, points):
+    transform = ants.read_transform(transform_path)
+    params = np.asarray(transform.parameters); centre = np.asarray(transform.fixed_parameters)
+    matrix = params[:9].reshape(3, 3); translation = params[9:12]
+    return (points - centre) @ matrix.T + translation + centre
+
+# Function to get physical coordinates of (up to n) random foreground voxels of an image
+def foreground_points(image, n=5000, seed=0):
+    data = image.numpy()
+    idx = np.argwhere(data > data.mean()) # rough head/body mask
+    idx = idx[np.random.default_rng(seed).choice(len(idx), size=min(n, len(idx)), replace=False)]
+    direction = np.asarray(image.direction); spacing = np.asarray(image.spacing); origin = np.asarray(image.origin)
+    return origin + (idx * spacing) @ direction.T
+
+# Function to time one registration
+def timed_registration(ct_ants, mr_ants, mode, initial_transform):
+    start = time.perf_counter()
+    reg = register_ct_to_mr(ct_ants, mr_ants, mode=mode, initial_transform=initial_transform)
+    return reg['fwdtransforms'][0], time.perf_counter() - start
+
+# Function to benchmark one case
+def benchmark_case(base_dir, repeats):
+    rs_dir = base_dir / "RayStation"
+    ct_path = rs_dir / "CT_NIfTI" / (get_fname(rs_dir / "CT_NIfTI") + ".nii.gz")
+    mr_path = rs_dir / "MR_NIfTI" / (get_fname(rs_dir / "MR_NIfTI") + ".nii.gz")
+    ct_ants = ants.image_read(str(ct_path)); mr_ants = ants.image_read(str(mr_path))
+
+    # Fast mode starts from the DICOM geometry when CT and MR share a frame of reference (as in roi_interp)
+    ct_for_uid = frame_of_reference_uid(rs_dir / "CT_DICOM")
+    same_for = bool(ct_for_uid) and ct_for_uid == frame_of_reference_uid(rs_dir / "MR_DICOM")
+    fast_init = identity_transform(results_dir / "identity.mat") if same_for else None
+
+    times = {"full": [], "fast": []}
+    for _ in range(repeats):
+        full_transform, full_time = timed_registration(ct_ants, mr_ants, "full", None)
+        fast_transform, fast_time = timed_registration(ct_ants, mr_ants, "fast", fast_init)
+        times["full"].append(full_time); times["fast"].append(fast_time)
+
+    # Distance between where the two transforms send MR foreground points (full registration is the reference)
+    points = foreground_points(mr_ants)
+    distances = np.linalg.norm(apply_transform_file(full_transform, points) - apply_transform_file(fast_transform, points),
+                               axis=1)
+
+    return {
+        "case": str(base_dir),
+        "ct_shape": list(ct_ants.shape), "mr_shape": list(mr_ants.shape),
+        "same_frame_of_reference": same_for,
+        "full_s": float(np.median(times["full"])), "fast_s": float(np.median(times["fast"])),
+        "speedup": float(np.median(times["full"]) / np.median(times["fast"])),
+        "distance_mean_mm": float(distances.mean()), "distance_p95_mm": float(np.percentile(distances, 95)),
+        "distance_max_mm": float(distances.max())
+    }
+
+# Only run when executed directly
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark fast vs full CT to MR registration.")
+    parser.add_argument("base_dirs", nargs="+", type=Path, help="Base directories of processed cases")
+    parser.add_argument("--repeats", type=int, default=1, help="Registrations per mode (median time is kept)")
+    args = parser.parse_args()
+
+    results_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    results = []
+    for base_dir in args.base_dirs:
+        print(f"Benchmarking registration of {base_dir}...")
+        result = benchmark_case(base_dir, args.repeats)
+        results.append(result)
+        print(f"  full {result['full_s']:.1f} s, fast {result['fast_s']:.1f} s ({result['speedup']:.1f}x). "
+              f"Fast vs full: mean {result['distance_mean_mm']:.2f} mm, 95th percentile "
+              f"{result['distance_p95_mm']:.2f} mm, max {result['distance_max_mm']:.2f} mm")
+
+    out_path = results_dir / f"registration_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    out_path.write_text(json.dumps(results, indent=2), encoding='utf-8')
+    print(f"Results saved to {out_path}")
@@ -0,0 +1,101 @@
+# Compare RT Struct rasterization of rt_utils (one ROI at a time) with rasterize_rois (all ROIs in one pass)
+# Usage: python rtstruct_benchmark.py <base_dir> [<base_dir> ...]
+# Cases need RayStation/ROIs and RayStation/MR_DICOM (made by rs_folders)
+
+## Import necessary packages
+import sys
+import json
+import time
+import datetime
+import argparse
+from pathlib import Path
+import numpy as np
+import pydicom
+from rt_utils import RTStructBuilder
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Subscripts.RTStruct_Utils import rasterize_rois, get_roi_names
+from Subscripts.Mask_Utils import labels_to_masks
+from Subscripts.Preliminaries import rs_get_paths
+
+# Folder results are saved to
+results_dir = Path(__file__).parent / "Results"
+
+# Function to pick the ROIs load_rois uses
+def pick_rois(roi_names):
+    return [[name for name in roi_names if "GTV" in name][0],
+            [name for name in roi_names if "EXTERNAL" == name.upper()][0],
+            [name for name in roi_names if "BRAIN" == name.upper()][0]]
+
+# Function to get masks the way load_rois used to (rt_utils, then transpose and flip x)
+def rt_utils_masks(rt_struct_path, mr_dcm_dir, names):
+    rtstruct = RTStructBuilder.create_from(dicom_series_path=mr_dcm_dir, rt_struct_path=rt_struct_path)
+    masks = []
+    for name in names:
+        mask = rtstruct.get_roi_mask_by_name(name)
+        mask = np.transpose(mask, (1, 0, 2)) # change to [x y z]
+        masks.append(mask[::-1, :, :]) # flip x-axis to be proper for NIfTI
+    return masks
+
+# Function to get masks with the single pass rasterizer
+def single_pass_masks(rt_struct_path, mr_dcm_dir, names):
+    rtstruct = pydicom.dcmread(rt_struct_path)
+    return labels_to_masks(rasterize_rois(rtstruct, mr_dcm_dir, names), len(names))
+
+# Function to compute Dice coefficient of two masks
+def dice(mask_a, mask_b):
+    mask_a = mask_a > 0; mask_b = mask_b > 0
+    total = mask_a.sum() + mask_b.sum()
+    return float(2 * (mask_a & mask_b).sum() / total) if total else 1.0
+
+# Function to time a function (median of repeats). Returns last result and time (s)
+def timed(function, repeats, *args):
+    times = []
+    for _ in range(repeats):
+        start = time.perf_counter()
+        result = function(*args)
+        times.append(time.perf_counter() - start)
+    return result, float(np.median(times))
+
+# Function to benchmark one case
+def benchmark_case(base_dir, repeats):
+    rs_dir = base_dir / "RayStation"
+    mr_dcm_dir = rs_dir / "MR_DICOM"
+    rt_struct_path = rs_get_paths(rs_dir / "ROIs", prints=False)["RS_File_Paths"][0]
+    names = pick_rois(get_roi_names(pydicom.dcmread(rt_struct_path, stop_before_pixels=True)))
+
+    reference, rt_utils_time = timed(rt_utils_masks, repeats, rt_struct_path, mr_dcm_dir, names)
+    masks, single_pass_time = timed(single_pass_masks, repeats, rt_struct_path, mr_dcm_dir, names)
+
+    return {
+        "case": str(base_dir),
+        "shape": list(masks[0].shape),
+        "rt_utils_s": rt_utils_time, "single_pass_s": single_pass_time, "speedup": rt_utils_time / single_pass_time,
+        "rois": {name: {"dice": dice(mask, ref), "voxels": int((ref > 0).sum()),
+                        "voxels_different": int(((mask > 0) != (ref > 0)).sum())}
+                 for name, mask, ref in zip(names, masks, reference)}
+    }
+
+# Only run when executed directly
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Benchmark RT Struct rasterization against rt_utils.")
+    parser.add_argument("base_dirs", nargs="+", type=Path, help="Base directories of cases")
+    parser.add_argument("--repeats", type=int, default=3, help="Runs per method (median time is kept)")
+    args = parser.parse_args()
+
+    results_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    results = []
+    for base_dir in args.base_dirs:
+        print(f"Benchmarking RT Struct rasterization of {base_dir}...")
+        result = benchmark_case(base_dir, args.repeats)
+        results.append(result)
+        print(f"  rt_utils {result['rt_utils_s']:.2f} s, single pass {result['single_pass_s']:.2f} s "
+              f"({result['speedup']:.1f}x)")
+        for name, roi in result["rois"].items():
+            print(f"  {name}: Dice {roi['dice']:.4f} ({roi['voxels_different']} of {roi['voxels']} voxels differ)")
+
+    out_path = results_dir / f"rtstruct_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    out_path.write_text(json.dumps(results, indent=2), encoding='utf-8')
+    print(f"Results saved to {out_path}")
@@ -0,0 +1,87 @@
+# Compare tracking engines on the same synthetic phantom: throughput, streamline counts and lengths
+# Usage: python tracking_benchmark.py [--engines eudx deterministic probabilistic pft] [--size 64x64x32] [--config crossing]
+# Results are saved as JSON in Benchmarks/Results
+
+## Import necessary packages
+import sys
+import json
+import time
+import shutil
+import datetime
+import argparse
+import tempfile
+from pathlib import Path
+import numpy as np
+from dipy.tracking.streamline import Streamlines, length
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Subscripts.Tractography_Utils import get_data, get_wm_mask, csa_and_sc, seed_gen
+from Subscripts.Tracking_Engines import tracking_engines, make_stopping_criterion, track
+from Subscripts.Mask_Utils import load_masks
+from Subscripts.Volume_Utils import clear_volume_cache
+from phantom import make_phantom_case, fiber_configs
+from pipeline_benchmark import code_version
+
+# Folder results are saved to
+results_dir = Path(__file__).parent / "Results"
+
+# Function to track the seeds with one engine and measure it
+def benchmark_engine(engine, seeds, FA, brain_mask, affine, csa_peaks, gtv_mask, threads):
+    stopping_criterion = make_stopping_criterion(engine, FA, brain_mask, affine)
+    start = time.perf_counter()
+    streamlines = Streamlines(track(engine, seeds, stopping_criterion, affine, csa_peaks, nbr_threads=threads))
+    seconds = time.perf_counter() - start
+
+    lengths = np.asarray(list(length(streamlines))) if len(streamlines) else np.zeros(1)
+    # Streamlines passing through the GTV (the ones WMPL uses)
+    voxels = [np.round(np.c_[s, np.ones(len(s))] @ np.linalg.inv(affine).T)[:, :3].astype(int) for s in streamlines]
+    shape = np.array(gtv_mask.shape)
+    touches = sum(bool(gtv_mask[tuple(v[np.all((v >= 0) & (v < shape), axis=1)].T)].any()) for v in voxels)
+    return {"engine": engine, "seconds": round(seconds, 3), "seeds": len(seeds), "streamlines": len(streamlines),
+            "streamlines_per_s": round(len(streamlines) / seconds, 1) if seconds > 0 else None,
+            "mean_length_mm": round(float(lengths.mean()), 2), "gtv_streamlines": int(touches)}
+
+# Only run when executed directly
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser(description="Compare tracking engines on a synthetic diffusion phantom.")
+    parser.add_argument("--engines", nargs="+", default=list(tracking_engines), choices=list(tracking_engines))
+    parser.add_argument("--size", default="64x64x32", help="Matrix size (XxYxZ)")
+    parser.add_argument("--gradients", type=int, default=32, help="Number of gradient directions")
+    parser.add_argument("--config", default="crossing", choices=fiber_configs, help="Fiber configuration")
+    parser.add_argument("--threads", type=int, default=0, help="Tracking threads (0 uses all cores)")
+    args = parser.parse_args()
+
+    shape = tuple(int(n) for n in args.size.lower().split("x"))
+    work_dir = Path(tempfile.mkdtemp(prefix="phantom_"))
+    try:
+        # Same phantom, peaks and seeds for every engine
+        fname = make_phantom_case(work_dir, shape=shape, n_gradients=args.gradients, config=args.config)
+        (gtv_mask,), _ = load_masks(work_dir, ["gtv"], dtype=np.uint8)
+        data_masked, mask, gtab, affine, hardi_img = get_data(work_dir / "NIfTI", fname)
+        white_matter_mask, FA = get_wm_mask(data_masked, gtab)
+        csa_peaks, _ = csa_and_sc(gtab, data_masked, white_matter_mask, FA)
+        seeds_wm, seeds_gtv = seed_gen(gtv_mask, white_matter_mask, affine, seeds_per_voxel=1)
+        seeds = np.concatenate([seeds_wm, seeds_gtv])
+
+        results = []
+        for engine in args.engines:
+            print(f"Tracking with {engine}...")
+            result = benchmark_engine(engine, seeds, FA, mask, affine, csa_peaks, gtv_mask, args.threads)
+            results.append(result)
+            print(f"  {result['streamlines']} streamlines in {result['seconds']:.2f} s "
+                  f"({result['streamlines_per_s']} /s), mean length {result['mean_length_mm']} mm, "
+                  f"{result['gtv_streamlines']} through GTV")
+    finally:
+        clear_volume_cache() # release memory-mapped masks before removing the case
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    results_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    out_path = results_dir / f"tracking_{datetime.datetime.now():%Y%m%d_%H%M%S}.json"
+    out_path.write_text(json.dumps({
+        "version": code_version(), "timestamp": datetime.datetime.now().isoformat(),
+        "phantom": {"shape": list(shape), "n_gradients": args.gradients, "config": args.config},
+        "threads": args.threads, "results": results
+    }, indent=2), encoding='utf-8')
+    print(f"Results saved to {out_path}")
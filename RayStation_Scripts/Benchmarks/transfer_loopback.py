@@ -0,0 +1,208 @@
+# Check the transfer protocol end to end: a TransferServer on 127.0.0.1 (in a thread) and a TransferClient
+# Checks LIST, FETCH, resuming a partial download, resuming after the server is closed mid transfer and restarted,
+# refetching a changed file and that folders outside the client's case folder are refused
+# Usage: python transfer_loopback.py [--size-mb 5] [--kill-after 3]
+
+## Import necessary packages
+import os
+import json
+import sys
+import zmq
+import time
+import zlib
+import tempfile
+import argparse
+import threading
+from pathlib import Path
+
+# Import necessary functions (Subscripts lives next to this folder)
+sys.path.append(str(Path(__file__).resolve().parents[1]))
+from Subscripts.Transfer_Utils import TransferServer, TransferClient, is_transfer_msg, chunk_size, credit_window
+
+client_id = b"loopback-client"
+
+# Function to run a transfer server on a ROUTER socket until stop is set
+# With stop_after (bytes), the server closes as soon as a transfer has sent that far, as if it was killed mid transfer
+# Offsets of the FETCH requests received are added to fetch_offsets (if given)
+def serve(context, endpoint, case_root, base_dir, ready, stop, stop_after=None, fetch_offsets=None):
+    socket = context.socket(zmq.ROUTER)
+    socket.linger = 0 # doesn't wait for anything when closing
+    for _ in range(50):
+        try:
+            socket.bind(endpoint)
+            break
+        except zmq.ZMQError: # Port of a server that just closed may not be released yet
+            time.sleep(0.1)
+    transfer_server = TransferServer(socket, case_root)
+    # The case root itself, folders outside it and cases of other clients are refused
+    assert not transfer_server.add_root(client_id, case_root), "case root accepted as a case folder"
+    assert not transfer_server.add_root(client_id, "/"), "filesystem root accepted as a case folder"
+    assert not transfer_server.add_root(client_id, Path(case_root).parent), "folder outside case root accepted"
+    assert transfer_server.add_root(client_id, base_dir), "case folder refused"
+    ready.set()
+    poller = zmq.Poller()
+    poller.register(socket, zmq.POLLIN)
+    while not stop.is_set():
+        if dict(poller.poll(timeout=0 if transfer_server.busy() else 50)):
+            identity, _, *frames = socket.recv_multipart()
+            if is_transfer_msg(frames):
+                if fetch_offsets is not None:
+                    header = json.loads(frames[1].decode('utf-8'))
+                    if header.get("cmd") == "FETCH":
+                        fetch_offsets.append(header.get("offset", 0))
+                transfer_server.handle(identity, frames)
+        transfer_server.pump()
+        if stop_after is not None and any(session["offset"] >= stop_after
+                                          for session in transfer_server.sessions.values()):
+            break # Closed mid transfer
+    transfer_server.close()
+    socket.close()
+
+# Function to restart the server once the one in thread has closed
+# Waits until the client stopped writing the partial download (part_path) and records its size in part_sizes
+def restart(thread, part_path, part_sizes, threads, serve_args):
+    thread.join()
+    size = -1
+    while not part_path.exists() or part_path.stat().st_size != size: # chunks already received are still written
+        size = part_path.stat().st_size if part_path.exists() else -1
+        time.sleep(0.3)
+    part_sizes.append(size)
+    new_thread = threading.Thread(target=serve, args=serve_args, daemon=True)
+    threads.append(new_thread)
+    new_thread.start()
+
+# Function to check a condition and print the result
+def check(name, condition):
+    print(f"{'PASS' if condition else 'FAIL'}  {name}")
+    return bool(condition)
+
+# Main function
+def main():
+    parser = argparse.ArgumentParser(description="Check the transfer protocol over a loopback connection.")
+    parser.add_argument("--size-mb", type=float, default=5, help="Size (MB) of the file transferred")
+    parser.add_argument("--kill-after", type=int, default=3,
+                        help="Chunks sent before the server is closed in the restart check (sent a credit window at a time)")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        tmp = Path(tmp)
+        case_root = tmp / "Patients"
+        base_dir = case_root / "Case 1"
+        other_dir = case_root / "Case 2"
+        local_dir = tmp / "Local"
+        for folder in [base_dir / "Tracts", other_dir]:
+            folder.mkdir(parents=True)
+        data = os.urandom(int(args.size_mb * 2**20))
+        (base_dir / "Tracts" / "tracts.trk").write_bytes(data)
+        (base_dir / "Tracts" / "small.txt").write_text("small file")
+        (other_dir / "secret.txt").write_text("not for this client")
+        (tmp / "outside.txt").write_text("outside case root")
+
+        context = zmq.Context()
+        ready, stop = threading.Event(), threading.Event()
+        # Find a free port for the server
+        probe = context.socket(zmq.ROUTER)
+        port = probe.bind_to_random_port("tcp://127.0.0.1")
+        probe.close()
+        endpoint = f"tcp://127.0.0.1:{port}"
+        thread = threading.Thread(target=serve, args=(context, endpoint, case_root, base_dir, ready, stop), daemon=True)
+        threads = [thread]
+        thread.start()
+        ready.wait()
+
+        socket = context.socket(zmq.DEALER)
+        socket.linger = 0 # doesn't wait for anything when closing
+        socket.setsockopt(zmq.IDENTITY, client_id)
+        socket.connect(f"tcp://127.0.0.1:{port}")
+        client = TransferClient(socket)
+        ok = True
+        try:
+            # LIST
+            files = {entry["path"]: entry for entry in client.list_dir(base_dir / "Tracts", timeout=5)}
+            ok &= check("LIST returns every file with its size",
+                        set(files) == {"tracts.trk", "small.txt"} and files["tracts.trk"]["size"] == len(data))
+
+            # FETCH
+            start = time.perf_counter()
+            total = client.fetch_dir(base_dir / "Tracts", local_dir / "Tracts", timeout=5)
+            seconds = time.perf_counter() - start
+            local_path = local_dir / "Tracts" / "tracts.trk"
+            ok &= check(f"FETCH copies files ({total / 2**20:.1f} MB in {seconds:.2f} s)",
+                        local_path.read_bytes() == data and (local_dir / "Tracts" / "small.txt").read_text() == "small file")
+            ok &= check("Fetching again skips unchanged files", client.fetch_dir(base_dir / "Tracts", local_dir / "Tracts",
+                                                                                 timeout=5) == 0)
+
+            # Resume: keep the first chunks of a new version of the file as its partial download
+            new_data = os.urandom(len(data))
+            remote_path = base_dir / "Tracts" / "tracts.trk"
+            remote_path.write_bytes(new_data)
+            mtime_ns = remote_path.stat().st_mtime_ns
+            part_path = local_path.with_name(f"{local_path.name}.{mtime_ns}.part")
+            part_path.write_bytes(new_data[:2 * chunk_size + 123])
+            client.fetch_file(remote_path, local_path, mtime_ns=mtime_ns, timeout=5)
+            ok &= check("FETCH resumes a partial download", local_path.read_bytes() == new_data and not part_path.exists())
+
+            # Server closed after a few chunks and restarted: the same fetch_file call resumes from its .part file
+            # The file is larger than the credit window so the server can't have sent it all before closing
+            restart_data = os.urandom((args.kill_after + 2 * credit_window) * chunk_size + 123)
+            restart_remote = base_dir / "Restart" / "large.bin"
+            restart_remote.parent.mkdir()
+            restart_remote.write_bytes(restart_data)
+            restart_local = local_dir / "Restart" / "large.bin"
+            restart_part = restart_local.with_name(f"{restart_local.name}.part")
+            stop.set() # Replace the server by one closing mid transfer
+            threads[-1].join()
+            stop.clear()
+            first_offsets, resumed_offsets, part_sizes = [], [], []
+            killed = threading.Thread(target=serve, args=(context, endpoint, case_root, base_dir, threading.Event(), stop,
+                                                          args.kill_after * chunk_size, first_offsets), daemon=True)
+            threads.append(killed)
+            killed.start()
+            restarter = threading.Thread(target=restart, args=(killed, restart_part, part_sizes, threads,
+                                                               (context, endpoint, case_root, base_dir, threading.Event(),
+                                                                stop, None, resumed_offsets)), daemon=True)
+            restarter.start()
+            client.fetch_file(restart_remote, restart_local, timeout=2)
+            restarter.join()
+            ok &= check(f"FETCH resumes after the server is closed and restarted (from offset "
+                        f"{resumed_offsets[0] if resumed_offsets else None} of {len(restart_data)})",
+                        first_offsets == [0] and part_sizes and 0 < part_sizes[0] < len(restart_data)
+                        and resumed_offsets[:1] == part_sizes)
+            ok &= check("Resumed file matches the CRC of the served file",
+                        zlib.crc32(restart_local.read_bytes()) == zlib.crc32(restart_data) and not restart_part.exists())
+
+            # Same size, new content: fetched again
+            newer_data = os.urandom(len(data))
+            remote_path.write_bytes(newer_data)
+            os.utime(remote_path, ns=(mtime_ns + 10**9, mtime_ns + 10**9)) # coarse filesystem clocks
+            total = client.fetch_dir(base_dir / "Tracts", local_dir / "Tracts", timeout=5)
+            ok &= check("Files changed without changing size are fetched again",
+                        total == len(data) and local_path.read_bytes() == newer_data)
+
+            # Outside the client's case folder
+            for name, path in [("another case", other_dir / "secret.txt"), ("outside case root", tmp / "outside.txt"),
+                               ("path escaping the case folder", base_dir / ".." / "Case 2" / "secret.txt")]:
+                try:
+                    client.fetch_file(path, local_dir / "refused.txt", timeout=5)
+                    refused = False
+                except FileNotFoundError:
+                    refused = True
+                ok &= check(f"FETCH refused for {name}", refused)
+            try:
+                client.list_dir(case_root, timeout=5)
+                refused = False
+            except FileNotFoundError:
+                refused = True
+            ok &= check("LIST refused for the case root", refused)
+        finally:
+            stop.set()
+            for thread in threads:
+                thread.join()
+            socket.close()
+            context.term()
+
+    print("All checks passed." if ok else "Some checks FAILED.")
+    return 0 if ok else 1
+
+if __name__ == "__main__":
+    sys.exit(main())
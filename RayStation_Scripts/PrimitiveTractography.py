@@ -1,15 +1,14 @@
 # Adapting primitive tractography script to RayStation
 
 # Import necessary functions
-from Subscripts.Preliminaries import check_nifti_folder, get_relevant_files, copy_relevant_files 
-from Subscripts.Preliminaries import dicom_to_nifti, get_fname
-from Subscripts.Tractography_Utils import get_data, get_wm_mask, csa_and_sc, seed_gen, streamline_gen, save_tracts, get_tracts
-from Subscripts.RS_ROI_Utils import rs_folders, load_rois, roi_interp, get_white_matter_mask
-from Subscripts.WMPL_Utils import get_wmpl, save_wmpl_dicom
+from Subscripts.Pipeline import run_pipeline
+from Subscripts.Progress_Utils import emit
+from Subscripts.Profile_Utils import enable_profiling, report_profile
 
 # Import packages
 import zmq
 import json
+import sys
 from pathlib import Path
 
 # Preliminaries
@@ -18,12 +17,21 @@ from pathlib import Path
 context = zmq.Context()
 
 ## Define data port to be used with server for sending data (for fury. like streamlines, masks, and affine)
-data_port = "5564"
+## Given by the server so several servers can run on one machine
+data_port = sys.argv[1] if len(sys.argv) > 1 else "5564"
+
+## Job ID given by the server. Names our data socket so the server sends us the base directory of our job only
+job_id = sys.argv[2] if len(sys.argv) > 2 else None
 
 ## Define data socket
 data_socket = context.socket(zmq.DEALER)
+if job_id is not None:
+    data_socket.setsockopt(zmq.IDENTITY, job_id.encode('utf-8'))
 data_socket.connect(f"tcp://localhost:{data_port}")
 
+# Tell server we are ready for the base directory
+data_socket.send_multipart([b'', b'', b'READY'])
+
 # Create poller to wait for server
 poller = zmq.Poller()
 poller.register(data_socket, zmq.POLLIN)
@@ -39,104 +47,61 @@ while True:
 interactive = True
 print("Interactivity: ", interactive)
 
-## Define NIfTI folder path
-nifti_dir = base_dir / "NIfTI"
-## Check if NIfTI folder has all the required files
-print(f"Checking NIfTI folder {nifti_dir}...")
-valid_folder = check_nifti_folder(nifti_dir, bval_bvec_expected=True)
-
-if not valid_folder: ## only proceed if NIfTI folder doesn't already contain necessary files
-    # Get diffusion MRIs if any exist
-    print("Collecting relevant MRI files...")
-    relevant_files = get_relevant_files(base_dir)
-
-    # Copy relevant diffusion MRIs to a new folder
-    print("Copying relevant files to a new folder...")
-    dicom_dir = copy_relevant_files(base_dir, relevant_files) # return output DICOM folder
-
-    # Convert DICOM files to NIfTI
-    print("Converting from DICOM to NIfTI...")
-    dicom_to_nifti(dicom_dir, nifti_dir)
-
-## Extract file name
-print("Getting file name...")
-fname = get_fname(nifti_dir)
-
-# Tractography
-
-## First check if tractography has already been completed
-print("Checking for existance of saved tracts...")
-streamlines_wm, streamlines_gtv, affine, tracts_flag = get_tracts(base_dir)
-
-## Check if white matter mask exists
-print("Checking for saved white matter mask...")
-white_matter_mask = get_white_matter_mask(base_dir)
-
-if white_matter_mask.size == 0 or not tracts_flag:
-    ## Extract data and perform segmentation
-    print("Extracting data and performing segmentation...")
-    data_masked, mask, gtab, affine, hardi_img = get_data(nifti_dir, fname)
-    print("Data obtained.")
-
-    ## Create white matter mask with DTI
-    print("Extracting white matter mask using DTI...")
-    white_matter_mask, FA = get_wm_mask(data_masked, gtab)
-    print("White matter mask obtained.")
-
-## Obtain ROIs defined on RS
-### Check if folders valid. Create them if they are not
-print("Checking for RayStation files...")
-rs_folders(base_dir)
-
-### Load ROIs
-print("Loading ROIs...")
-gtv_mask, external_mask, brain_mask = load_rois(base_dir)
-
-### Perform interpolation to match mask shapes. Function will check if this is necessary. Returns required masks
-gtv_mask, external_mask, brain_mask, white_matter_mask, gtv_wm_mask = roi_interp(base_dir, gtv_mask, external_mask, 
-                                                                                 brain_mask, white_matter_mask, affine)
-print("Relevant ROIs succesfully loaded in MR coordinates.")
-
-if not tracts_flag:
-    ## Get CSA ODF model and define stopping criterion
-    print("Applying CSA ODF model...")
-    csa_peaks, stopping_criterion = csa_and_sc(gtab, data_masked, white_matter_mask, FA)
-    print("CSA ODF model successfully applied to data.")
-
-    ## Generate seeds 
-    print("Generating seeds...")
-    seeds_wm, seeds_gtv = seed_gen(gtv_mask, white_matter_mask, affine, seeds_per_voxel=1)
-    print("Seeds generated.")
-
-    ## Generate streamlines
-    print("Generating streamlines...")
-    streamlines_wm, streamlines_gtv = streamline_gen(seeds_wm, seeds_gtv, csa_peaks, stopping_criterion, affine)
-    print("Streamlines generated.")
-
-    ## Save tracts
-    print("Saving tracts...")
-    save_tracts(base_dir, streamlines_wm, streamlines_gtv, hardi_img)
-    print("Tracts successfully saved.")
-
-## Show tracts
-if interactive:
-    print("Showing tracts...")
-    data_socket.send_multipart([ds_identity, b'', b'Show Fury - Tracts']) # Send message over via socket
-
-# WMPL
-
-## Create WMPL map (loads if already saved before)
-wmpl = get_wmpl(base_dir)
-
-## Save WMPL map as a DICOM
-print("Saving WMPL map as a DICOM...")
-save_wmpl_dicom(base_dir, wmpl)
-print("WMPL map saved as DICOM successfully")
-
-## Show WMPL map
-if interactive:
-
-    print("Showing WMPL map...")
-    data_socket.send_multipart([ds_identity, b'', b'Show Fury - WMPL']) # Send message over via socket
+# Save QA images (standard views of tracts and WMPL map) rendered offscreen
+qa_snapshots = False
+
+# CT to MR registration mode. "fast" uses a coarser pyramid and voxel sampling (see Benchmarks/registration_benchmark.py)
+registration_mode = "full"
+
+# Run the heavy stages (DTI, CSA, tracking) on the bounding box of the brain only. Results are identical
+crop_to_brain = True
+
+# Volumes the brain mask is made from: "all" (mean of every diffusion volume) or "b0" (b0 volumes only, faster)
+# The mask is saved in BrainMask and reused on later runs of the same series
+brain_mask_mode = "all"
+
+# Memory-map the DWI (uncompressed copy made once next to it) and fit DTI/CSA slab by slab
+# Peak memory then follows the slab size (slab_size in Volume_Utils) instead of the whole 4D acquisition
+dwi_memmap = False
+
+# Tracking engine: "eudx", "deterministic", "probabilistic" or "pft" (see Tracking_Engines and Benchmarks/tracking_benchmark.py)
+tracking_engine = "eudx"
+
+# White matter seeding: "uniform" (every voxel, as in the paper), "gtv_proximal" or "fa_weighted" (see Seeding_Utils)
+# seed_budget caps the number of white matter seeds (None for no cap)
+seeding_strategy = "uniform"
+seed_budget = None
+
+# Keep only white matter streamlines through the GTV (all WMPL needs), filtered while tracking
+# All streamlines are still kept when they are shown (interactive or QA snapshots)
+filter_tracts_to_gtv = True
+
+# Also save tracts as a compressed uint16 cache next to the trk files (see Tract_Cache_Utils), loaded instead of them
+# The cache is only kept if WMPL from it matches WMPL from the trk streamlines
+compressed_tract_cache = False
+
+# Profile pipeline functions (time, CPU, peak memory, top allocations). Summary is printed and sent at the end
+# profile_dumps writes a profiler dump per call to <base_dir>/Profiles: None, "cprofile" or "pyinstrument"
+profiling = False
+profile_dumps = None
+if profiling:
+    enable_profiling(dump=profile_dumps, dump_dir=base_dir / "Profiles")
+
+# Function to tell the client to show tracts or WMPL map
+def show(kind):
+    data_socket.send_multipart([ds_identity, b'', f'Show Fury - {kind}'.encode('utf-8')]) # Send message over via socket
+
+# Run pipeline (see Subscripts/Pipeline.py)
+run_pipeline(base_dir, show=show if interactive else None, qa_snapshots=qa_snapshots,
+             registration_mode=registration_mode, crop_to_brain=crop_to_brain, brain_mask_mode=brain_mask_mode,
+             dwi_memmap=dwi_memmap, tracking_engine=tracking_engine, seeding_strategy=seeding_strategy,
+             seed_budget=seed_budget, filter_tracts_to_gtv=filter_tracts_to_gtv,
+             compressed_tract_cache=compressed_tract_cache)
+
+## Report profile of the run
+if profiling:
+    print("Profile summary:")
+    report_profile()
 
+emit("run_end")
 print("Program successfully completed.")
@@ -0,0 +1,170 @@
+# Run the tractography pipeline (non-interactive) over a cohort of cases, several cases at once
+# Usage: python PrimitiveTractography_Batch.py <root folder or manifest> [--processes 4] [--cores 16] [--memory-gb 64]
+# Root folder: every folder in it holding a case (Combined or NIfTI folder) is run
+# Manifest: text file with one case per line, a base directory or a case name (looked up like get_base_dir does)
+# Output of each case goes to a log, and a summary of timings and failures of each case is saved as JSON and CSV
+# Stages of the cases running at once share a budget of cores and memory (see Scheduler_Utils), unless --no-scheduler
+
+# Import necessary functions
+from Subscripts.Batch_Utils import find_cases, read_manifest, start_worker, make_pool_context, run_case
+from Subscripts.Batch_Utils import save_summary, print_summary
+from Subscripts.Tracking_Engines import tracking_engines
+from Subscripts.Seeding_Utils import seeding_strategies
+from Subscripts.Scheduler_Utils import ResourceBroker, default_budget, set_worker_threads
+
+# Import packages
+import sys
+import datetime
+import argparse
+from pathlib import Path
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
+
+# Pipeline settings used for every case (see PrimitiveTractography.py). Cases are never shown, so
+# only streamlines through the GTV are kept unless QA snapshots are saved
+pipeline_settings = {
+    "qa_snapshots": False,
+    "registration_mode": "full",
+    "crop_to_brain": True,
+    "brain_mask_mode": "all",
+    "dwi_memmap": False,
+    "tracking_engine": "eudx",
+    "seeding_strategy": "uniform",
+    "seed_budget": None,
+    "filter_tracts_to_gtv": True,
+    "compressed_tract_cache": False,
+}
+
+# Only run when executed directly (workers import this file on Windows)
+if __name__ == "__main__":
+
+    # Settings
+    parser = argparse.ArgumentParser(description="Run Primitive Tractography over a cohort of cases.")
+    parser.add_argument("cases", type=Path, help="Root folder of cases, or manifest file (one case per line)")
+    parser.add_argument("--processes", type=int, default=None,
+                        help="Cases run at once (default: a quarter of the cores, or 1 without the scheduler)")
+    parser.add_argument("--cores", type=int, default=None, help="Cores stages may use at once (default: all)")
+    parser.add_argument("--memory-gb", type=float, default=None,
+                        help="Memory (GB) stages may use at once (default: most of the available memory)")
+    parser.add_argument("--no-scheduler", action="store_true", help="Don't schedule stages (each case uses every core)")
+    parser.add_argument("--output", type=Path, default=None,
+                        help="Folder for logs and summary (default: Batch_<time> next to the cases)")
+    parser.add_argument("--patients-dir", type=Path, default=None, help="Folder case names of a manifest are in")
+    parser.add_argument("--engine", default=pipeline_settings["tracking_engine"], choices=list(tracking_engines))
+    parser.add_argument("--seeding", default=pipeline_settings["seeding_strategy"], choices=seeding_strategies)
+    parser.add_argument("--qa-snapshots", action="store_true", help="Save QA snapshots of each case")
+    parser.add_argument("--cases-per-worker", type=int, default=10,
+                        help="Cases a worker runs before it is replaced by a fresh one, releasing memory it kept "
+                             "(Python 3.11 or newer, 0 to keep workers)")
+    args = parser.parse_args()
+
+    settings = dict(pipeline_settings, tracking_engine=args.engine, seeding_strategy=args.seeding,
+                    qa_snapshots=args.qa_snapshots or pipeline_settings["qa_snapshots"])
+
+    # Cases
+    if args.cases.is_dir():
+        cases = find_cases(args.cases)
+        source_dir = args.cases
+    else:
+        cases = read_manifest(args.cases, patients_root=args.patients_dir)
+        source_dir = args.cases.parent
+    if not cases:
+        sys.exit(f"No cases found in {args.cases}.")
+
+    # Budget of cores and memory. Thread pools of workers are sized before they start (they inherit it)
+    cores, memory_gb = default_budget()
+    cores = args.cores or cores
+    memory_gb = args.memory_gb or memory_gb
+    scheduler = not args.no_scheduler
+    processes = min(args.processes or (max(1, cores // 4) if scheduler else 1), len(cases))
+    context = make_pool_context()
+    broker = ResourceBroker(context, cores, memory_gb) if scheduler else None
+    if scheduler:
+        blas_threads, itk_threads = set_worker_threads(cores)
+        memory = f"{memory_gb:.0f} GB" if memory_gb is not None else "no memory limit"
+        print(f"Scheduling stages on {cores} cores and {memory} ({blas_threads} BLAS and {itk_threads} ITK threads "
+              f"per worker at most).")
+
+    started = datetime.datetime.now()
+    output_dir = args.output or source_dir / f"Batch_{started:%Y%m%d_%H%M%S}"
+    output_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    info = {"started": started.isoformat(), "source": str(args.cases), "processes": processes,
+            "scheduler": {"cores": cores, "memory_gb": memory_gb} if scheduler else None, "settings": settings}
+    print(f"Running {len(cases)} cases, {processes} at once. Logs and summary in {output_dir}")
+
+    # Cases which couldn't be found are failed without running
+    results = [{"case": case["case"], "base_dir": None, "status": "failed", "error": case["error"], "seconds": None}
+               for case in cases if case.get("error")]
+    runnable = [case for case in cases if not case.get("error")]
+
+    # Workers are replaced after some cases (max_tasks_per_child needs Python 3.11 with a forkserver or spawn context)
+    pool_options = {}
+    if args.cases_per_worker and sys.version_info >= (3, 11):
+        pool_options["max_tasks_per_child"] = args.cases_per_worker
+
+    # Run cases in a pool of workers which import the pipeline once
+    # A worker dying (killed, out of memory...) breaks the whole pool, and the cases running next to it die with it.
+    # The pool is then made again for the cases not started yet. The cases which were running are run again at the
+    # end, one at a time, so the one that kills its worker fails on its own
+    pending = [(i, case, output_dir / "Logs" / f"{i:03d}_{case['case']}.log") for i, case in enumerate(runnable, start=1)]
+    suspects = [] # cases running when the pool broke
+    isolated = False # True once suspects are run one at a time
+    done = 0
+    while pending or suspects:
+        if not pending:
+            print(f"[{datetime.datetime.now()}] Running {len(suspects)} case(s) stopped by a dying worker again, one at a time...")
+            pending, suspects, isolated = suspects, [], True
+        workers = 1 if isolated else min(processes, len(pending))
+        with ProcessPoolExecutor(max_workers=workers, mp_context=context, initializer=start_worker,
+                                 initargs=(broker,), **pool_options) as pool:
+            futures = {}
+            for i, case, log_path in pending:
+                log_path.unlink(missing_ok=True) # log shows the case started (see below)
+                futures[pool.submit(run_case, case, settings, log_path)] = (i, case, log_path)
+            pending = []
+            ran = False # whether any case got to a worker. If not, workers can't start at all (imports failing...)
+            for future in as_completed(futures):
+                i, case, log_path = futures[future]
+                try:
+                    result = future.result()
+                except BrokenProcessPool:
+                    if not log_path.is_file():
+                        pending.append((i, case, log_path)) # Never started. Run it in the next pool
+                        continue
+                    ran = True
+                    if not isolated:
+                        print(f"[{datetime.datetime.now()}] {case['case']} stopped when a worker died. Will run it again.")
+                        suspects.append((i, case, log_path))
+                        continue
+                    result = {"case": case["case"], "base_dir": str(case["base_dir"]), "status": "failed",
+                              "error": "Worker died running the case (killed, out of memory...)", "seconds": None,
+                              "log": str(log_path)}
+                except Exception as e: # case couldn't be sent to or returned from its worker
+                    result = {"case": case["case"], "base_dir": str(case["base_dir"]), "status": "failed",
+                              "error": f"Worker stopped: {type(e).__name__}: {e}", "seconds": None, "log": str(log_path)}
+                ran = True
+                results.append(result)
+                done += 1
+                status = "done" if result["status"] == "ok" else f"FAILED ({result['error']})"
+                seconds = f" in {result['seconds']:.0f} s" if result.get("seconds") is not None else ""
+                print(f"[{datetime.datetime.now()}] [{done}/{len(runnable)}] {case['case']} {status}{seconds}")
+                save_summary(output_dir, results, info) # saved as cases finish, so a stopped batch keeps its results
+        if (pending or suspects) and not ran:
+            # Workers died before running anything. A new pool would do the same
+            print(f"[{datetime.datetime.now()}] [ERROR] Workers could not start. Failing the remaining cases.")
+            for i, case, log_path in pending + suspects:
+                results.append({"case": case["case"], "base_dir": str(case["base_dir"]), "status": "failed",
+                                "error": "Workers could not start", "seconds": None, "log": None})
+            save_summary(output_dir, results, info)
+            break
+        if pending:
+            print(f"[{datetime.datetime.now()}] Worker pool broke. Starting a new one for {len(pending)} case(s)...")
+        pending.sort(key=lambda entry: entry[0])
+        suspects.sort(key=lambda entry: entry[0])
+
+    # Summary
+    info["seconds"] = round((datetime.datetime.now() - started).total_seconds(), 1)
+    save_summary(output_dir, results, info)
+    print_summary(results)
+    print(f"Summary saved to {output_dir / 'summary.json'} and {output_dir / 'summary.csv'}")
+    sys.exit(1 if any(result["status"] != "ok" for result in results) else 0)
@@ -24,6 +24,9 @@ if __name__ == "__main__":
     from Subscripts.Visualization_Utils import show_tracts, show_wmpl 
     from Subscripts.Preliminaries import get_base_dir, rs_get_info
     from Subscripts.RS_Utils import export_rs_stuff, check_rois, check_pl_map, check_ct_planning
+    from Subscripts.Transfer_Utils import TransferClient
+    from Subscripts.Progress_Utils import ProgressDisplay
+    from Subscripts.Dispatch_Utils import rank_servers, server_name
 
     # Check if we can import from connect (RayStation) if we can't then we aren't calling from RayStation
     try:
@@ -69,29 +72,27 @@ if __name__ == "__main__":
     else:
         client_id = str(uuid.uuid4())[:8] # unique short ID
 
-    # Define ports
-    server_ip = "10.244.196.191"
-    main_port = "5560"
-    heartbeat_port = "5561"
-    stream_port = "5562"
-    data_port = "5563"
+    # Define servers (IP and ports). The least loaded server is used and the others are tried if it goes away
+    # Ports left out use the defaults (5560 main, 5561 heartbeat, 5562 stream, 5563 data)
+    servers = [
+        {"ip": "10.244.196.191"},
+    ]
+    ready_timeout = 30 # seconds to wait for a server to accept the request before trying the next one
+    results_timeout = 10 # seconds to wait for the messages to show results once the server says FINISHED
 
-    #  Socket for work
-    print(f"\n[{datetime.datetime.now()}] Connecting to PrimitiveTractography server...")
-    main_socket = context.socket(zmq.DEALER)
-    main_socket.linger = 0 # doesn't wait for anything when closing
-    main_socket.connect(f"tcp://{server_ip}:{main_port}")
+    # Download results over the data port instead of reading them from the shared folder
+    transfer_artifacts = False
+    local_dir = Path.home() / "PrimitiveTractography" / case_name # Local copy of results
+    view_dir = local_dir if transfer_artifacts else base_dir # Folder results are shown/imported from
 
-    # Socket for receiving terminal outputs
-    stream_socket = context.socket(zmq.PULL)
-    stream_socket.connect(f"tcp://{server_ip}:{stream_port}")
-
-    # Socket for receiving data
-    data_socket = context.socket(zmq.DEALER)
-    data_socket.connect(f"tcp://{server_ip}:{data_port}")
+    # Folders to download (relative to base directory) before showing tracts and WMPL map
+    tracts_artifacts = ["Tracts", "RayStation/ROIs_NIfTI"]
+    wmpl_artifacts = ["WMPL", "RayStation/ROIs_NIfTI"]
 
     # Error flag
     err_flag = False
+    # Flag set when the server stops answering (next server is tried)
+    connection_lost = False
 
     # Define heartbeat class
     class HeartbeatManager:
@@ -158,11 +159,12 @@ if __name__ == "__main__":
                             global main_socket_active 
                             global stream_socket_active
                             global data_socket_active
-                            global err_flag
+                            global err_flag, connection_lost
                             main_socket_active = False # exit main socket loop
                             stream_socket_active = False # exit stream socket loop
                             data_socket_active = False # exit data socket loop
                             err_flag = True # Set error flag to true
+                            connection_lost = True # Try next server
 
                             return # exit daemon function
                         self._recreate_socket()
@@ -173,10 +175,6 @@ if __name__ == "__main__":
                     self._recreate_socket()
                     time.sleep(9) # Wait before retrying
 
-    # Initialize class and start
-    heartbeat = HeartbeatManager(context, server_ip, heartbeat_port, client_id)
-    heartbeat.start()
-
     # Define function to receive stream socket outputs
     def receive_stream():
         global stream_socket_active # access stream_socket_active flag
@@ -185,10 +183,17 @@ if __name__ == "__main__":
         while stream_socket_active:
             if dict(stream_poller.poll(timeout=3000)): # check for 3 seconds
                 # Receive terminal outputs until script is done
-                msg = stream_socket.recv_json()
+                topic, msg = stream_socket.recv_multipart()
+                if topic != client_id.encode('utf-8'):
+                    continue # Output of another client whose ID starts with ours
+                msg = json.loads(msg.decode('utf-8'))
                 if msg["type"] == "stdout":
-                    print(f"[{datetime.datetime.now()}] REMOTE:", msg["data"])
+                    progress_display.line(f"[{datetime.datetime.now()}] REMOTE: {msg['data']}")
+                elif msg["type"] == "event":
+                    progress_display.handle(msg["data"])
                 elif msg["type"] == "done":
+                    progress_display.record({"event": "done", "time": time.time(), "returncode": msg['returncode']})
+                    progress_display.close()
                     print(f"[{datetime.datetime.now()}] Script finished with code {msg['returncode']}")
                     if msg['returncode'] != 0:
                         err_flag = True # Set error flag to true
@@ -202,20 +207,9 @@ if __name__ == "__main__":
                     return # end function
             time.sleep(0.1) # Wait a bit to remove weird errors when shutting down
 
-    # Create poller for main socket
-    poller = zmq.Poller()
-    poller.register(main_socket, zmq.POLLIN)
-
-    # Create poller for stream socket
-    stream_poller = zmq.Poller()
-    stream_poller.register(stream_socket, zmq.POLLIN)
-
-    # Create poller for data socket
-    data_poller = zmq.Poller()
-    data_poller.register(data_socket, zmq.POLLIN)
-
     # Define function to receive data and plot Fury
     data_socket_active = False # Set to false until we confirm access to server
+    downloading = threading.Event() # set while data_dealer downloads results
     def data_dealer():
         global data_socket_active
         global base_dir
@@ -223,20 +217,42 @@ if __name__ == "__main__":
         # First send base directory
         base_dir_json = json.dumps(str(base_dir)).encode('utf-8')
         data_socket.send_multipart([b'', base_dir_json])
-        
+
+        # Messages received while downloading are kept here until the download is done
+        pending_msgs = []
+        transfer_client = TransferClient(data_socket, on_other_msg=lambda frames: pending_msgs.append(frames[0]))
+
+        # Download folders from server to local copy
+        def fetch_artifacts(folders):
+            downloading.set()
+            try:
+                for folder in folders:
+                    print(f"[{datetime.datetime.now()}] Downloading {folder}...")
+                    transfer_client.fetch_dir(f"{base_dir}/{folder}", local_dir / folder)
+            finally:
+                downloading.clear()
+            print(f"[{datetime.datetime.now()}] Download complete.")
+
         while data_socket_active:
-            if dict(data_poller.poll(timeout=3000)): # check for 3 seconds
-                _, ds_msg = data_socket.recv_multipart()  # receive message
+            if pending_msgs or dict(data_poller.poll(timeout=3000)): # check for 3 seconds
+                if pending_msgs:
+                    ds_msg = pending_msgs.pop(0)
+                else:
+                    _, ds_msg = data_socket.recv_multipart()  # receive message
                 ds_msg = ds_msg.decode('utf-8') # decode message
 
                 if ds_msg == "Show Fury - Tracts":
+                    if transfer_artifacts:
+                        fetch_artifacts(tracts_artifacts)
                     # Show tracts
-                    tracts_process = Process(target=show_tracts, args=(base_dir,))
+                    tracts_process = Process(target=show_tracts, args=(view_dir,))
                     tracts_process.start()
                     # Repeat loop for WMPL map
                 elif ds_msg == "Show Fury - WMPL":
+                    if transfer_artifacts:
+                        fetch_artifacts(wmpl_artifacts)
                     # Show WMPL map
-                    wmpl_process = Process(target=show_wmpl, args=(base_dir,))
+                    wmpl_process = Process(target=show_wmpl, args=(view_dir,))
                     wmpl_process.start()
                     data_socket_active = False # Set flag false
                     return # Function is finished
@@ -244,54 +260,146 @@ if __name__ == "__main__":
             time.sleep(0.1) # Wait a bit to remove weird errors when shutting down
         return # Exit function if data socket not active
 
-    try:
-        print(f"\n[{datetime.datetime.now()}] Sending request to server...")
-        main_socket.send_multipart([b'', b"READY"])
-        main_socket_active = True
-        while main_socket_active:
-            if dict(poller.poll(timeout=3000)): # Check for reply for 3 seconds
-                #  Get the reply.
-                _, message = main_socket.recv_multipart()
-                message = message.decode()
-                if message == "READY":
-                    print(f"\n[{datetime.datetime.now()}] Server available. Starting tractography...")
-                    main_socket.send_multipart([b'', b"RUN"])
-                    stream_socket_active = True
-                    data_socket_active = True
-                    threading.Thread(target=receive_stream, daemon=True).start() # start to receive from stream socket
-                    threading.Thread(target=data_dealer, daemon=False).start() # start to send/receive data
-                    while main_socket_active:
-                        if dict(poller.poll(timeout=1000)): # Check for reply for 1 second
-                            _, message = main_socket.recv_multipart()
-                            message = message.decode()
-                            if message == "FINISHED":
-                                time.sleep(0.1) # Wait for "script ended with code 0"
-                                print(f"[{datetime.datetime.now()}] Tractography and white matter path length map succesfully completed!")
-                                break
-                            elif message == "ERROR":
-                                print(f"[{datetime.datetime.now()}] [ERROR] Error during tractography.")
-                                err_flag = True # Set error flag to true
-                                break
-                            else:
-                                print(f"[{datetime.datetime.now()}] Unexpected returned message while performing tractography: {message}.")
-                                err_flag = True # Set error flag to true
-                                break
-                else:
-                    print(f"[{datetime.datetime.now()}] Unexpected returned message prior to commencing tractography: {message}")
+    # Order servers by load (queue depth and free cores, asked over the heartbeat channel)
+    print(f"\n[{datetime.datetime.now()}] Checking load of PrimitiveTractography servers...")
+    ranked_servers = rank_servers(context, servers, client_id)
+    if not ranked_servers:
+        print(f"[{datetime.datetime.now()}] [ERROR] No PrimitiveTractography server available.")
+        err_flag = True # Set error flag to true
+
+    for server in ranked_servers:
+        # Reset flags for this server
+        err_flag = False
+        connection_lost = False
+
+        # Live progress display. Also keeps a JSONL trace of the run's events in the case folder (one per server tried)
+        progress_display = ProgressDisplay(trace_dir=base_dir / "Logs")
+
+        #  Socket for work
+        print(f"\n[{datetime.datetime.now()}] Connecting to PrimitiveTractography server {server_name(server)}...")
+        main_socket = context.socket(zmq.DEALER)
+        main_socket.linger = 0 # doesn't wait for anything when closing
+        main_socket.setsockopt(zmq.IDENTITY, client_id.encode('utf-8')) # same ID as heartbeats so server can tie job to them
+        main_socket.connect(f"tcp://{server['ip']}:{server['main_port']}")
+
+        # Socket for receiving terminal outputs (only the ones of our job, sent with our ID as topic)
+        stream_socket = context.socket(zmq.SUB)
+        stream_socket.linger = 0 # doesn't wait for anything when closing
+        stream_socket.setsockopt(zmq.SUBSCRIBE, client_id.encode('utf-8'))
+        stream_socket.connect(f"tcp://{server['ip']}:{server['stream_port']}")
+
+        # Socket for receiving data
+        data_socket = context.socket(zmq.DEALER)
+        data_socket.linger = 0 # doesn't wait for anything when closing
+        data_socket.setsockopt(zmq.IDENTITY, client_id.encode('utf-8')) # server only lets the client that ran a case download it
+        data_socket.connect(f"tcp://{server['ip']}:{server['data_port']}")
+
+        # Initialize class and start
+        heartbeat = HeartbeatManager(context, server['ip'], server['heartbeat_port'], client_id)
+        heartbeat.start()
+
+        # Create poller for main socket
+        poller = zmq.Poller()
+        poller.register(main_socket, zmq.POLLIN)
+
+        # Create poller for stream socket
+        stream_poller = zmq.Poller()
+        stream_poller.register(stream_socket, zmq.POLLIN)
+
+        # Create poller for data socket
+        data_poller = zmq.Poller()
+        data_poller.register(data_socket, zmq.POLLIN)
+
+        stream_thread = data_thread = None # started once the server accepts the request
+        try:
+            print(f"\n[{datetime.datetime.now()}] Sending request to server...")
+            main_socket.send_multipart([b'', b"READY"])
+            main_socket_active = True
+            ready_deadline = time.time() + ready_timeout
+            run_started = False
+            while main_socket_active:
+                if not run_started and time.time() > ready_deadline:
+                    # Server not answering. Try next one
+                    print(f"[{datetime.datetime.now()}] No reply from server {server_name(server)}.")
                     err_flag = True # Set error flag to true
+                    connection_lost = True
                     break
-    except Exception as e:
-            print(f"[{datetime.datetime.now()}] Error: {e}")
-            err_flag = True # Set error flag to true
-    finally:
-        # Close sockets and terminate context
-        time.sleep(3) # Wait a bit for threads to stop polling
-
-        main_socket.close()
-        stream_socket.close()
-        data_socket.close()
-        heartbeat.stop() # Calls stop method in HeartbeatManager class
-        context.term()
+                if dict(poller.poll(timeout=3000)): # Check for reply for 3 seconds
+                    #  Get the reply.
+                    _, message = main_socket.recv_multipart()
+                    message = message.decode()
+                    if message == "READY":
+                        print(f"\n[{datetime.datetime.now()}] Server available. Starting tractography...")
+                        run_started = True
+                        main_socket.send_multipart([b'', b"RUN", json.dumps(str(base_dir)).encode('utf-8')])
+                        stream_socket_active = True
+                        data_socket_active = True
+                        stream_thread = threading.Thread(target=receive_stream, daemon=True) # start to receive from stream socket
+                        stream_thread.start()
+                        data_thread = threading.Thread(target=data_dealer, daemon=False) # start to send/receive data
+                        data_thread.start()
+                        while main_socket_active:
+                            if dict(poller.poll(timeout=1000)): # Check for reply for 1 second
+                                _, message = main_socket.recv_multipart()
+                                message = message.decode()
+                                if message == "FINISHED":
+                                    time.sleep(0.1) # Wait for "script ended with code 0"
+                                    print(f"[{datetime.datetime.now()}] Tractography and white matter path length map succesfully completed!")
+                                    break
+                                elif message == "QUEUED":
+                                    print(f"[{datetime.datetime.now()}] Server busy. Tractography queued...")
+                                elif message == "CANCELLED":
+                                    print(f"[{datetime.datetime.now()}] [ERROR] Tractography cancelled by server.")
+                                    err_flag = True # Set error flag to true
+                                    break
+                                elif message == "ERROR":
+                                    print(f"[{datetime.datetime.now()}] [ERROR] Error during tractography.")
+                                    err_flag = True # Set error flag to true
+                                    break
+                                else:
+                                    print(f"[{datetime.datetime.now()}] Unexpected returned message while performing tractography: {message}.")
+                                    err_flag = True # Set error flag to true
+                                    break
+                    else:
+                        print(f"[{datetime.datetime.now()}] Unexpected returned message prior to commencing tractography: {message}")
+                        err_flag = True # Set error flag to true
+                        break
+        except KeyboardInterrupt:
+                # Tell server to stop our job so it doesn't keep running for nothing
+                print(f"\n[{datetime.datetime.now()}] Stopped by user. Cancelling tractography...")
+                main_socket.send_multipart([b'', b"CANCEL"])
+                err_flag = True # Set error flag to true
+                main_socket_active = stream_socket_active = data_socket_active = False # exit loops
+        except Exception as e:
+                print(f"[{datetime.datetime.now()}] Error: {e}")
+                err_flag = True # Set error flag to true
+        finally:
+            # Stop the threads using the stream and data sockets before closing them (ZMQ sockets aren't thread safe)
+            if data_thread is not None:
+                if not err_flag:
+                    # Messages to show results can come after FINISHED (cached cases), and downloads take a while
+                    data_thread.join(timeout=results_timeout)
+                    while data_thread.is_alive() and downloading.is_set():
+                        data_thread.join(timeout=1)
+                data_socket_active = False # Stop waiting for messages
+                data_thread.join() # Returns within a poll, or once a download in progress is done
+            if stream_thread is not None:
+                stream_socket_active = False
+                stream_thread.join()
+
+            # Close sockets
+            main_socket.close()
+            stream_socket.close()
+            data_socket.close()
+            heartbeat.stop() # Calls stop method in HeartbeatManager class
+            progress_display.close() # Close trace of this server's run (if the stream didn't finish)
+
+        if not connection_lost:
+            break # Done with this server (successfully or not)
+        print(f"\n[{datetime.datetime.now()}] Lost server {server_name(server)}. Trying next server (if any)...")
+
+    # Terminate context
+    context.term()
 
     if rs_flag and not err_flag:
 
@@ -309,7 +417,7 @@ if __name__ == "__main__":
             print(f"[{datetime.datetime.now()}] Importing WMPL as examination...")
 
             # If running from RayStation, import WMPL
-            wmpl_dir_dcm = base_dir / "WMPL/DICOM" # Path to WMPL DICOM
+            wmpl_dir_dcm = view_dir / "WMPL/DICOM" # Path to WMPL DICOM
 
             # Extract info from files with pydicom
             files, _ = rs_get_info(wmpl_dir_dcm)
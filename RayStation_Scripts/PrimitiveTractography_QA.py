@@ -0,0 +1,43 @@
+# Save QA images (axial, coronal and sagittal views of tracts and WMPL map) for processed cases without a display
+
+# Import necessary functions
+from Subscripts.Visualization_Utils import offscreen_window, save_snapshots, snapshot_views, snapshot_size, snapshot_budget
+
+# Import packages
+import argparse
+import sys
+from pathlib import Path
+
+# Only run when executed directly (views are rendered in spawned processes, which import this file)
+if __name__ == "__main__":
+
+    # Settings
+    parser = argparse.ArgumentParser(description="Render QA snapshots of processed tractography cases.")
+    parser.add_argument("base_dirs", nargs="+", type=Path, help="Base directories of cases")
+    parser.add_argument("--kinds", nargs="+", default=["tracts", "wmpl"], choices=["tracts", "wmpl"])
+    parser.add_argument("--views", nargs="+", default=list(snapshot_views), choices=list(snapshot_views))
+    parser.add_argument("--size", nargs=2, type=int, default=list(snapshot_size), help="Width and height (pixels)")
+    parser.add_argument("--budget", type=int, default=snapshot_budget, help="White matter streamlines drawn")
+    parser.add_argument("--processes", type=int, default=None, help="Views rendered at once (default: one per view)")
+    args = parser.parse_args()
+
+    # Check VTK can render without a display before building any scene (otherwise it aborts mid render)
+    window_name = offscreen_window()
+    if window_name is None:
+        print("[ERROR] VTK can't open an offscreen window here, so no QA snapshots can be rendered. "
+              "On machines without a display, install VTK with OSMesa or EGL support "
+              "(pip install --extra-index-url https://wheels.vtk.org vtk-osmesa) or run under a display (e.g. xvfb-run).")
+        sys.exit(1)
+    print(f"Rendering with {window_name}.")
+
+    failed = 0
+    for base_dir in args.base_dirs:
+        print(f"Saving QA snapshots of {base_dir}...")
+        try:
+            save_snapshots(base_dir, kinds=args.kinds, views=args.views, size=tuple(args.size),
+                           budget=args.budget, processes=args.processes)
+        except Exception as e:
+            print(f"[ERROR] Could not save QA snapshots of {base_dir}: {e}")
+            failed += 1
+
+    sys.exit(1 if failed else 0)
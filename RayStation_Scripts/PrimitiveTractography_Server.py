@@ -7,13 +7,91 @@ import zmq
 import threading
 import subprocess
 import sys
+import json
+import queue
+import os
+import argparse
+import uuid
+from pathlib import Path
 
-# Define port numbers
-main_port = "5560"
-heartbeat_port = "5561"
-stream_port = "5562"
-data_port = "5563"
-local_data_port = "5564"
+# Import necessary functions
+from Subscripts.Transfer_Utils import TransferServer, is_transfer_msg
+from Subscripts.Progress_Utils import parse_event
+from Subscripts.Cache_Utils import ResultCache
+from Subscripts.Job_Utils import Job, cleanup_partial_outputs, psutil
+from Subscripts.Preliminaries import patients_dir
+
+# Define port numbers (can be changed to run several servers on one machine)
+parser = argparse.ArgumentParser(description="Server for Primitive Tractography")
+parser.add_argument("--main-port", default="5560")
+parser.add_argument("--heartbeat-port", default="5561")
+parser.add_argument("--stream-port", default="5562")
+parser.add_argument("--data-port", default="5563")
+parser.add_argument("--local-data-port", default="5564")
+parser.add_argument("--max-jobs", type=int, default=1, help="jobs running at once")
+parser.add_argument("--cache-index", default=None,
+                    help="result cache index file (next to this script). Default: result_cache_<main port>.json")
+parser.add_argument("--case-root", default=str(patients_dir), help="folder holding case folders. Others are refused")
+args = parser.parse_args()
+main_port = args.main_port
+heartbeat_port = args.heartbeat_port
+stream_port = args.stream_port
+data_port = args.data_port
+local_data_port = args.local_data_port
+case_root = Path(args.case_root).resolve()
+
+# Tractography script to run
+script_path = "V:/Common/Staff Personal Folders/DanielH/RayStation_Scripts/Tractography/PrimitiveTractography.py"
+subscripts_path = str(Path(script_path).parent / "Subscripts") # pipeline the script runs (and everything it uses)
+
+# Index of completed cases. Repeat requests for an unchanged case are answered without running the script
+cache_max_gb = 200 # tracts, QA images and brain masks of least recently used cases are deleted past this size
+# One index per server (servers on the same machine would overwrite each other's index)
+cache_index = args.cache_index or f"result_cache_{main_port}.json"
+result_cache = ResultCache(Path(__file__).parent / cache_index, max_bytes=cache_max_gb * 2**30,
+                           code_paths=[script_path, subscripts_path])
+
+# What was done with each requested case (("cached", None) or ("spawned", job ID)), by (client ID, base directory)
+# Read by the data relay thread. A client can only download from a case folder it asked to run
+run_decisions = {}
+
+# Function to check that a base directory sent by a client is a case folder inside the case root
+def valid_case_dir(base_dir):
+    try:
+        path = Path(base_dir).resolve()
+    except (OSError, ValueError): # e.g. embedded null byte
+        return False
+    return path != case_root and path.is_relative_to(case_root)
+
+# Jobs. Only the main thread starts jobs and uses the main socket
+max_running_jobs = args.max_jobs # jobs running at once. Others wait in the queue
+job_queue = [] # (identity, base_dir) of jobs waiting for a free slot
+running_jobs = {} # job ID -> Job. Added by the main thread, removed by the job's stream thread when it ends
+
+# Function to get the running jobs of a client (a snapshot, since stream threads remove jobs that end)
+def client_jobs(client_id):
+    return [job for job in list(running_jobs.values()) if job.client_id == client_id]
+
+# Function to check if a client has a job running or queued (clients run one case at a time)
+def client_busy(client_id):
+    return bool(client_jobs(client_id)) or any(queued[0].decode('utf-8', errors='replace') == client_id
+                                                for queued in job_queue)
+main_outbox = queue.Queue() # (identity, message) to send on main socket, from other threads
+disconnected_clients = queue.Queue() # client IDs whose heartbeat was lost, from heartbeat thread
+
+# Timeouts (seconds, None for no limit). A job is cancelled when its current stage or the whole job takes too long
+stage_timeouts = {
+    "dicom_to_nifti": 30 * 60,
+    "get_data": 30 * 60,
+    "get_wm_mask": 60 * 60,
+    "roi_interp": 30 * 60,
+    "csa_and_sc": 2 * 60 * 60,
+    "streamline_gen": 4 * 60 * 60,
+    "get_wmpl": 60 * 60
+}
+default_stage_timeout = 60 * 60 # for stages not listed above
+job_timeout = 8 * 60 * 60
+terminate_grace = 10 # seconds given to the script to exit before it is killed
 
 # Create context
 context = zmq.Context()
@@ -26,16 +104,24 @@ main_socket.bind(f"tcp://*:{main_port}")
 heartbeat_socket = context.socket(zmq.REP)
 heartbeat_socket.bind(f"tcp://*:{heartbeat_port}")
 
-# Streaming socket (for returning terminal outputs)
-stream_socket = context.socket(zmq.PUSH)
+# Streaming socket (for returning terminal outputs). Messages are sent with the client ID as topic, so each client
+# only gets the output of its own job
+stream_socket = context.socket(zmq.PUB)
 stream_socket.bind(f"tcp://*:{stream_port}")
+stream_lock = threading.Lock() # each job's thread (and the main thread) sends on it
+
+# Function to send a stream message to a client
+def send_stream(client_id, msg):
+    with stream_lock:
+        stream_socket.send_multipart([client_id.encode('utf-8'), json.dumps(msg).encode('utf-8')])
 
 # Data socket
 data_socket = context.socket(zmq.ROUTER)
+data_socket.setsockopt(zmq.ROUTER_HANDOVER, 1) # clients name their data socket with their ID. A reconnect takes the name over
 data_socket.bind(f"tcp://*:{data_port}")
 
-# Local data socket
-local_data_socket = context.socket(zmq.DEALER)
+# Local data socket. Scripts name their socket with their job ID, so each gets the base directory of its own job
+local_data_socket = context.socket(zmq.ROUTER)
 local_data_socket.bind(f"tcp://*:{local_data_port}")
 
 # Define main poller
@@ -55,6 +141,18 @@ data_poller.register(local_data_socket, zmq.POLLIN)
 last_heartbeat = {}
 heartbeat_timeout = 15 # seconds
 
+# Function to describe how busy the server is (sent to clients choosing between servers)
+if psutil is not None:
+    psutil.cpu_percent() # First call only starts the measurement
+def server_status():
+    cpu_count = os.cpu_count() or 1
+    if psutil is not None:
+        free_cores = round(cpu_count * (1 - psutil.cpu_percent() / 100), 1) # measured
+    else:
+        free_cores = max(cpu_count - len(running_jobs) * cpu_count // max_running_jobs, 0) # assume each job fills its share
+    return {"queue_depth": len(job_queue), "running": len(running_jobs), "max_jobs": max_running_jobs,
+            "cpu_count": cpu_count, "free_cores": free_cores}
+
 # define function to monitor heartbeats
 def monitor_heartbeats():
     global heartbeat_polling # Create flag to indicate when we are polling. Allows us to exit program safely with no errors
@@ -70,6 +168,9 @@ def monitor_heartbeats():
                     last_heartbeat[client_id] = time.time()
                     # print(f"[{datetime.datetime.now()}] [Heartbeat] Received from {client_id}.")
                     heartbeat_socket.send(b"PONG")
+                elif message.startswith("STATUS:"):
+                    # Client choosing a server. Reply with our load
+                    heartbeat_socket.send_json(server_status())
                 else:
                     heartbeat_socket.send(b"UNKNOWN")
 
@@ -81,6 +182,7 @@ def monitor_heartbeats():
                     to_remove.append(client_id)
             for client_id in to_remove:
                 del last_heartbeat[client_id]
+                disconnected_clients.put(client_id) # Main thread cancels the client's job
 
             time.sleep(0.1) # wait a bit... removes weird error messages
         except Exception as e:
@@ -95,88 +197,223 @@ heartbeat_thread.start()
 
 stream_polling = True # Set flag to true first so that it's defined
 # define function to relay terminal outputs from PrimitiveTractography
-def stream(identity):
+def stream(job):
     global stream_polling
+    proc = job.proc
     while stream_polling:
         for line in iter(proc.stdout.readline, ''):
-            stream_socket.send_json({"type": "stdout", "data": line.strip()})
+            event = parse_event(line.strip())
+            if event is not None:
+                job.on_event(event) # Keep track of stage for timeouts
+                send_stream(job.client_id, {"type": "event", "data": event}) # structured stage/progress/metrics event
+            else:
+                send_stream(job.client_id, {"type": "stdout", "data": line.strip()})
             if not stream_polling:
-                stream_socket.send_json({"type": "stdout", "data": "Connection lost!"}) # tell user connection lost
+                send_stream(job.client_id, {"type": "stdout", "data": "Connection lost!"}) # tell user connection lost
                 return # end daemon function
-        stream_socket.send_json({"type": "done", "returncode": proc.wait()})
+        returncode = proc.wait()
 
-        if proc.wait() == 0:
+        if job.cancel_reason is not None:
+            # Job was cancelled or timed out. Remove half-written outputs
+            removed = cleanup_partial_outputs(job.base_dir) if job.base_dir is not None else 0
+            print(f"\n[{datetime.datetime.now()}] Tractography cancelled ({job.cancel_reason}). Removed {removed} partial output(s).")
+            send_stream(job.client_id, {"type": "stdout", "data": f"Tractography cancelled: {job.cancel_reason}"})
+            send_stream(job.client_id, {"type": "done", "returncode": returncode})
+            main_outbox.put((job.identity, b"CANCELLED"))
+        elif returncode == 0:
+            send_stream(job.client_id, {"type": "done", "returncode": returncode})
             print("\nTractography completed succesfully.")
-            main_socket.send_multipart([identity, b'', b"FINISHED"])
-            return # end of function
+            if job.base_dir is not None:
+                result_cache.record(job.base_dir) # Remember case so repeat requests return straight away
+            main_outbox.put((job.identity, b"FINISHED"))
         else:
+            send_stream(job.client_id, {"type": "done", "returncode": returncode})
             print("\nError in tractography script.")
-            main_socket.send_multipart([identity, b'', b"ERROR"])
-            return # end of function
+            main_outbox.put((job.identity, b"ERROR"))
+        running_jobs.pop(job.job_id, None) # Free slot for queued jobs
+        return # end of function
         
     return # exit function if not stream polling
 
+# Function to start the tractography script for a client
+def start_job(identity, base_dir):
+    global stream_polling
+    job_id = uuid.uuid4().hex # names the script's data socket
+    # Start tractography script
+    # Call tractography script with python venv
+    proc = subprocess.Popen(
+        [sys.executable, "-u", script_path, local_data_port, job_id], # script connects back on our local data port
+        stdout=subprocess.PIPE, 
+        stderr=subprocess.STDOUT,
+        text=True,
+        bufsize=1)
+    job = Job(identity, base_dir, proc, job_id)
+    running_jobs[job_id] = job
+    
+    stream_polling = True # Set flag to true first
+    if base_dir is not None:
+        run_decisions[(job.client_id, base_dir)] = ("spawned", job_id) # Data relay can now pass the base directory to the script
+
+    threading.Thread(target=stream, args=(job,), daemon=True).start() # start streaming terminal output thread
+
+# Function to cancel a client's job (running or queued)
+def cancel_client_jobs(client_id, reason):
+    for queued in [queued for queued in job_queue if queued[0].decode('utf-8', errors='replace') == client_id]:
+        job_queue.remove(queued)
+        print(f"[{datetime.datetime.now()}] [Jobs] Removed queued job of {client_id}: {reason}")
+    for job in client_jobs(client_id):
+        job.cancel(reason, grace=terminate_grace)
+
 data_polling = True # Set flag to true first so that it's defined
+# Seconds a base directory sent on the data port waits for the main thread to decide what to do with its case
+# (kept for as long as its job is queued). Base directories of refused cases, or never run, are dropped after that
+pending_timeout = 5 * 60
+
+# Function to read the base directory a client sent on the data port. None if the message isn't one
+def parse_base_dir(frames):
+    try:
+        base_dir = json.loads(frames[0].decode('utf-8'))
+    except (IndexError, UnicodeDecodeError, ValueError):
+        return None
+    return base_dir if isinstance(base_dir, str) else None
+
 # Define function to relay data from PrimitiveTractography and relay back when the Fury window is closed
+# Also serves chunked file transfers (tracts, masks, WMPL) to clients on the same data port
 def data_relay():
     global data_polling # Create flag to indicate when we are polling. Allows us to exit program safely with no errors
+    transfer_server = TransferServer(data_socket, case_root) # Only used from this thread (ZMQ sockets aren't thread safe)
+    pending_base_dirs = [] # (identity, base directory, time received) before the main thread decided what to do with the case
+    job_clients = {} # job ID -> data socket identity of the client the script's messages go to
+    job_base_dirs = {} # job ID -> base directory to send once the script has connected
+    ready_jobs = set() # job IDs of scripts which connected (ROUTER drops messages to scripts not connected yet)
     while data_polling:
-        if dict(data_poller.poll(timeout=3000)): # check for 3 seconds
-            # Receive base directory from client
-            ds_identity, _, base_dir = data_socket.recv_multipart()
-            # Send base directory to server
-            local_data_socket.send_multipart([ds_identity, b'', base_dir])
-            break # continue to poll for Fury data now
-        time.sleep(0.1) # wait a bit... removes weird error messages
-
-    cnt = 0 # Set counter to exit after 2
-    while data_polling:
-        if dict(data_poller.poll(timeout=3000)): # check for 3 seconds
-            ds_identity, _, ds_msg = local_data_socket.recv_multipart() # receive data from PrimitiveTractography
+        # Don't wait if there are chunks left to send
+        socks = dict(data_poller.poll(timeout=0 if transfer_server.busy() else 100))
+
+        if data_socket in socks:
+            ds_identity, _, *frames = data_socket.recv_multipart()
+            if is_transfer_msg(frames):
+                # Request for a file transfer
+                transfer_server.handle(ds_identity, frames)
+            else:
+                # Receive base directory from client. Anything else is dropped (it would stop this thread)
+                base_dir = parse_base_dir(frames)
+                if base_dir is None:
+                    print(f"[{datetime.datetime.now()}] [Data] Dropped message which isn't a base directory.")
+                else:
+                    pending_base_dirs.append((ds_identity, base_dir, time.time()))
 
-            # Send data to client
-            data_socket.send_multipart([ds_identity, b'', ds_msg])
+        # Hand base directories over once we know whether the script was started for the case
+        # (data socket identity is the client ID, the same as on the main socket)
+        for pending in list(pending_base_dirs):
+            ds_identity, base_dir, received = pending
+            key = (ds_identity.decode('utf-8', errors='replace'), base_dir)
+            decision, job_id = run_decisions.pop(key, (None, None))
+            if decision is not None:
+                transfer_server.add_root(ds_identity, base_dir) # Allow client to download from its case folder
+            if decision == "spawned":
+                # Base directory goes to the script of the job once it has connected
+                job_clients[job_id] = ds_identity
+                job_base_dirs[job_id] = json.dumps(base_dir).encode('utf-8')
+                pending_base_dirs.remove(pending)
+            elif decision == "cached":
+                # Results already exist. Tell client to show them
+                data_socket.send_multipart([ds_identity, b'', b'Show Fury - Tracts'])
+                data_socket.send_multipart([ds_identity, b'', b'Show Fury - WMPL'])
+                pending_base_dirs.remove(pending)
+            elif time.time() - received > pending_timeout and \
+                not any(queued == (ds_identity, base_dir) for queued in list(job_queue)):
+                # Case refused or never run
+                pending_base_dirs.remove(pending)
 
-            cnt += 1 # add to counter
+        if local_data_socket in socks:
+            job_id, _, _, ds_msg = local_data_socket.recv_multipart() # receive data from PrimitiveTractography
+            job_id = job_id.decode('utf-8', errors='replace')
+            ds_identity = job_clients.get(job_id)
+            if ds_msg == b"READY":
+                ready_jobs.add(job_id) # Script connected and waits for its base directory
+            elif ds_identity is not None:
+                # Send data to the client of the job
+                data_socket.send_multipart([ds_identity, b'', ds_msg])
 
-            if cnt >= 2:
-                return # exit function
+        # Send base directories to scripts which have connected
+        for job_id in [job_id for job_id in job_base_dirs if job_id in ready_jobs]:
+            local_data_socket.send_multipart([job_id.encode('utf-8'), job_clients[job_id], b'', job_base_dirs.pop(job_id)])
+            ready_jobs.discard(job_id)
 
-        time.sleep(0.1) # wait a bit... removes weird error messages
+        # Send chunks to clients which have credit
+        transfer_server.pump()
+
+    transfer_server.close()
     return # exit function if not data polling
 
+# Start data relay thread (runs for as long as the server does)
+data_relay_thread = threading.Thread(target=data_relay, daemon=True)
+data_relay_thread.start()
+
 try:
     print("\nWaiting for client message...")
     while True: #  Wait for next request from client
-        socks = dict(main_poller.poll(timeout=3000)) # Check for 3 seconds
+        socks = dict(main_poller.poll(timeout=100)) # Check for 100 ms (other threads' messages are sent below)
         if main_socket in socks:
             # Receive message from client
-            identity, _, message = main_socket.recv_multipart()
-            message = message.decode()
+            frames = main_socket.recv_multipart()
+            identity, message, payload = frames[0], frames[2] if len(frames) > 2 else b'', frames[3:]
+            message = message.decode('utf-8', errors='replace')
+            # Base directory of the case is sent along with RUN (None if missing or malformed)
+            base_dir = parse_base_dir(payload)
             if message == "READY":
                 # Let client know server is ready
                 main_socket.send_multipart([identity, b'', b"READY"])
+            elif message == "RUN" and base_dir is None:
+                # The script would wait for a base directory forever
+                print(f"[{datetime.datetime.now()}] Refused run request without a valid base directory.")
+                main_socket.send_multipart([identity, b'', b"ERROR"])
+            elif message == "RUN" and not valid_case_dir(base_dir):
+                # Only case folders can be processed (and downloaded from)
+                print(f"[{datetime.datetime.now()}] Refused case {base_dir}: not inside {case_root}.")
+                main_socket.send_multipart([identity, b'', b"ERROR"])
+            elif message == "RUN" and client_busy(identity.decode('utf-8', errors='replace')):
+                # Its output, downloads and cancellation are tied to the client, so a second job can't run alongside
+                print(f"[{datetime.datetime.now()}] Refused case {base_dir}: client already has a job running or queued.")
+                main_socket.send_multipart([identity, b'', b"ERROR"])
+            elif message == "RUN" and result_cache.lookup(base_dir):
+                # Case already processed and unchanged. Answer straight away
+                print(f"[{datetime.datetime.now()}] Case {base_dir} already processed. Returning cached results.")
+                run_decisions[(identity.decode('utf-8', errors='replace'), base_dir)] = ("cached", None)
+                send_stream(identity.decode('utf-8', errors='replace'),
+                            {"type": "stdout", "data": "Case already processed. Using saved results."})
+                send_stream(identity.decode('utf-8', errors='replace'), {"type": "done", "returncode": 0})
+                main_socket.send_multipart([identity, b'', b"FINISHED"])
             elif message == "RUN":
-
-                # Start tractography script
-                path = "V:/Common/Staff Personal Folders/DanielH/RayStation_Scripts/Tractography/PrimitiveTractography.py"
-                # Call tractography script with python venv
-                proc = subprocess.Popen(
-                    [sys.executable, "-u", path],
-                    stdout=subprocess.PIPE, 
-                    stderr=subprocess.STDOUT,
-                    text=True,
-                    bufsize=1)
-                
-                stream_polling = True # Set flag to true first
-                
-                data_polling = True # Set flag to true first 
-
-                threading.Thread(target=data_relay, daemon=True).start() # start data relay thread
-
-                threading.Thread(target=stream, args=(identity,), daemon=True).start() # start streaming terminal output thread
+                # Queue job. It starts below as soon as there is a free slot
+                job_queue.append((identity, base_dir))
+                if len(running_jobs) >= max_running_jobs:
+                    main_socket.send_multipart([identity, b'', b"QUEUED"])
+            elif message == "CANCEL":
+                # Client aborted
+                cancel_client_jobs(identity.decode('utf-8', errors='replace'), "cancelled by client")
             else:
                 print(f"Unexpected message received from client")
+
+        # Cancel jobs of clients which stopped sending heartbeats
+        while not disconnected_clients.empty():
+            cancel_client_jobs(disconnected_clients.get(), "client disconnected")
+
+        # Cancel jobs which ran for too long
+        for job in list(running_jobs.values()):
+            reason = job.check_timeouts(stage_timeouts, default_stage_timeout, job_timeout)
+            if reason is not None:
+                job.cancel(reason, grace=terminate_grace)
+
+        # Start queued jobs if there is a free slot
+        while job_queue and len(running_jobs) < max_running_jobs:
+            start_job(*job_queue.pop(0))
+
+        # Send messages from other threads
+        while not main_outbox.empty():
+            identity, message = main_outbox.get()
+            main_socket.send_multipart([identity, b'', message])
 except KeyboardInterrupt:
     print("\nShutting down server from user (KeyboardInterrupt).")
     while heartbeat_polling or data_polling or stream_polling:
@@ -0,0 +1,170 @@
+# Functions for running the pipeline over a cohort of cases (see PrimitiveTractography_Batch.py)
+# Cases run in a pool of worker processes. Each worker imports the pipeline once and runs case after case
+
+## Import necessary packages
+import os
+import gc
+import sys
+import csv
+import json
+import time
+import datetime
+import traceback
+import multiprocessing
+from pathlib import Path
+from contextlib import contextmanager
+
+# Import necessary functions
+from Subscripts.Job_Utils import partial_prefix, atomic_path
+from Subscripts.Progress_Utils import parse_event
+from Subscripts.Preliminaries import get_base_dir
+from Subscripts.Scheduler_Utils import init_worker, scheduled
+
+# Modules imported by every worker before its first case (DiPy, nibabel, ANTs etc. come with them)
+warm_modules = ["Subscripts.Pipeline"]
+
+# Function to check if a folder looks like a case (raw DICOM files or converted NIfTI files in it)
+def is_case_dir(path):
+    return path.is_dir() and ((path / "Combined").is_dir() or (path / "NIfTI").is_dir())
+
+# Function to find the cases in a root folder (every folder in it holding a case)
+def find_cases(root):
+    root = Path(root)
+    return [{"case": path.name, "base_dir": path} for path in sorted(root.iterdir())
+            if not path.name.startswith((".", partial_prefix)) and is_case_dir(path)]
+
+# Function to read the cases of a manifest: one per line, a base directory (relative to the manifest) or a case name
+# (looked up in patients_dir, see get_base_dir). Empty lines and lines starting with # are skipped
+# Cases which can't be found are kept with their error, so they show up as failed in the summary
+def read_manifest(manifest_path, patients_root=None):
+    manifest_path = Path(manifest_path)
+    cases = []
+    for line in manifest_path.read_text(encoding='utf-8').splitlines():
+        entry = line.strip()
+        if not entry or entry.startswith("#"):
+            continue
+        path = Path(entry) if Path(entry).is_absolute() else manifest_path.parent / entry
+        if path.is_dir():
+            cases.append({"case": path.name, "base_dir": path})
+            continue
+        try:
+            cases.append({"case": entry, "base_dir": get_base_dir(entry, root=patients_root)})
+        except ValueError as e:
+            cases.append({"case": entry, "base_dir": None, "error": str(e)})
+    return cases
+
+# Function to import the pipeline in a worker before its first case
+def warm_imports():
+    for module in warm_modules:
+        __import__(module)
+
+# Function to start a worker: keep the broker its stages take cores and memory from (None to not schedule stages)
+# and import the pipeline
+def start_worker(broker=None):
+    init_worker(broker)
+    warm_imports()
+
+# Function to make the pool of worker processes
+# Where possible (not on Windows) workers are forked from a server which imported the pipeline already,
+# so imports are only done once for all workers. Otherwise each worker imports it when it starts
+def make_pool_context():
+    if "forkserver" in multiprocessing.get_all_start_methods():
+        context = multiprocessing.get_context("forkserver")
+        context.set_forkserver_preload(warm_modules)
+        return context
+    return multiprocessing.get_context("spawn")
+
+# Context manager sending everything written to stdout and stderr (also by C libraries and subprocesses) to a file
+@contextmanager
+def redirect_output(log_path):
+    log_path = Path(log_path)
+    log_path.parent.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    with open(log_path, "w", encoding='utf-8') as log:
+        sys.stdout.flush()
+        sys.stderr.flush()
+        saved = os.dup(1), os.dup(2)
+        os.dup2(log.fileno(), 1)
+        os.dup2(log.fileno(), 2)
+        try:
+            yield log_path
+        finally:
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os.dup2(saved[0], 1)
+            os.dup2(saved[1], 2)
+            os.close(saved[0])
+            os.close(saved[1])
+
+# Function to read stage durations, time waited for resources and peak memory back from the events in a case log
+def log_metrics(log_path):
+    stages = {}
+    waited = 0.0 # seconds stages waited for cores and memory (scheduled batches)
+    peak_rss = None
+    with open(log_path, encoding='utf-8', errors='replace') as log:
+        for line in log:
+            event = parse_event(line.rstrip("\n"))
+            if event is None:
+                continue
+            if event.get("rss_mb") is not None:
+                peak_rss = max(peak_rss or 0, event["rss_mb"])
+            if event["event"] == "stage_end":
+                stages[event["stage"]] = stages.get(event["stage"], 0) + event["duration"]
+            elif event["event"] == "stage_resources":
+                waited += event["waited"]
+    return stages, round(waited, 1), peak_rss
+
+# Function to run the pipeline on one case in a worker. Output goes to the log of the case
+# Never raises: failures are returned with their error, so one bad case doesn't stop the cohort
+def run_case(case, settings, log_path):
+    from Subscripts.Pipeline import run_pipeline # imported already (warm_imports)
+    from Subscripts.Volume_Utils import clear_volume_cache
+
+    result = {"case": case["case"], "base_dir": str(case["base_dir"]), "status": "ok", "error": None,
+              "log": str(log_path), "worker": os.getpid()}
+    start = time.perf_counter()
+    with redirect_output(log_path), scheduled(case["base_dir"]):
+        try:
+            result.update(run_pipeline(case["base_dir"], **settings))
+        except Exception as e:
+            traceback.print_exc()
+            result["status"] = "failed"
+            result["error"] = f"{type(e).__name__}: {e}"
+        finally:
+            clear_volume_cache() # release memory-mapped volumes of this case before the next one
+            gc.collect()
+    result["seconds"] = round(time.perf_counter() - start, 1)
+    result["stages"], result["waited"], result["peak_rss_mb"] = log_metrics(log_path)
+    return result
+
+# Function to save the summary of a batch as JSON and CSV (one row per case, one column per stage)
+def save_summary(output_dir, results, info):
+    output_dir = Path(output_dir)
+    stage_names = list(dict.fromkeys(name for result in results for name in result.get("stages", {})))
+    with atomic_path(output_dir / "summary.json") as tmp_path:
+        tmp_path.write_text(json.dumps({**info, "saved": datetime.datetime.now().isoformat(), "cases": results},
+                                       indent=2, default=str), encoding='utf-8')
+    columns = ["case", "status", "seconds", "waited", "peak_rss_mb", "tracts_reused", "streamlines_wm",
+               "streamlines_gtv", "error", "base_dir", "log"]
+    with atomic_path(output_dir / "summary.csv") as tmp_path:
+        with open(tmp_path, "w", newline="", encoding='utf-8') as file:
+            writer = csv.writer(file)
+            writer.writerow(columns + [f"{name}_s" for name in stage_names])
+            for result in results:
+                writer.writerow([result.get(column) for column in columns]
+                                + [result.get("stages", {}).get(name) for name in stage_names])
+
+# Function to print the summary of a batch
+def print_summary(results):
+    width = max([len(result["case"]) for result in results] + [4])
+    print(f"{'Case':<{width}}  {'Status':<7} {'Time (s)':>9}  Slowest stage / error")
+    for result in results:
+        stages = result.get("stages") or {}
+        if result["status"] == "ok":
+            slowest = max(stages, key=stages.get) if stages else ""
+            detail = f"{slowest} ({stages[slowest]:.0f} s)" if slowest else ""
+        else:
+            detail = result["error"]
+        seconds = f"{result['seconds']:.0f}" if result.get("seconds") is not None else "-"
+        print(f"{result['case']:<{width}}  {result['status']:<7} {seconds:>9}  {detail}")
+    failed = sum(result["status"] != "ok" for result in results)
+    print(f"{len(results) - failed} of {len(results)} cases completed, {failed} failed.")
@@ -0,0 +1,65 @@
+# Functions for making the brain mask of a diffusion series once and reusing it
+# median_otsu is run on a 3D mean volume, so the 4D data is never copied. Data is masked in place
+
+## Import necessary packages
+import hashlib
+import numpy as np
+from pathlib import Path
+from dipy.segment.mask import median_otsu
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+
+# Volumes the brain mask is made from
+# "all": mean of every diffusion volume (as before). "b0": mean of the b0 volumes only (faster, little contrast lost)
+brain_mask_modes = ["all", "b0"]
+
+# Function to define folder holding saved brain masks (next to NIfTI, which only holds inputs)
+def brain_mask_dir(nifti_dir):
+    return Path(nifti_dir).parent / "BrainMask"
+
+# Function to make the key of a diffusion series. Changes if the DWI or its b-values, or the mode, change
+def series_key(nifti_dir, fname, mode):
+    digest = hashlib.sha256()
+    for suffix in [".nii.gz", ".bval"]:
+        stat = (Path(nifti_dir) / (fname + suffix)).stat()
+        digest.update(f"{fname}{suffix}|{stat.st_size}|{stat.st_mtime_ns}\n".encode('utf-8'))
+    digest.update(f"{mode}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+# Function to make the brain mask and the b0 mean of a series
+def compute_brain_mask(data, gtab, mode="all"):
+    if mode not in brain_mask_modes:
+        raise ValueError(f"Unknown brain mask mode '{mode}'. Use one of {brain_mask_modes}.")
+
+    b0_mean = data[..., gtab.b0s_mask].mean(axis=3, dtype=np.float64).astype(np.float32)
+    if mode == "b0":
+        mean_volume = b0_mean
+    else: # Same volume median_otsu(data, vol_idx=range(data.shape[3])) averages, without copying the 4D data first
+        mean_volume = data.mean(axis=3, dtype=np.float64)
+    _, mask = median_otsu(mean_volume, numpass=1) # 3D input, so only the mean volume is filtered
+    return mask, b0_mean
+
+# Function to get the brain mask and b0 mean of a series. Computed once, then loaded from BrainMask
+def get_brain_mask(nifti_dir, fname, data, gtab, mode="all"):
+    key = series_key(nifti_dir, fname, mode)
+    mask_path = brain_mask_dir(nifti_dir) / f"{fname}_{mode}.npz"
+
+    if mask_path.is_file():
+        saved = np.load(mask_path)
+        if str(saved["key"]) == key and tuple(saved["shape"]) == data.shape[:3]:
+            print("[OK] Brain mask located and loaded.")
+            mask = np.unpackbits(saved["mask"], count=int(np.prod(data.shape[:3]))).reshape(data.shape[:3]).astype(bool)
+            return mask, saved["b0_mean"]
+
+    mask, b0_mean = compute_brain_mask(data, gtab, mode)
+    mask_path.parent.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    with atomic_path(mask_path) as tmp_path:
+        with open(tmp_path, "wb") as file: # file object so numpy doesn't change the name
+            np.savez_compressed(file, key=key, shape=np.array(mask.shape), mask=np.packbits(mask), b0_mean=b0_mean)
+    return mask, b0_mean
+
+# Function to zero voxels outside the mask, in place (no second 4D array)
+def apply_mask_in_place(data, mask):
+    data *= mask[..., None].astype(data.dtype)
+    return data
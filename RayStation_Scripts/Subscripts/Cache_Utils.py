@@ -0,0 +1,135 @@
+# Functions for the server-side index of completed cases
+
+## Import necessary packages
+import json
+import time
+import hashlib
+import shutil
+import threading
+from pathlib import Path
+
+# Import necessary functions
+from Subscripts.Volume_Utils import is_uncompressed_copy
+
+# Folders (relative to base directory) holding the inputs of a case. Derived folders (ROIs_NIfTI, BrainMask) are left out
+# NIfTI is made by dcm2niix, but counts as an input: the pipeline reads it and only converts again when it is invalid
+input_folders = ["Combined", "NIfTI", "RayStation/ROIs", "RayStation/MR_DICOM", "RayStation/CT_DICOM"]
+
+# Folders (relative to base directory) holding results of a case which can be made again by running it
+# Counted towards the size of the cache, and deleted when the case is evicted
+# WMPL (the clinical export, which RayStation imports) is never deleted
+regenerable_folders = ["Tracts", "QA", "BrainMask"]
+
+# Files which must exist for a case to count as completed
+required_outputs = ["Tracts/tractogram_EuDX.trk", "Tracts/tractogram_GTV_EuDX.trk", "WMPL/NIfTI/WMPL_map.nii.gz"]
+
+# Function to fingerprint the inputs of a case (and the code that processes them) from file sizes and modification times
+# code_paths are files or folders (every .py file in them counts)
+def fingerprint_case(base_dir, code_paths=()):
+    base_dir = Path(base_dir)
+    digest = hashlib.sha256()
+    for folder in input_folders:
+        folder_path = base_dir / folder
+        if not folder_path.is_dir():
+            continue
+        for file_path in sorted(folder_path.rglob("*")):
+            if file_path.is_file() and not is_uncompressed_copy(file_path): # copies made by load_volume aren't inputs
+                stat = file_path.stat()
+                digest.update(f"{file_path.relative_to(base_dir)}|{stat.st_size}|{stat.st_mtime_ns}\n".encode('utf-8'))
+    for code_path in code_paths: # Re-run cases if the pipeline changed
+        code_path = Path(code_path)
+        code_files = sorted(code_path.rglob("*.py")) if code_path.is_dir() else [code_path] if code_path.is_file() else []
+        for file_path in code_files:
+            stat = file_path.stat()
+            name = file_path.relative_to(code_path) if code_path.is_dir() else file_path.name
+            digest.update(f"{name}|{stat.st_size}|{stat.st_mtime_ns}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+# Function to check that the results of a case exist
+def outputs_exist(base_dir):
+    base_dir = Path(base_dir)
+    wmpl_dir_dcm = base_dir / "WMPL/DICOM"
+    return all((base_dir / output).is_file() for output in required_outputs) and wmpl_dir_dcm.is_dir() \
+        and any(wmpl_dir_dcm.glob("*.dcm"))
+
+# Function to get the size (bytes) of the regenerable results of a case
+def outputs_size(base_dir):
+    base_dir = Path(base_dir)
+    return sum(file_path.stat().st_size for folder in regenerable_folders if (base_dir / folder).is_dir()
+               for file_path in (base_dir / folder).rglob("*") if file_path.is_file())
+
+# Function to delete the regenerable results of a case. Returns bytes freed
+def delete_regenerable(base_dir):
+    base_dir = Path(base_dir)
+    freed = outputs_size(base_dir)
+    for folder in regenerable_folders:
+        if (base_dir / folder).is_dir():
+            shutil.rmtree(base_dir / folder, ignore_errors=True)
+    return freed
+
+# Class keeping an index (JSON file) of completed cases with their input fingerprints. Least recently used cases are
+# evicted when their regenerable results take more than max_bytes: those results are deleted (so they are run again
+# when asked for). The WMPL map and its DICOM series are kept: they are the clinical outputs, which RayStation imports
+class ResultCache:
+    def __init__(self, index_path, max_bytes, code_paths=()):
+        # Initialize by defining stuff
+        self.index_path = Path(index_path)
+        self.max_bytes = max_bytes
+        self.code_paths = code_paths
+        self.lock = threading.Lock()
+        self.index = {} # base directory -> {"fingerprint", "bytes", "last_used"}
+        if self.index_path.is_file():
+            try:
+                self.index = json.loads(self.index_path.read_text(encoding='utf-8'))
+            except (json.JSONDecodeError, OSError) as e:
+                print(f"[WARNING] Could not read result cache index {self.index_path}: {e}. Starting empty.")
+
+    def _save(self):
+        # Write index to a temporary file then swap it in, so the index is never half-written
+        tmp_path = self.index_path.with_name(self.index_path.name + ".tmp")
+        tmp_path.write_text(json.dumps(self.index, indent=2), encoding='utf-8')
+        tmp_path.replace(self.index_path)
+
+    def lookup(self, base_dir):
+        # Return True if case was completed before with the same inputs and its results are still there
+        key = str(base_dir)
+        with self.lock:
+            entry = self.index.get(key)
+            if entry is None:
+                return False
+            if not outputs_exist(base_dir) or entry["fingerprint"] != fingerprint_case(base_dir, self.code_paths):
+                del self.index[key] # Inputs changed or results removed. Forget case
+                self._save()
+                return False
+            entry["last_used"] = time.time()
+            self._save()
+            return True
+
+    def record(self, base_dir):
+        # Add a completed case to the index, then evict old cases if needed
+        key = str(base_dir)
+        with self.lock:
+            if not outputs_exist(base_dir):
+                print(f"[WARNING] Results missing for {base_dir}. Not adding case to result cache.")
+                return
+            self.index[key] = {
+                "fingerprint": fingerprint_case(base_dir, self.code_paths),
+                "bytes": outputs_size(base_dir),
+                "last_used": time.time()
+            }
+            self._evict(keep=key)
+            self._save()
+
+    def _evict(self, keep=None):
+        # Delete regenerable results of least recently used cases until we are within budget, and forget the cases
+        total = sum(entry["bytes"] for entry in self.index.values())
+        for key, entry in sorted(self.index.items(), key=lambda item: item[1]["last_used"]):
+            if total <= self.max_bytes:
+                break
+            if key == keep:
+                continue # Never evict the case we just finished
+            freed = delete_regenerable(key)
+            print(f"Evicting {key} from result cache ({freed / 2**30:.2f} GB of tracts, QA images and brain masks "
+                  f"deleted). Its WMPL is kept.")
+            total -= entry["bytes"]
+            del self.index[key]
@@ -0,0 +1,65 @@
+# Functions for running heavy stages on the part of the volume that holds the brain (crop/uncrop)
+# A box is a tuple of slices into the full volume. Cropped data gets an affine shifted to the corner of the box,
+# so world (RASMM) coordinates of seeds and streamlines are the same as with full-size data
+
+## Import necessary packages
+import numpy as np
+
+# Import necessary functions
+from Subscripts.Streamline_Utils import streamline_points, voxel_coords
+
+# Voxels kept around the brain mask, so tracking and peaks at the edge of the brain see the same neighbourhood
+crop_margin = 5
+
+# Function to get the box of a volume of this shape (no cropping)
+def full_box(shape):
+    return tuple(slice(0, n) for n in shape[:3])
+
+# Function to get the bounding box of a mask plus margin, clipped to the volume
+# The box is made symmetric in x and y, so masks flipped to RayStation orientation ([::-1, ::-1, :]) fit in it too
+# and any full-size volume (flipped or not) is cropped with the same box
+def brain_box(mask, margin=crop_margin):
+    mask = np.asarray(mask) != 0
+    if not mask.any():
+        return full_box(mask.shape)
+
+    box = []
+    for axis, n in enumerate(mask.shape[:3]):
+        other_axes = tuple(a for a in range(3) if a != axis)
+        hits = np.flatnonzero(mask.any(axis=other_axes))
+        start, stop = max(hits[0] - margin, 0), min(hits[-1] + 1 + margin, n)
+        if axis < 2: # union with mirrored range
+            start, stop = min(start, n - stop), max(stop, n - start)
+        box.append(slice(int(start), int(stop)))
+    return tuple(box)
+
+# Function to get the box holding every point of some streamlines (voxel the point falls in, as path_length rounds it)
+def streamlines_box(streamlines, affine, shape):
+    if len(streamlines) == 0:
+        return full_box(shape)
+    points, _ = streamline_points(streamlines)
+    voxels = voxel_coords(points, affine)
+    start = np.clip(voxels.min(axis=0), 0, np.array(shape[:3]) - 1).astype(int)
+    stop = np.clip(voxels.max(axis=0) + 1, 1, np.array(shape[:3])).astype(int)
+    return tuple(slice(int(a), int(b)) for a, b in zip(start, stop))
+
+# Function to crop a volume (3D or 4D) to a box. Returns a view, so no data is copied
+def crop(volume, box):
+    return volume[box]
+
+# Function to get the affine of a cropped volume (voxel 0 of the crop is the corner of the box)
+def crop_affine(affine, box):
+    shift = np.eye(4)
+    shift[:3, 3] = [s.start for s in box]
+    return affine @ shift
+
+# Function to paste a cropped volume back into a full-size volume filled with fill_value
+def uncrop(volume, box, full_shape, fill_value=0):
+    full_shape = tuple(full_shape[:3]) + volume.shape[3:] # extra axes (e.g. peaks per voxel) are kept
+    full = np.full(full_shape, fill_value, dtype=volume.dtype)
+    full[box] = volume
+    return full
+
+# Function to get the number of voxels of a box relative to the full volume (for reporting)
+def box_fraction(box, shape):
+    return float(np.prod([s.stop - s.start for s in box]) / np.prod(shape[:3]))
@@ -0,0 +1,68 @@
+# Functions for choosing between several tractography servers
+
+## Import necessary packages
+import zmq
+import json
+import datetime
+
+# Default ports of a server. A server entry only needs to list the ports it changes
+default_ports = {"main_port": "5560", "heartbeat_port": "5561", "stream_port": "5562", "data_port": "5563"}
+
+# Function to fill in default ports of a server entry
+def server_config(server):
+    config = dict(default_ports)
+    config.update(server)
+    return config
+
+# Function to name a server in messages
+def server_name(server):
+    return f"{server['ip']}:{server['main_port']}"
+
+# Function to ask servers (all at once) for their load over the heartbeat channel
+# Returns {index in servers: status dictionary} for servers which replied within timeout (ms)
+def query_server_status(context, servers, client_id, timeout=2000):
+    poller = zmq.Poller()
+    sockets = {}
+    for i, server in enumerate(servers):
+        socket = context.socket(zmq.REQ)
+        socket.linger = 0 # doesn't wait for anything when closing
+        socket.connect(f"tcp://{server['ip']}:{server['heartbeat_port']}")
+        socket.send_string(f"STATUS:{client_id}")
+        poller.register(socket, zmq.POLLIN)
+        sockets[socket] = i
+
+    statuses = {}
+    deadline = datetime.datetime.now() + datetime.timedelta(milliseconds=timeout)
+    while len(statuses) < len(sockets):
+        remaining = int((deadline - datetime.datetime.now()).total_seconds() * 1000)
+        if remaining <= 0:
+            break
+        for socket in dict(poller.poll(timeout=remaining)):
+            try:
+                statuses[sockets[socket]] = json.loads(socket.recv_string())
+            except json.JSONDecodeError:
+                pass # Old server without STATUS support. Treat as unavailable
+            poller.unregister(socket)
+
+    for socket in sockets:
+        socket.close()
+    return statuses
+
+# Function to score how busy a server is. Lower is better
+def server_load(status):
+    # Jobs ahead of us per job slot first, then fewer free cores
+    waiting = status.get("queue_depth", 0) + status.get("running", 0)
+    return (waiting / max(status.get("max_jobs", 1), 1), -status.get("free_cores", 0))
+
+# Function to order servers from least to most loaded. Servers which didn't reply are left out
+def rank_servers(context, servers, client_id, timeout=2000):
+    servers = [server_config(server) for server in servers]
+    statuses = query_server_status(context, servers, client_id, timeout=timeout)
+    for i, server in enumerate(servers):
+        if i in statuses:
+            status = statuses[i]
+            print(f"[{datetime.datetime.now()}] Server {server_name(server)}: {status.get('running', 0)} running, "
+                  f"{status.get('queue_depth', 0)} queued, {status.get('free_cores', '?')} free cores")
+        else:
+            print(f"[{datetime.datetime.now()}] Server {server_name(server)}: no reply")
+    return [servers[i] for i in sorted(statuses, key=lambda i: server_load(statuses[i]))]
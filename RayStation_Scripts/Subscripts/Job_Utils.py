@@ -0,0 +1,115 @@
+# Functions for running, cancelling and timing out tractography jobs
+
+## Import necessary packages
+import os
+import time
+import shutil
+import datetime
+import threading
+import subprocess
+from pathlib import Path
+from contextlib import contextmanager
+
+# psutil is optional. Without it, only the script itself (not processes it started) is terminated
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Outputs are written under this prefix then renamed, so a killed job never leaves a complete-looking file behind
+partial_prefix = ".partial_"
+
+# Context manager giving a temporary path (file or folder) to write to. It is swapped in for path once writing is done
+@contextmanager
+def atomic_path(path):
+    path = Path(path)
+    tmp_path = path.with_name(partial_prefix + path.name) # keep extension so nibabel etc. know the format
+    _remove(tmp_path) # leftover from an earlier attempt
+    try:
+        yield tmp_path
+    except BaseException:
+        _remove(tmp_path) # Don't keep half-written outputs
+        raise
+    if path.is_dir():
+        shutil.rmtree(path) # Folders can't be replaced in one step
+    os.replace(tmp_path, path)
+
+# Function to remove a file or folder if it exists
+def _remove(path):
+    if path.is_dir():
+        shutil.rmtree(path, ignore_errors=True)
+    elif path.exists():
+        path.unlink()
+
+# Function to remove partial outputs left behind by a job that was stopped
+def cleanup_partial_outputs(base_dir):
+    removed = 0
+    for path in sorted(Path(base_dir).rglob(partial_prefix + "*"), reverse=True): # children before parents
+        _remove(path)
+        removed += 1
+    return removed
+
+# Function to stop a process and the processes it started. Asks nicely first, then kills after grace seconds
+def terminate_process_tree(proc, grace=10):
+    children = []
+    if psutil is not None:
+        try:
+            children = psutil.Process(proc.pid).children(recursive=True)
+        except psutil.NoSuchProcess:
+            pass
+    for process in [proc] + children:
+        try:
+            process.terminate()
+        except Exception:
+            pass # Already gone
+    try:
+        proc.wait(timeout=grace)
+    except subprocess.TimeoutExpired:
+        proc.kill()
+    for child in children:
+        try:
+            child.kill()
+        except Exception:
+            pass
+
+# Class holding a running tractography job and the stage it is in
+class Job:
+    def __init__(self, identity, base_dir, proc, job_id):
+        # Initialize by defining stuff
+        self.job_id = job_id # unique per job (a client may run cases one after the other)
+        self.identity = identity # ROUTER identity of client (same as its heartbeat ID)
+        self.client_id = identity.decode('utf-8', errors='replace')
+        self.base_dir = base_dir
+        self.proc = proc
+        self.started = time.time()
+        self.stage = None # stage currently running (from the script's stage events)
+        self.stage_start = None
+        self.cancel_reason = None # set when job is cancelled or timed out
+
+    def on_event(self, event):
+        # Keep track of the running stage
+        if event.get("event") == "stage_start":
+            self.stage = event["stage"]
+            self.stage_start = time.time()
+        elif event.get("event") == "stage_end":
+            self.stage = None
+            self.stage_start = None
+
+    def check_timeouts(self, stage_timeouts, default_stage_timeout, job_timeout):
+        # Return reason if the job or its current stage ran for too long
+        now = time.time()
+        if job_timeout is not None and now - self.started > job_timeout:
+            return f"job exceeded {job_timeout} s"
+        if self.stage is not None:
+            limit = stage_timeouts.get(self.stage, default_stage_timeout)
+            if limit is not None and now - self.stage_start > limit:
+                return f"stage '{self.stage}' exceeded {limit} s"
+        return None
+
+    def cancel(self, reason, grace=10):
+        # Stop job in the background (terminating can take up to grace seconds)
+        if self.cancel_reason is not None:
+            return # Already being cancelled
+        self.cancel_reason = reason
+        print(f"[{datetime.datetime.now()}] [Jobs] Cancelling job of {self.client_id}: {reason}")
+        threading.Thread(target=terminate_process_tree, args=(self.proc, grace), daemon=True).start()
@@ -0,0 +1,105 @@
+# Functions for level-of-detail (decimated) streamlines used for visualization
+
+## Import necessary packages
+import os
+import nibabel as nib
+import numpy as np
+from dipy.tracking.streamline import Streamlines
+from dipy.tracking.streamlinespeed import compress_streamlines
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Tract_Cache_Utils import load_tracts_file
+
+# psutil is optional. Without it, the default budget is picked from the number of cores only
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Streamline budgets (number of streamlines) cached for every tractogram. Full tractogram is always available too
+lod_budgets = [10000, 50000, 200000]
+
+# Maximum distance (mm) between a compressed streamline and the original one
+lod_tol_error = 0.5
+lod_max_segment_length = 10 # mm
+
+# Seed for subsampling, so the same streamlines are shown every time
+lod_seed = 0
+
+# Function to define folder holding the decimated tractograms
+def lod_dir(trk_path):
+    return trk_path.parent / "LOD"
+
+# Function to define path of a decimated tractogram ("full" is the compressed tractogram with every streamline)
+def lod_path(trk_path, budget):
+    return lod_dir(trk_path) / f"{trk_path.stem}_lod_{budget}.trk"
+
+# Function to pick a streamline budget for this machine
+def hardware_budget():
+    # Can be forced with an environment variable
+    if os.environ.get("TRACTOGRAPHY_LOD_BUDGET"):
+        return int(os.environ["TRACTOGRAPHY_LOD_BUDGET"])
+    memory_gb = psutil.virtual_memory().total / 2**30 if psutil is not None else None
+    cores = os.cpu_count() or 1
+    if (memory_gb is not None and memory_gb < 8) or cores <= 2:
+        return lod_budgets[0]
+    if (memory_gb is not None and memory_gb < 32) or cores <= 8:
+        return lod_budgets[1]
+    return lod_budgets[2]
+
+# Function to create the decimated tractograms of a trk file (compression, then subsampling at every budget)
+def build_lods(trk_path):
+    header = nib.streamlines.load(trk_path, lazy_load=True).header # header only
+    streamlines, _ = load_tracts_file(trk_path) # from compressed cache when there is one
+
+    # Compress streamlines. Removes points that lie (within tolerance) on a straight line between their neighbours
+    compressed = Streamlines(compress_streamlines(streamlines, tol_error=lod_tol_error,
+                                                  max_segment_length=lod_max_segment_length))
+    print(f"[OK] Compressed {len(streamlines)} streamlines from {len(streamlines.get_data())} "
+          f"to {len(compressed.get_data())} points.")
+
+    lod_dir(trk_path).mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    for old_path in lod_dir(trk_path).glob(f"{trk_path.stem}_lod_*.trk"):
+        old_path.unlink() # Levels from an older tractogram
+    save_lod(compressed, header, lod_path(trk_path, "full"))
+
+    # Subsample compressed streamlines at every budget smaller than the tractogram
+    rng = np.random.default_rng(lod_seed)
+    for budget in lod_budgets:
+        if budget >= len(compressed):
+            continue
+        idx = np.sort(rng.choice(len(compressed), size=budget, replace=False)) # keep original order
+        save_lod(compressed[idx], header, lod_path(trk_path, budget))
+
+# Function to save a decimated tractogram with the header of the original trk file
+def save_lod(streamlines, header, path):
+    tractogram = nib.streamlines.Tractogram(streamlines, affine_to_rasmm=np.eye(4)) # streamlines are already in RASMM
+    with atomic_path(path) as tmp_path:
+        nib.streamlines.save(tractogram, str(tmp_path), header=header)
+
+# Function to load streamlines of a tractogram at a given budget. Decimated tractograms are created if missing or outdated
+def get_lod_streamlines(trk_path, budget):
+    full_path = lod_path(trk_path, "full")
+    if not full_path.is_file() or full_path.stat().st_mtime < trk_path.stat().st_mtime:
+        print(f"Creating decimated tractograms for {trk_path.name}...")
+        build_lods(trk_path)
+
+    # Use largest cached budget not above the requested one (smallest one if budget is below every level)
+    # Full compressed tractogram is used when it fits in the budget
+    n_streamlines = nib.streamlines.load(full_path, lazy_load=True).header["nb_streamlines"]
+    cached = [b for b in lod_budgets if lod_path(trk_path, b).is_file()]
+    if budget is None or budget >= n_streamlines or not cached:
+        path = full_path
+    else:
+        fitting = [b for b in cached if b <= budget]
+        path = lod_path(trk_path, max(fitting) if fitting else min(cached))
+
+    trk = nib.streamlines.load(path)
+    return trk.streamlines, trk.affine
+
+# Function to get the next budget up or down from the current one (None is the full tractogram)
+def next_budget(budget, step):
+    levels = lod_budgets + [None]
+    i = levels.index(budget) if budget in levels else 0
+    return levels[min(max(i + step, 0), len(levels) - 1)]
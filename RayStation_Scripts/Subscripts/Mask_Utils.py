@@ -0,0 +1,101 @@
+# Functions for saving and loading masks as one label volume in ROIs_NIfTI
+
+## Import necessary packages
+import numpy as np
+import nibabel as nib
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Volume_Utils import load_volume, forget_volume, uncompressed_path
+
+# Masks stored in the label volume. Bit i holds mask_names[i]
+mask_names = ["gtv", "external", "brain", "white_matter"]
+
+# Label volume is gzipped by default (small on the network share). Either way it is memory-mapped when read
+# (see load_volume), but uncompressed labels skip making the uncompressed copy on first read
+labels_compressed = True
+
+# Function to define folder holding masks
+def rois_nii_dir(base_dir):
+    return base_dir / "RayStation" / "ROIs_NIfTI"
+
+# Function to define path of the label volume
+def labels_path(base_dir, compressed=labels_compressed):
+    return rois_nii_dir(base_dir) / ("roi_labels.nii.gz" if compressed else "roi_labels.nii")
+
+# Function to define path of a mask saved on its own (older cases)
+def legacy_mask_path(base_dir, name):
+    return rois_nii_dir(base_dir) / f"{name}_mask.nii.gz"
+
+# Function to pack masks into a label volume with one bit per mask (first mask is bit 0)
+def masks_to_labels(masks):
+    labels = np.zeros(masks[0].shape, dtype=np.uint8)
+    for bit, mask in enumerate(masks):
+        labels |= (np.asarray(mask) > 0).astype(np.uint8) << bit
+    return labels
+
+# Function to unpack one mask from a label volume in a single uint8 array (0 or 1), no temporaries
+# Single bits can't be viewed by numpy, so every mask takes one byte per voxel. bool masks are views of it
+def label_bit(labels, bit, dtype=np.uint8):
+    mask = np.right_shift(labels, bit, dtype=np.uint8)
+    np.bitwise_and(mask, 1, out=mask)
+    return mask.view(bool) if dtype is bool else mask.astype(dtype, copy=False)
+
+# Function to unpack masks from a label volume
+def labels_to_masks(labels, n_masks):
+    return [label_bit(labels, bit) for bit in range(n_masks)]
+
+# Function to save masks (in mask_names order) as the label volume. Replaces saved masks of older formats
+def save_masks(base_dir, masks, affine, compressed=labels_compressed):
+    rois_nii_dir(base_dir).mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    labels_img = nib.Nifti1Image(masks_to_labels(masks), affine=affine)
+    labels_img.header["descrip"] = "bits:" + ",".join(mask_names[:len(masks)]) # so the file explains itself
+    for path in [labels_path(base_dir, True), labels_path(base_dir, False)]:
+        forget_volume(path) # release memory-mapped copies before replacing them
+    with atomic_path(labels_path(base_dir, compressed)) as tmp_path:
+        nib.save(labels_img, tmp_path)
+
+    # Remove other copies, so older masks are never read instead
+    # (the uncompressed copy of the gzipped file is the file just saved when saving uncompressed)
+    for old_path in [labels_path(base_dir, not compressed)] + [legacy_mask_path(base_dir, name) for name in mask_names]:
+        forget_volume(old_path, remove_copy=uncompressed_path(old_path) != labels_path(base_dir, compressed))
+        if old_path.is_file():
+            old_path.unlink()
+
+# Function to find the label volume. None if masks were never saved in this format
+# Gzipped file comes first, since an uncompressed file next to it is only its copy (see load_volume)
+def find_labels(base_dir):
+    for compressed in (True, False):
+        if labels_path(base_dir, compressed).is_file():
+            return labels_path(base_dir, compressed)
+    return None
+
+# Function to check if masks are saved (label volume or files of older cases)
+def has_masks(base_dir, names):
+    labels_file = find_labels(base_dir)
+    if labels_file is not None:
+        return all(name in mask_names[:stored_mask_count(labels_file)] for name in names)
+    return all(legacy_mask_path(base_dir, name).is_file() for name in names)
+
+# Function to get the number of masks in a label volume (from its header)
+def stored_mask_count(labels_file):
+    descrip = nib.load(labels_file).header["descrip"].item().decode('utf-8', errors='replace')
+    return len(descrip[len("bits:"):].split(",")) if descrip.startswith("bits:") else len(mask_names)
+
+# Function to load masks as bool (or uint8) arrays. Never expands to float
+# One byte per voxel and mask, made in one step from the memory-mapped label volume (bool masks are views of it)
+# Returns list of masks (same order as names) and affine
+def load_masks(base_dir, names, dtype=bool):
+    labels_file = find_labels(base_dir)
+    if labels_file is not None:
+        labels_img, labels = load_volume(labels_file) # uint8 as stored, memory-mapped
+        masks = [label_bit(labels, mask_names.index(name), dtype) for name in names]
+        affine = labels_img.affine
+        return masks, affine
+    else: # Older case with one file per mask
+        masks = []
+        for name in names:
+            mask_img, mask = load_volume(legacy_mask_path(base_dir, name))
+            masks.append(mask != 0)
+            affine = mask_img.affine
+    return [mask.astype(dtype, copy=False) for mask in masks], affine
@@ -0,0 +1,54 @@
+# Functions for caching ROI surface meshes used by the visualizations
+
+## Import necessary packages
+import hashlib
+import numpy as np
+from dipy.viz import actor, has_fury
+
+if has_fury:
+    from fury.utils import get_actor_from_primitive, get_polydata_vertices, get_polydata_triangles, get_polydata_normals
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+
+# Function to define folder holding the meshes (next to ROIs_NIfTI)
+def mesh_dir(base_dir):
+    return base_dir / "RayStation" / "ROIs_Meshes"
+
+# Function to hash the content of a mask (and its affine). Meshes are remade when this changes
+def mask_hash(mask, affine):
+    digest = hashlib.sha256()
+    digest.update(str(mask.shape).encode('utf-8'))
+    digest.update(np.packbits(np.asarray(mask) > 0).tobytes()) # 1 bit per voxel, whatever the dtype
+    digest.update(np.round(np.asarray(affine, dtype=np.float64), 6).tobytes())
+    return digest.hexdigest()
+
+# Function to get an actor showing the surface of a mask. The surface (marching cubes) is computed once and saved
+def roi_contour_actor(base_dir, name, mask, affine, color, opacity):
+    mesh_path = mesh_dir(base_dir) / f"{name}_mesh.npz"
+    key = mask_hash(mask, affine)
+
+    if mesh_path.is_file():
+        mesh = np.load(mesh_path)
+        if str(mesh["hash"]) == key:
+            # Rebuild actor from saved mesh
+            contour_actor = get_actor_from_primitive(mesh["vertices"], mesh["triangles"], normals=mesh["normals"],
+                                                     backface_culling=False)
+            contour_actor.GetProperty().SetColor(*color)
+            contour_actor.GetProperty().SetOpacity(opacity)
+            return contour_actor
+
+    # Compute surface and save it
+    contour_actor = actor.contour_from_roi(mask, affine=affine, opacity=opacity, color=color)
+    contour_actor.GetMapper().Update()
+    polydata = contour_actor.GetMapper().GetInput()
+
+    mesh_path.parent.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    with atomic_path(mesh_path) as tmp_path:
+        with open(tmp_path, "wb") as file: # file object so numpy doesn't change the name
+            np.savez(file, hash=key,
+                     vertices=get_polydata_vertices(polydata).astype(np.float32),
+                     triangles=get_polydata_triangles(polydata).astype(np.int32),
+                     normals=get_polydata_normals(polydata).astype(np.float32))
+
+    return contour_actor
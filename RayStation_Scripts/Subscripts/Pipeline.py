@@ -0,0 +1,182 @@
+# Tractography pipeline for one case (DICOM to NIfTI, tractography, WMPL map), shared by the interactive script
+# (PrimitiveTractography.py) and the batch script (PrimitiveTractography_Batch.py)
+
+## Import necessary packages
+import sys
+import subprocess
+from pathlib import Path
+
+# Import necessary functions
+from Subscripts.Preliminaries import check_nifti_folder, get_relevant_files, copy_relevant_files
+from Subscripts.Preliminaries import dicom_to_nifti, get_fname
+from Subscripts.Tractography_Utils import get_data, get_wm_mask, csa_and_sc, seed_gen, streamline_gen, save_tracts, get_tracts
+from Subscripts.Tractography_Utils import tracts_filtered
+from Subscripts.RS_ROI_Utils import rs_folders, load_rois, roi_interp, get_white_matter_mask
+from Subscripts.WMPL_Utils import get_wmpl, save_wmpl_dicom
+from Subscripts.Progress_Utils import stage
+from Subscripts.Crop_Utils import brain_box, full_box, crop, crop_affine, uncrop, box_fraction
+from Subscripts.Seeding_Utils import gtv_hit_report
+
+# Script rendering QA snapshots. Run separately, since views are rendered in spawned processes which would re-run
+# the script that started them
+qa_script = Path(__file__).resolve().parents[1] / "PrimitiveTractography_QA.py"
+
+# Function to run the pipeline on one case. Settings are described in PrimitiveTractography.py
+# show is called with "Tracts" and then "WMPL" when they are ready to be shown (None for non-interactive runs)
+# Returns a summary of the case (whether saved tracts were reused, number of streamlines)
+def run_pipeline(base_dir, show=None, qa_snapshots=False, registration_mode="full", crop_to_brain=True,
+                 brain_mask_mode="all", dwi_memmap=False, tracking_engine="eudx", seeding_strategy="uniform",
+                 seed_budget=None, filter_tracts_to_gtv=True, compressed_tract_cache=False):
+    base_dir = Path(base_dir)
+
+    # All streamlines are kept when they are shown (interactive or QA snapshots)
+    keep_all_tracts = show is not None or qa_snapshots or not filter_tracts_to_gtv
+
+    ## Define NIfTI folder path
+    nifti_dir = base_dir / "NIfTI"
+    ## Check if NIfTI folder has all the required files
+    print(f"Checking NIfTI folder {nifti_dir}...")
+    valid_folder = check_nifti_folder(nifti_dir, bval_bvec_expected=True)
+
+    if not valid_folder: ## only proceed if NIfTI folder doesn't already contain necessary files
+        with stage("dicom_to_nifti"):
+            # Get diffusion MRIs if any exist
+            print("Collecting relevant MRI files...")
+            relevant_files = get_relevant_files(base_dir)
+
+            # Copy relevant diffusion MRIs to a new folder
+            print("Copying relevant files to a new folder...")
+            dicom_dir = copy_relevant_files(base_dir, relevant_files) # return output DICOM folder
+
+            # Convert DICOM files to NIfTI
+            print("Converting from DICOM to NIfTI...")
+            dicom_to_nifti(dicom_dir, nifti_dir)
+
+    ## Extract file name
+    print("Getting file name...")
+    fname = get_fname(nifti_dir)
+
+    # Tractography
+
+    ## First check if tractography has already been completed
+    print("Checking for existance of saved tracts...")
+    with stage("get_tracts"):
+        streamlines_wm, streamlines_gtv, affine, tracts_flag = get_tracts(base_dir)
+    if tracts_flag and keep_all_tracts and tracts_filtered(base_dir):
+        print("Saved tracts only hold streamlines through the GTV. Tracking again to show all of them...")
+        tracts_flag = False
+    tracts_reused = bool(tracts_flag)
+
+    ## Check if white matter mask exists
+    print("Checking for saved white matter mask...")
+    white_matter_mask = get_white_matter_mask(base_dir)
+
+    if white_matter_mask.size == 0 or not tracts_flag:
+        ## Extract data and perform segmentation
+        print("Extracting data and performing segmentation...")
+        with stage("get_data"):
+            data_masked, mask, gtab, affine, hardi_img = get_data(nifti_dir, fname, mask_mode=brain_mask_mode,
+                                                                     memmap=dwi_memmap)
+        print("Data obtained.")
+
+        ## Crop to the brain (box of the median_otsu mask plus margin). Data is a view, so nothing is copied
+        full_shape = mask.shape
+        box = brain_box(mask) if crop_to_brain else full_box(full_shape)
+        data_masked = crop(data_masked, box)
+        affine_crop = crop_affine(affine, box) # same world coordinates as the full volume
+        print(f"Processing {100 * box_fraction(box, full_shape):.0f}% of the volume (brain bounding box).")
+
+        ## Create white matter mask with DTI
+        print("Extracting white matter mask using DTI...")
+        with stage("get_wm_mask"):
+            white_matter_mask, FA = get_wm_mask(data_masked, gtab)
+        white_matter_mask = uncrop(white_matter_mask, box, full_shape) # full size again, to be matched with ROIs and saved
+        print("White matter mask obtained.")
+
+    ## Obtain ROIs defined on RS
+    ### Check if folders valid. Create them if they are not
+    print("Checking for RayStation files...")
+    rs_folders(base_dir)
+
+    ### Load ROIs
+    print("Loading ROIs...")
+    with stage("load_rois"):
+        gtv_mask, external_mask, brain_mask = load_rois(base_dir)
+
+    ### Perform interpolation to match mask shapes. Function will check if this is necessary. Returns required masks
+    with stage("roi_interp"):
+        gtv_mask, external_mask, brain_mask, white_matter_mask, gtv_wm_mask = roi_interp(base_dir, gtv_mask, external_mask,
+                                                                                         brain_mask, white_matter_mask, affine,
+                                                                                         registration_mode=registration_mode)
+    print("Relevant ROIs succesfully loaded in MR coordinates.")
+
+    if not tracts_flag:
+        ## Get CSA ODF model and define stopping criterion
+        print("Applying CSA ODF model...")
+        with stage("csa_and_sc"):
+            csa_peaks, stopping_criterion = csa_and_sc(gtab, data_masked, crop(white_matter_mask, box), FA,
+                                                       engine=tracking_engine, brain_mask=crop(mask, box),
+                                                       affine=affine_crop)
+        print("CSA ODF model successfully applied to data.")
+
+        ## Generate seeds
+        print("Generating seeds...")
+        with stage("seed_gen"):
+            seeds_wm, seeds_gtv = seed_gen(crop(gtv_mask, box), crop(white_matter_mask, box), affine_crop,
+                                           seeds_per_voxel=1, strategy=seeding_strategy, FA=FA[::-1, ::-1, :],
+                                           max_seeds=seed_budget) # FA flipped like the white matter mask
+        print("Seeds generated.")
+
+        ## Generate streamlines
+        print("Generating streamlines...")
+        tracked = {} # white matter streamlines tracked and kept (before and after filtering to the GTV)
+        with stage("streamline_gen"):
+            streamlines_wm, streamlines_gtv = streamline_gen(seeds_wm, seeds_gtv, csa_peaks, stopping_criterion,
+                                                             affine_crop, engine=tracking_engine,
+                                                             gtv_mask=None if keep_all_tracts else crop(gtv_mask, box),
+                                                             counts=tracked)
+        print("Streamlines generated.")
+
+        ## Report how many streamlines reach the GTV (the ones WMPL uses)
+        gtv_hit_report(streamlines_wm, streamlines_gtv, crop(gtv_mask, box), affine_crop, strategy=seeding_strategy,
+                       counts=tracked)
+
+        ## Save tracts
+        print("Saving tracts...")
+        with stage("save_tracts"):
+            save_tracts(base_dir, streamlines_wm, streamlines_gtv, hardi_img, gtv_only=not keep_all_tracts,
+                        cache=compressed_tract_cache)
+        print("Tracts successfully saved.")
+
+    ## Show tracts
+    if show is not None:
+        print("Showing tracts...")
+        show("Tracts")
+
+    # WMPL
+
+    ## Create WMPL map (loads if already saved before)
+    with stage("get_wmpl"):
+        wmpl = get_wmpl(base_dir)
+
+    ## Save WMPL map as a DICOM
+    print("Saving WMPL map as a DICOM...")
+    with stage("save_wmpl_dicom", total=wmpl.shape[2]):
+        save_wmpl_dicom(base_dir, wmpl)
+    print("WMPL map saved as DICOM successfully")
+
+    ## Show WMPL map
+    if show is not None:
+        print("Showing WMPL map...")
+        show("WMPL")
+
+    ## Save QA images
+    if qa_snapshots:
+        print("Saving QA snapshots...")
+        with stage("qa_snapshots"):
+            qa_result = subprocess.run([sys.executable, str(qa_script), str(base_dir)])
+            if qa_result.returncode != 0: # QA images are a nice to have. Don't fail the case over them
+                print(f"[WARNING] Could not save QA snapshots (exit code {qa_result.returncode}).")
+
+    return {"tracts_reused": tracts_reused, "streamlines_wm": len(streamlines_wm),
+            "streamlines_gtv": len(streamlines_gtv)}
@@ -8,9 +8,17 @@ from collections import defaultdict
 import shutil
 import re
 
+# Import necessary functions
+from Subscripts.Job_Utils import partial_prefix
+from Subscripts.Profile_Utils import profiled
+
+# Folder holding the base directories of cases ("<case_name> RS")
+patients_dir = Path("V:/Common/Staff Personal Folders/DanielH/DICOM_Files/TractographyPatient")
+
 ## Create necessary functions
 
 # Function to check if a folder path has all the required NIfTI files
+@profiled
 def check_nifti_folder(path, bval_bvec_expected):
     # First set flag to false
     valid_folder = False
@@ -51,6 +59,7 @@ def check_nifti_folder(path, bval_bvec_expected):
     return valid_folder
 
 # Function to extract file name from a given folder of NIfTI files
+@profiled
 def get_fname(path):
     fname = [] # Set empty first
     for file_path in path.rglob("*"): # parses every file recursively
@@ -76,6 +85,7 @@ def get_fname(path):
     return fname
 
 # Function to get exported RayStation file PATHS
+@profiled
 def rs_get_paths(path, prints=True):
 
     # Define lists to add file paths to
@@ -117,6 +127,7 @@ def rs_get_paths(path, prints=True):
     return file_paths
 
 # Function to get exported RayStation files
+@profiled
 def rs_get_info(path, prints=True):
 
     # Define lists to add file paths to
@@ -179,21 +190,27 @@ def rs_get_info(path, prints=True):
     return file_info, file_paths
 
 # Function to convert from DICOM to NIfTI
+@profiled
 def dicom_to_nifti(dicom_dir, nifti_dir):
 
     nifti_dir.mkdir(parents=True, exist_ok=True) # make folder for NIFTI if it doesnt exist yet
 
+    # Convert into a temporary folder first so a stopped conversion never looks complete
+    tmp_dir = nifti_dir.with_name(partial_prefix + nifti_dir.name)
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+
     # Create command for dcm2niix
     # EXPLANATION OF LETTERS
     # -z y creates compressed (.gz) .nii files
     # -f %p_%s defines output file name as %p (protocol name(DICOM tag 0018, 1030)) with %s (series(DICOM tag 0020, 0011))
-    # -o specifies the output directory of the NIfTI files
+    # -o specifies the output directory of the NIfTI files (temporary folder here)
     cmd = [
         # "dcm2niix",
         "V:/Common/Staff Personal Folders/DanielH/RayStation_Scripts/Tractography/Subscripts/dcm2niix/dcm2niix.exe",
         "-z", "y",
         "-f", "%p_%s",
-        "-o", str(nifti_dir),
+        "-o", str(tmp_dir),
         str(dicom_dir)
     ]
 
@@ -206,12 +223,18 @@ def dicom_to_nifti(dicom_dir, nifti_dir):
         print("STDERR:", e.stderr)
         print("Return code:", e.returncode)
 
+    # Move converted files into NIfTI folder
+    for file_path in tmp_dir.iterdir():
+        shutil.move(str(file_path), str(nifti_dir / file_path.name))
+    tmp_dir.rmdir()
+
     print("[OK] DICOM files successfully converted to NIfTI")
 
 # Function to define base directory to be used
-def get_base_dir(case_name):
+@profiled
+def get_base_dir(case_name, root=None):
     ## Base directory to be used
-    base_dir = Path(f"V:/Common/Staff Personal Folders/DanielH/DICOM_Files/TractographyPatient/{case_name} RS/")
+    base_dir = Path(root if root is not None else patients_dir) / f"{case_name} RS"
     if base_dir.is_dir():
         print("Base folder: ", base_dir)
         return base_dir
@@ -219,6 +242,7 @@ def get_base_dir(case_name):
         raise ValueError(f"Could not find folder: {base_dir}")
 
 # Function to get diffusion MRIs    
+@profiled
 def get_relevant_files(base_dir):
     # Define folder containing raw DICOM files
     dicom_raw_dir = base_dir / "Combined"
@@ -267,6 +291,7 @@ def get_relevant_files(base_dir):
         raise ValueError("\nNo valid DICOMs found.")
 
 # Function     
+@profiled
 def copy_relevant_files(base_dir, relevant_files):
     output_dir = base_dir / "DICOM"
     output_dir.mkdir(parents=True, exist_ok=True) # make folder for derived relevant DICOM files if it doesnt exist yet
@@ -0,0 +1,185 @@
+# Functions for opt-in profiling of pipeline functions (time, CPU, memory and optional profiler dumps)
+# Functions are wrapped with @profiled where they are defined. Wrappers only measure after enable_profiling is called
+
+## Import necessary packages
+import os
+import time
+import threading
+import functools
+import tracemalloc
+import cProfile
+from pathlib import Path
+
+# Import necessary functions
+from Subscripts.Progress_Utils import emit, get_rss
+
+# pyinstrument is optional. Without it, only cProfile dumps can be written
+try:
+    import pyinstrument
+except ImportError:
+    pyinstrument = None
+
+# Profiling is off unless enable_profiling is called (or TRACTOGRAPHY_PROFILE is set, e.g. by a batch runner)
+profiling_enabled = os.environ.get("TRACTOGRAPHY_PROFILE", "") not in ("", "0")
+
+# Profiler dumps written per call: None, "cprofile" (.prof, open with snakeviz/pstats) or "pyinstrument" (.html)
+profiler = None
+
+# Folder profiler dumps are written to
+profile_dir = None
+
+# Number of top allocation sites (tracemalloc) kept per call
+tracemalloc_top = 5
+
+# Time between two RSS samples while a profiled function runs (seconds)
+rss_interval = 0.05
+
+# One record per profiled call, in order of completion
+_records = []
+
+# Records of the calls running now (outermost first), so nested calls don't reset the peaks of outer calls
+_active = []
+_sampler = None
+
+# Function to switch profiling on. Starts tracemalloc (slows allocations down, so only when asked for)
+def enable_profiling(dump=None, dump_dir=None, top=tracemalloc_top):
+    global profiling_enabled, profiler, profile_dir, tracemalloc_top
+    if dump not in (None, "cprofile", "pyinstrument"):
+        raise ValueError(f"Unknown profiler '{dump}'. Use None, 'cprofile' or 'pyinstrument'.")
+    if dump == "pyinstrument" and pyinstrument is None:
+        print("[WARNING] pyinstrument is not installed. Writing cProfile dumps instead.")
+        dump = "cprofile"
+    profiling_enabled = True
+    profiler = dump
+    profile_dir = Path(dump_dir) if dump_dir is not None else None
+    tracemalloc_top = top
+    if not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+# Function to switch profiling off
+def disable_profiling():
+    global profiling_enabled
+    profiling_enabled = False
+    if tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+# Function to sample RSS in the background while profiled functions run. Peaks go to every running record
+def _sample_rss():
+    while _active:
+        rss = get_rss()
+        for record in list(_active):
+            record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+        time.sleep(rss_interval)
+
+# Function to check if RSS can be measured (psutil installed)
+def psutil_available():
+    return get_rss() is not None
+
+# Function to write a profiler dump of one call
+def _write_dump(name, prof):
+    dump_dir = profile_dir if profile_dir is not None else Path.cwd() / "Profiles"
+    dump_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    stem = f"{name}_{len(_records):03d}" # numbered, so repeated calls don't overwrite each other
+    if profiler == "cprofile":
+        path = dump_dir / (stem + ".prof")
+        prof.dump_stats(path)
+    else:
+        path = dump_dir / (stem + ".html")
+        path.write_text(prof.output_html(), encoding='utf-8')
+    return str(path)
+
+# Decorator measuring wall time, CPU time, peak RSS and top allocations of each call when profiling is enabled
+def profiled(function):
+    name = f"{function.__module__.rsplit('.', 1)[-1]}.{function.__name__}"
+
+    @functools.wraps(function)
+    def wrapper(*args, **kwargs):
+        global _sampler
+        if not profiling_enabled:
+            return function(*args, **kwargs)
+
+        outermost = not _active
+        rss = get_rss()
+        record = {"function": name, "depth": len(_active), "start_rss_mb": rss, "peak_rss_mb": rss}
+        _active.append(record)
+        if psutil_available() and (_sampler is None or not _sampler.is_alive()):
+            _sampler = threading.Thread(target=_sample_rss, daemon=True)
+            _sampler.start()
+
+        # Only the outermost call profiles and resets the tracemalloc peak (profilers can't be nested)
+        prof = None
+        if outermost and profiler == "cprofile":
+            prof = cProfile.Profile()
+        elif outermost and profiler == "pyinstrument":
+            prof = pyinstrument.Profiler()
+        if outermost and tracemalloc.is_tracing():
+            tracemalloc.reset_peak()
+            snapshot_before = tracemalloc.take_snapshot()
+
+        wall_start, cpu_start = time.perf_counter(), time.process_time()
+        if prof is not None:
+            if profiler == "cprofile":
+                prof.enable()
+            else:
+                prof.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            if prof is not None:
+                if profiler == "cprofile":
+                    prof.disable()
+                else:
+                    prof.stop()
+            record["wall_s"] = round(time.perf_counter() - wall_start, 3)
+            record["cpu_s"] = round(time.process_time() - cpu_start, 3)
+            _active.remove(record)
+            rss = get_rss()
+            if rss is not None:
+                record["peak_rss_mb"] = max(record["peak_rss_mb"], rss)
+                record["end_rss_mb"] = rss
+
+            if outermost and tracemalloc.is_tracing():
+                record["traced_peak_mb"] = round(tracemalloc.get_traced_memory()[1] / 2**20, 1)
+                # Allocation sites grown the most during the call (memory still held when it returned)
+                own_frames = [tracemalloc.Filter(False, tracemalloc.__file__), tracemalloc.Filter(False, __file__)]
+                stats = tracemalloc.take_snapshot().filter_traces(own_frames).compare_to(
+                    snapshot_before.filter_traces(own_frames), "lineno")
+                record["top_allocations"] = [{"site": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+                                              "size_mb": round(stat.size_diff / 2**20, 2)}
+                                             for stat in stats if stat.size_diff > 0][:tracemalloc_top]
+            if prof is not None:
+                record["dump"] = _write_dump(name, prof)
+            _records.append(record)
+
+    return wrapper
+
+# Function to get profile records of this run
+def profile_records():
+    return list(_records)
+
+# Function to sum records per function (calls, total wall/CPU time, largest peak RSS), slowest first
+def profile_summary():
+    summary = {}
+    for record in _records:
+        entry = summary.setdefault(record["function"], {"function": record["function"], "calls": 0, "wall_s": 0.0,
+                                                        "cpu_s": 0.0, "peak_rss_mb": None, "traced_peak_mb": None})
+        entry["calls"] += 1
+        entry["wall_s"] = round(entry["wall_s"] + record["wall_s"], 3)
+        entry["cpu_s"] = round(entry["cpu_s"] + record["cpu_s"], 3)
+        for key in ("peak_rss_mb", "traced_peak_mb"):
+            if record.get(key) is not None:
+                entry[key] = max(entry[key] or 0, record[key])
+    return sorted(summary.values(), key=lambda entry: entry["wall_s"], reverse=True)
+
+# Function to print the summary as a table and send it as a "profile" event on the stream
+def report_profile():
+    summary = profile_summary()
+    if not summary:
+        return None
+    print(f"{'Function':<40} {'Calls':>5} {'Wall (s)':>9} {'CPU (s)':>9} {'Peak RSS (MB)':>14} {'Traced peak (MB)':>17}")
+    for entry in summary:
+        peak_rss = f"{entry['peak_rss_mb']:.0f}" if entry["peak_rss_mb"] is not None else "-"
+        traced = f"{entry['traced_peak_mb']:.0f}" if entry["traced_peak_mb"] is not None else "-"
+        print(f"{entry['function']:<40} {entry['calls']:>5} {entry['wall_s']:>9.2f} {entry['cpu_s']:>9.2f} "
+              f"{peak_rss:>14} {traced:>17}")
+    return emit("profile", functions=summary, calls=profile_records())
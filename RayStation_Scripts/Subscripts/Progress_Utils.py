@@ -0,0 +1,162 @@
+# Functions for structured progress and metrics events
+
+## Import necessary packages
+import sys
+import json
+import time
+import datetime
+from pathlib import Path
+
+# psutil is optional. Without it, RSS is reported as None
+try:
+    import psutil
+    _process = psutil.Process()
+except ImportError:
+    psutil = None
+
+# Prefix for events printed on stdout. The server picks these lines out of the relayed output
+event_prefix = "@@EVENT "
+
+# Minimum time between two progress events of the same stage (seconds)
+progress_interval = 1.0
+
+# Start time of the run and of each running stage
+_run_start = time.time()
+_stage_start = {}
+_last_progress = {} # time of last progress event per stage
+
+# Gate every stage waits at before it starts (see Scheduler_Utils). Called with the stage name, returns a context
+# manager held while the stage runs. None to start stages straight away
+_stage_gate = None
+
+# Function to set the stage gate (None to remove it)
+def set_stage_gate(gate):
+    global _stage_gate
+    _stage_gate = gate
+
+# Function to get resident set size (MB) of this process
+def get_rss():
+    if psutil is None:
+        return None
+    return round(_process.memory_info().rss / 2**20, 1)
+
+# Function to print an event as a single JSON line on stdout
+def emit(event_type, **fields):
+    event = {"event": event_type, "time": time.time(), "elapsed": round(time.time() - _run_start, 3), "rss_mb": get_rss()}
+    event.update(fields)
+    print(event_prefix + json.dumps(event), flush=True)
+    return event
+
+# Function to read an event back from a line of output. Returns None if line isn't an event
+def parse_event(line):
+    if not line.startswith(event_prefix):
+        return None
+    try:
+        return json.loads(line[len(event_prefix):])
+    except json.JSONDecodeError:
+        return None
+
+# Context manager to emit stage start and end events around a block of code
+class stage:
+    def __init__(self, name, total=None):
+        self.name = name
+        self.total = total
+
+    def __enter__(self):
+        self.gate = _stage_gate(self.name) if _stage_gate is not None else None
+        if self.gate is not None:
+            self.gate.__enter__() # wait for the stage's resources. Not counted in its duration
+        _stage_start[self.name] = time.time()
+        emit("stage_start", stage=self.name, total=self.total)
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        duration = time.time() - _stage_start.pop(self.name, time.time())
+        _last_progress.pop(self.name, None)
+        emit("stage_end", stage=self.name, duration=round(duration, 3), ok=exc_type is None)
+        if self.gate is not None:
+            self.gate.__exit__(exc_type, exc, tb) # give the resources back
+        return False # Don't swallow errors
+
+# Function to emit a progress event. Rate (items/s) and ETA are taken from the start of the stage
+def progress(stage_name, done, total=None, unit="items", force=False):
+    now = time.time()
+    start = _stage_start.get(stage_name, _run_start)
+    if not force and now - _last_progress.get(stage_name, 0) < progress_interval:
+        return None # Don't flood the stream socket
+    _last_progress[stage_name] = now
+
+    rate = done / (now - start) if now > start else None
+    eta = (total - done) / rate if (total is not None and rate) else None
+    return emit("progress", stage=stage_name, done=done, total=total, unit=unit,
+                fraction=round(done / total, 4) if total else None,
+                rate=round(rate, 1) if rate else None, eta=round(eta, 1) if eta is not None else None)
+
+# Function to wrap an iterable and emit progress events while it is consumed
+def track_progress(iterable, stage_name, total=None, unit="items", offset=0):
+    done = offset # items already done before this iterable
+    for item in iterable:
+        done += 1
+        progress(stage_name, done, total, unit)
+        yield item
+    progress(stage_name, done, total, unit, force=True)
+
+# Class to render events as a live progress display and keep a JSONL trace of the run
+class ProgressDisplay:
+    def __init__(self, trace_dir=None):
+        # Initialize by defining stuff
+        self.trace_file = None
+        self.progress_shown = False # True when the last thing printed is a progress bar (no newline)
+        if trace_dir is not None:
+            trace_dir = Path(trace_dir)
+            trace_dir.mkdir(parents=True, exist_ok=True)
+            trace_path = trace_dir / f"run_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.jsonl"
+            self.trace_file = open(trace_path, "a", encoding="utf-8")
+
+    def _newline(self):
+        # End the progress bar line before printing something else
+        if self.progress_shown:
+            sys.stdout.write("\n")
+            self.progress_shown = False
+
+    def line(self, text):
+        # Print a regular line of output
+        self._newline()
+        print(text)
+
+    def record(self, event):
+        # Write event to the trace without showing it
+        if self.trace_file is not None:
+            self.trace_file.write(json.dumps(event) + "\n")
+            self.trace_file.flush()
+
+    def handle(self, event):
+        # Write event to the trace and show it
+        self.record(event)
+
+        rss = f", RSS {event['rss_mb']:.0f} MB" if event.get("rss_mb") is not None else ""
+        if event["event"] == "stage_start":
+            self.line(f"[{datetime.datetime.now()}] [Stage] {event['stage']} started")
+        elif event["event"] == "stage_end":
+            status = "done" if event.get("ok", True) else "FAILED"
+            self.line(f"[{datetime.datetime.now()}] [Stage] {event['stage']} {status} in {event['duration']:.1f} s{rss}")
+        elif event["event"] == "progress":
+            if event.get("fraction") is not None:
+                width = 30
+                filled = int(width * event["fraction"])
+                bar = f"[{'#' * filled}{'.' * (width - filled)}] {100 * event['fraction']:5.1f}%"
+            else:
+                bar = f"{event['done']} {event['unit']}"
+            rate = f", {event['rate']:.0f} {event['unit']}/s" if event.get("rate") else ""
+            eta = f", ETA {event['eta']:.0f} s" if event.get("eta") is not None else ""
+            sys.stdout.write(f"\r    {event['stage']}: {bar}{rate}{eta}{rss}   ")
+            sys.stdout.flush()
+            self.progress_shown = True
+        else:
+            self.line(f"[{datetime.datetime.now()}] [{event['event']}] {event}")
+
+    def close(self):
+        self._newline()
+        if self.trace_file is not None:
+            self.trace_file.close()
+            self.trace_file = None
@@ -2,16 +2,20 @@
 
 ## Import necessary packages
 import nibabel as nib
-from dipy.io.image import load_nifti
-from rt_utils import RTStructBuilder
 import numpy as np
 import shutil
+import pydicom
 import ants
 
 # Import necessary functions
 from Subscripts.Preliminaries import rs_get_paths, dicom_to_nifti, check_nifti_folder, get_fname
+from Subscripts.Registration_Utils import get_ct_to_mr_transform, transform_masks
+from Subscripts.Mask_Utils import labels_to_masks, save_masks, has_masks, load_masks
+from Subscripts.RTStruct_Utils import rasterize_rois, get_roi_names
+from Subscripts.Profile_Utils import profiled
 
 # Check if necessary folders exist and if they contain files required
+@profiled
 def rs_folders(base_dir):
     # Define Paths
     rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
@@ -82,6 +86,7 @@ def rs_folders(base_dir):
             print("Located files and created necessary folders successfully.")
 
 # Load necessary ROIs
+@profiled
 def load_rois(base_dir):
 
     # Define folders/paths
@@ -89,66 +94,47 @@ def load_rois(base_dir):
     rs_ct_dcm_dir = rs_dir / "CT_DICOM" # Folder containg RS CT DICOM exports
     rs_mr_dcm_dir = rs_dir / "MR_DICOM" # Folder containing RS MR DICOM exports
     rs_rois_dir = rs_dir / "ROIs" # Folder containing RS ROIs (in RT struct)
-    rs_rois_nii_dir = rs_dir / "ROIs_NIfTI" # Folder containing RS ROIs in NIfTI
-    rs_rois_nii_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
-    gtv_mask_nii_path = rs_rois_nii_dir / "gtv_mask.nii.gz" # define file path
-    external_mask_nii_path = rs_rois_nii_dir / "external_mask.nii.gz" # define file path
-    brain_mask_nii_path = rs_rois_nii_dir / "brain_mask.nii.gz" # define file path
-
-    if gtv_mask_nii_path.is_file() and external_mask_nii_path.is_file() and brain_mask_nii_path.is_file():
-        # Get masks from pre-defined files
-        gtv_mask_nii = nib.load(gtv_mask_nii_path); gtv_mask = gtv_mask_nii.get_fdata()
-        external_mask_nii = nib.load(external_mask_nii_path); external_mask = external_mask_nii.get_fdata()
-        brain_mask_nii = nib.load(brain_mask_nii_path); brain_mask = brain_mask_nii.get_fdata()
+
+    if has_masks(base_dir, ["gtv", "external", "brain"]):
+        # Get masks from saved label volume (or mask files of older cases)
+        (gtv_mask, external_mask, brain_mask), _ = load_masks(base_dir, ["gtv", "external", "brain"], dtype=np.uint8)
         
     else:
-        # Using RT_Utils package
-
         # Get path for RT Struct with ROIs
         file_paths = rs_get_paths(rs_rois_dir)
         rt_struct_path = file_paths["RS_File_Paths"][0] # Should only be one RT Struct file
 
         # Load RTStruct
-        rtstruct = RTStructBuilder.create_from(dicom_series_path=rs_mr_dcm_dir, rt_struct_path=rt_struct_path) # use MR DICOM series
+        rtstruct = pydicom.dcmread(rt_struct_path)
 
         # List available ROI names
-        print(f"ROI Names: {rtstruct.get_roi_names()}")
+        roi_names = get_roi_names(rtstruct)
+        print(f"ROI Names: {roi_names}")
 
         # Choose ROI(s) to convert to NIfTI mask. Note that names must be exact
-        gtv_name = [name for name in rtstruct.get_roi_names() if "GTV" in name] # Get names that contain GTV
+        gtv_name = [name for name in roi_names if "GTV" in name] # Get names that contain GTV
         gtv_name = gtv_name[0] # Take first name from list of GTV names 
-        gtv_mask = rtstruct.get_roi_mask_by_name(gtv_name)  # 3D binary numpy array
-        gtv_mask = np.transpose(gtv_mask, (1, 0, 2)) # change to [x y z]
-        gtv_mask = gtv_mask[::-1, :, :] # flip x-axis to be proper for NIfTI
-
-        external_name = [name for name in rtstruct.get_roi_names() if "EXTERNAL" == name.upper()] # Get names that contain external
+        external_name = [name for name in roi_names if "EXTERNAL" == name.upper()] # Get names that contain external
         external_name = external_name[0] # Take first name from list of external names 
-        external_mask = rtstruct.get_roi_mask_by_name(external_name) # Get External
-        external_mask = np.transpose(external_mask, (1, 0, 2)) # change to [x y z]
-        external_mask = external_mask[::-1, :, :] # flip x-axis to be proper for NIfTI
-
-        brain_name = [name for name in rtstruct.get_roi_names() if "BRAIN" == name.upper()] # Get names that contain brain
+        brain_name = [name for name in roi_names if "BRAIN" == name.upper()] # Get names that contain brain
         brain_name = brain_name[0] # Take first name from list of brain names 
-        brain_mask = rtstruct.get_roi_mask_by_name("Brain") # Get Brain
-        brain_mask = np.transpose(brain_mask, (1, 0, 2)) # change to [x y z]
-        brain_mask = brain_mask[::-1, :, :] # flip x-axis to be proper for NIfTI
+
+        # Fill all ROIs on the MR DICOM series in one pass. Masks come out [x y z] with x-axis flipped for NIfTI
+        labels = rasterize_rois(rtstruct, rs_mr_dcm_dir, [gtv_name, external_name, brain_name])
+        gtv_mask, external_mask, brain_mask = labels_to_masks(labels, 3)
 
     return gtv_mask, external_mask, brain_mask
     
 # Interpolate ROIs from CT shape to MR shape if necessary. Return important parameters
-def roi_interp(base_dir, gtv_mask, external_mask, brain_mask, white_matter_mask, affine):
+# registration_mode is "full" or "fast" (see registration_modes in Registration_Utils)
+@profiled
+def roi_interp(base_dir, gtv_mask, external_mask, brain_mask, white_matter_mask, affine, registration_mode="full"):
 
     # Define folders/paths
     rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
     rs_ct_dcm_dir = rs_dir / "CT_DICOM" # Folder containg RS CT DICOM exports
     rs_mr_dcm_dir = rs_dir / "MR_DICOM" # Folder containing RS MR DICOM exports
     rs_rois_dir = rs_dir / "ROIs" # Folder containing RS ROIs (in RT struct)
-    rs_rois_nii_dir = rs_dir / "ROIs_NIfTI" # Folder containing RS ROIs in NIfTI
-    rs_rois_nii_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
-    gtv_mask_nii_path = rs_rois_nii_dir / "gtv_mask.nii.gz" # define file path
-    external_mask_nii_path = rs_rois_nii_dir / "external_mask.nii.gz" # define file path
-    brain_mask_nii_path = rs_rois_nii_dir / "brain_mask.nii.gz" # define file path
-    white_matter_mask_nii_path = rs_rois_nii_dir / "white_matter_mask.nii.gz" # define file path
 
     # First check if interpolation is needed. Flag is true when interpolation is needed
     interp_flag = True if gtv_mask.shape != white_matter_mask.shape else False
@@ -190,33 +176,23 @@ def roi_interp(base_dir, gtv_mask, external_mask, brain_mask, white_matter_mask,
         print("Converting from DICOM to NIfTI...")
         dicom_to_nifti(rs_mr_dcm_dir, rs_mr_nii_dir)
 
-    # Get affine from CT NIfTI file
+    # Get CT NIfTI file
     if interp_flag:
         print("Getting file name...")
         rs_ct_nii_fname = get_fname(rs_ct_nii_dir) # Acquire file name for ct scan
         rs_ct_nii_fpath = str(rs_ct_nii_dir / (rs_ct_nii_fname + ".nii.gz")) 
 
-        # Extract affine
-        _, affine_ct= load_nifti(rs_ct_nii_fpath, return_img = False) # only care about affine here
-
     # Getting affine from MR no matter what
     print("Getting file name...")
     rs_mr_nii_fname = get_fname(rs_mr_nii_dir) # Acquire file name for ct scan
     rs_mr_nii_fpath = str(rs_mr_nii_dir / (rs_mr_nii_fname + ".nii.gz")) 
 
-    # Extract affine
-    _, affine_mr= load_nifti(rs_mr_nii_fpath, return_img = False) # only care about affine here
+    # Extract affine (header only, data isn't read)
+    affine_mr = nib.load(rs_mr_nii_fpath).affine
 
     # Make sure affine from diffusion MR same as RayStation MR
     assert np.allclose(affine_mr, affine, rtol=1e-03, atol=1e-05), "Affines from raw MR and RayStation MR are not matching."
 
-    # Save ROIs as NIfTI files (for ANTs in next step)
-    if interp_flag:
-        # Save masks to NIfTI files
-        nib.save(nib.Nifti1Image(gtv_mask.astype('uint8'), affine=affine_ct), gtv_mask_nii_path) # use same affine as from CT
-        nib.save(nib.Nifti1Image(external_mask.astype('uint8'), affine=affine_ct), external_mask_nii_path) # use same affine as from CT
-        nib.save(nib.Nifti1Image(brain_mask.astype('uint8'), affine=affine_ct), brain_mask_nii_path) # use same affine as from CT
-
     # Create image registration from CT to MR using ANTs
     if interp_flag:
         # Use ANTs to transform masks from CR to MR space
@@ -224,25 +200,19 @@ def roi_interp(base_dir, gtv_mask, external_mask, brain_mask, white_matter_mask,
         # First read NIfTI files with ANTs
         ct_ants = ants.image_read(str(rs_ct_nii_fpath))
         mr_ants = ants.image_read(str(rs_mr_nii_fpath)) # MR file exported from RayStation. NOT raw MR diffusion imaging
-        gtv_mask_ants_ct = ants.image_read(str(gtv_mask_nii_path))
-        external_mask_ants_ct = ants.image_read(str(external_mask_nii_path))
-        brain_mask_ants_ct = ants.image_read(str(brain_mask_nii_path))
-
-        # Register CT to MR
-        reg = ants.registration(fixed=mr_ants, moving=ct_ants, type_of_transform='Rigid')
-
-        # Apply transform to masks
-        gtv_mask_ants_mr = ants.apply_transforms(fixed=mr_ants, moving=gtv_mask_ants_ct, 
-                                                transformlist=reg['fwdtransforms'], interpolator='nearestNeighbor')
-        external_mask_ants_mr = ants.apply_transforms(fixed=mr_ants, moving=external_mask_ants_ct, 
-                                                transformlist=reg['fwdtransforms'], interpolator='nearestNeighbor')
-        brain_mask_ants_mr = ants.apply_transforms(fixed=mr_ants, moving=brain_mask_ants_ct, 
-                                                transformlist=reg['fwdtransforms'], interpolator='nearestNeighbor')
-        
-        # Get masks from ants variables
-        gtv_mask = gtv_mask_ants_mr.numpy()[:,::-1,:] # reverse y axis to be aligned with white matter
-        external_mask = external_mask_ants_mr.numpy()[:,::-1,:] # reverse y axis to be aligned with white matter
-        brain_mask = brain_mask_ants_mr.numpy()[:,::-1,:] # reverse y axis to be aligned with white matter
+
+        # Register CT to MR (or reuse transform saved for these images)
+        transformlist = get_ct_to_mr_transform(base_dir, ct_ants, mr_ants, rs_ct_nii_fpath, rs_mr_nii_fpath,
+                                               type_of_transform='Rigid', mode=registration_mode)
+
+        # Apply transform to all masks at once (masks are on the CT grid, so they get the CT header)
+        gtv_mask, external_mask, brain_mask = transform_masks([gtv_mask, external_mask, brain_mask], ct_ants, mr_ants,
+                                                              transformlist)
+
+        # Reverse y axis to be aligned with white matter
+        gtv_mask = gtv_mask[:,::-1,:]
+        external_mask = external_mask[:,::-1,:]
+        brain_mask = brain_mask[:,::-1,:]
 
         # Interpolation no longer needed
         interp_flag = False
@@ -254,28 +224,19 @@ def roi_interp(base_dir, gtv_mask, external_mask, brain_mask, white_matter_mask,
     # Create mask overlapping WM with GTV
     gtv_wm_mask = gtv_mask.astype(bool) & white_matter_mask.astype(bool)
 
-    # Save ROIs as NIfTI files (for good now)
-    # Save masks to NIfTI files
-    nib.save(nib.Nifti1Image(gtv_mask.astype('uint8'), affine=affine_mr), gtv_mask_nii_path) # use same affine as from MR
-    nib.save(nib.Nifti1Image(external_mask.astype('uint8'), affine=affine_mr), external_mask_nii_path) # use same affine as from MR
-    nib.save(nib.Nifti1Image(brain_mask.astype('uint8'), affine=affine_mr), brain_mask_nii_path) # use same affine as from MR
-    nib.save(nib.Nifti1Image(white_matter_mask.astype('uint8'), affine=affine_mr), white_matter_mask_nii_path) # use same affine as from MR
+    # Save ROIs as one label volume in ROIs_NIfTI (for good now)
+    save_masks(base_dir, [gtv_mask, external_mask, brain_mask, white_matter_mask], affine_mr) # use same affine as from MR
 
     return gtv_mask, external_mask, brain_mask, white_matter_mask, gtv_wm_mask 
 
 # Load white matter mask if it exists
+@profiled
 def get_white_matter_mask(base_dir):
-    # Define path
-    rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
-    rs_rois_nii_dir = rs_dir / "ROIs_NIfTI"
-    white_matter_mask_nii_path = rs_rois_nii_dir / "white_matter_mask.nii.gz" # define file path
-
-    if white_matter_mask_nii_path.is_file():
+    if has_masks(base_dir, ["white_matter"]):
         # Load white matter mask
-        white_matter_mask_nii = nib.load(white_matter_mask_nii_path); white_matter_mask = white_matter_mask_nii.get_fdata()
+        (white_matter_mask,), _ = load_masks(base_dir, ["white_matter"], dtype=np.uint8)
         print("[OK] White matter mask located and loaded.")
         return white_matter_mask
     else:
         print("[WARNING] White matter mask not found.")
         return np.array([]) # return empty array
-    
@@ -0,0 +1,201 @@
+# Functions for turning RT Struct contours into masks on an image series
+
+## Import necessary packages
+import numpy as np
+import pydicom
+
+# Function to read geometry of every slice of a DICOM series (pixel data isn't read)
+# Slices are sorted along the slice normal, same as rt_utils
+def load_series_geometry(dcm_dir):
+    slices = []
+    for file in dcm_dir.glob("*.dcm"):
+        try:
+            ds = pydicom.dcmread(file, stop_before_pixels=True)
+            slices.append({
+                "uid": str(ds.SOPInstanceUID),
+                "position": np.array(ds.ImagePositionPatient, dtype=np.float64),
+                "orientation": np.array(ds.ImageOrientationPatient, dtype=np.float64),
+                "spacing": np.array(ds.PixelSpacing, dtype=np.float64), # [between rows, between columns]
+                "rows": int(ds.Rows), "columns": int(ds.Columns)
+            })
+        except Exception:
+            continue # Not an image slice
+
+    if not slices:
+        raise ValueError(f"No image slices found in {dcm_dir}")
+
+    normal = np.cross(slices[0]["orientation"][:3], slices[0]["orientation"][3:])
+    for series_slice in slices:
+        series_slice["normal_position"] = float(np.dot(normal, series_slice["position"]))
+    return sorted(slices, key=lambda series_slice: series_slice["normal_position"])
+
+# Function to get names of ROIs in an RT Struct
+def get_roi_names(rtstruct):
+    return [str(roi.ROIName) for roi in rtstruct.StructureSetROISequence]
+
+# Function to clip edges (rounded end points [column, row]) to a rows x columns slice, same as cv2.clipLine
+# Ends outside the slice are moved onto its top/bottom side first and then onto its left/right side (truncating)
+def clip_edges(starts, ends, rows, columns):
+    starts, ends = starts.astype(np.int64), ends.astype(np.int64)
+    right, bottom = columns - 1, rows - 1
+    x1, y1, x2, y2 = starts[:, 0].copy(), starts[:, 1].copy(), ends[:, 0].copy(), ends[:, 1].copy()
+    outside_codes = lambda x, y: (x < 0) * 1 + (x > right) * 2 + (y < 0) * 4 + (y > bottom) * 8
+    c1, c2 = outside_codes(x1, y1), outside_codes(x2, y2)
+    clip = ((c1 & c2) == 0) & ((c1 | c2) != 0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        # Onto the top or bottom side
+        move = clip & ((c1 & 12) != 0)
+        a = np.where(c1 < 8, 0, bottom)
+        x1 = np.where(move, x1 + np.trunc((a - y1) * (x2 - x1) / (y2 - y1)).astype(np.int64), x1)
+        y1 = np.where(move, a, y1)
+        c1 = np.where(move, outside_codes(x1, y1) & 3, c1)
+        move = clip & ((c2 & 12) != 0)
+        a = np.where(c2 < 8, 0, bottom)
+        x2 = np.where(move, x2 + np.trunc((a - y2) * (x2 - x1) / (y2 - y1)).astype(np.int64), x2)
+        y2 = np.where(move, a, y2)
+        c2 = np.where(move, outside_codes(x2, y2) & 3, c2)
+
+        # Onto the left or right side
+        clip &= ((c1 & c2) == 0) & ((c1 | c2) != 0)
+        move = clip & (c1 != 0)
+        a = np.where(c1 == 1, 0, right)
+        y1 = np.where(move, y1 + np.trunc((a - x1) * (y2 - y1) / (x2 - x1)).astype(np.int64), y1)
+        x1 = np.where(move, a, x1)
+        c1 = np.where(move, 0, c1)
+        move = clip & (c2 != 0)
+        a = np.where(c2 == 1, 0, right)
+        y2 = np.where(move, y2 + np.trunc((a - x2) * (y2 - y1) / (x2 - x1)).astype(np.int64), y2)
+        x2 = np.where(move, a, x2)
+        c2 = np.where(move, 0, c2)
+
+    keep = (c1 | c2) == 0 # edges entirely outside the slice draw nothing
+    return np.stack([x1, y1], axis=1)[keep], np.stack([x2, y2], axis=1)[keep]
+
+# Function to mark the pixels along the edges of polygons (rounded vertices), like cv2's 8-connected lines:
+# clipped to the slice, drawn left to right, one pixel per step along the longer axis, stepping along the shorter one
+# when Bresenham's error term says so
+def outline_pixels(starts, ends, rows, columns):
+    starts, ends = clip_edges(starts, ends, rows, columns)
+    flip = ends[:, 0] < starts[:, 0]
+    starts, ends = np.where(flip[:, None], ends, starts), np.where(flip[:, None], starts, ends)
+    delta = (ends - starts).astype(np.int64)
+    major = (np.abs(delta[:, 1]) > np.abs(delta[:, 0])).astype(np.int64) # axis with more pixels (x on ties)
+    edges = np.arange(len(delta))
+    d_major = np.abs(delta[edges, major]); d_minor = np.abs(delta[edges, 1 - major])
+
+    # Pixel k of an edge moves k along the major axis and ceil((2 d_minor k - d_major) / (2 d_major)) along the other
+    edge = np.repeat(edges, d_major + 1)
+    k = np.arange(edge.size) - np.repeat(np.cumsum(d_major + 1) - (d_major + 1), d_major + 1)
+    minor_k = -((d_major[edge] - 2 * d_minor[edge] * k) // np.maximum(2 * d_major[edge], 1))
+    points = starts[edge].astype(np.int64)
+    points[np.arange(edge.size), major[edge]] += k * np.sign(delta[edge, major[edge]])
+    points[np.arange(edge.size), 1 - major[edge]] += minor_k * np.sign(delta[edge, 1 - major[edge]])
+    inside = (points[:, 0] >= 0) & (points[:, 0] < columns) & (points[:, 1] >= 0) & (points[:, 1] < rows)
+    return points[inside, 1], points[inside, 0]
+
+# Function to fill polygons (list of (N,2) arrays of [column, row] pixel coordinates) on a rows x columns slice
+# Same as rt_utils (cv2.fillPoly): vertices are rounded to pixels, the inside is filled with the even-odd rule (holes,
+# i.e. contours inside contours, are left empty) and pixels on the edges are filled too
+def fill_polygons(polygons, rows, columns):
+    polygons = [np.around(polygon).astype(np.int64) for polygon in polygons]
+
+    # Edges of every polygon (last point connects back to the first)
+    starts = np.concatenate(polygons)
+    ends = np.concatenate([np.roll(polygon, -1, axis=0) for polygon in polygons])
+    slice_mask = np.zeros((rows, columns), dtype=bool)
+    slice_mask[outline_pixels(starts, ends, rows, columns)] = True
+
+    # Rows the polygons span
+    row_min = max(int(min(starts[:, 1].min(), ends[:, 1].min())), 0)
+    row_max = min(int(max(starts[:, 1].max(), ends[:, 1].max())), rows - 1)
+    if row_max < row_min:
+        return slice_mask
+    scan_rows = np.arange(row_min, row_max + 1, dtype=np.int64)[:, None]
+
+    # Crossings of every row with every edge. Half-open rule (upper end in, lower end out) so vertices count once
+    # (the rows on the lower ends are filled by the outline)
+    top = np.where((starts[:, 1] <= ends[:, 1])[:, None], starts, ends)
+    bottom = np.where((starts[:, 1] <= ends[:, 1])[:, None], ends, starts)
+    height = bottom[:, 1] - top[:, 1]
+    crosses = (top[:, 1] <= scan_rows) & (scan_rows < bottom[:, 1])
+    # Same fixed point arithmetic as cv2 (16 fractional bits, slope truncated towards zero), so both ends of a run
+    # land on the same pixels
+    width = (bottom[:, 0] - top[:, 0]) << 16
+    slope = np.sign(width) * (np.abs(width) // np.maximum(height, 1))
+    crossing_x = (top[:, 0] << 16) + (scan_rows - top[:, 1]) * slope
+    crossing_x = np.sort(np.where(crosses, crossing_x, np.iinfo(np.int64).max), axis=1) # non-crossings sorted to the end
+
+    # Pair crossings (1st with 2nd, 3rd with 4th, ...) and fill the pixels between them using a difference array
+    n_pairs = crosses.sum(axis=1).max() // 2
+    if n_pairs == 0:
+        return slice_mask
+    valid = np.arange(n_pairs) < (crosses.sum(axis=1) // 2)[:, None]
+    first = np.clip((crossing_x[:, 0:2 * n_pairs:2][valid] + (1 << 16) - 1) >> 16, 0, columns) # rounded up
+    last = np.clip((crossing_x[:, 1:2 * n_pairs:2][valid] >> 16) + 1, 0, columns) # rounded down, inclusive
+    row_idx = np.broadcast_to(np.arange(scan_rows.shape[0])[:, None], valid.shape)[valid]
+    keep = last > first
+    diff = np.zeros((scan_rows.shape[0], columns + 1), dtype=np.int32)
+    np.add.at(diff, (row_idx[keep], first[keep]), 1)
+    np.add.at(diff, (row_idx[keep], last[keep]), -1)
+    slice_mask[row_min:row_max + 1] |= np.cumsum(diff[:, :columns], axis=1) > 0
+    return slice_mask
+
+# Function to fill several ROIs of an RT Struct (pydicom dataset) into one label volume in a single pass over its contours
+# Bit i of the label volume is roi_names[i]. Volume is [x y z] with x flipped (same as the masks load_rois used to make
+# from rt_utils with a transpose and flip), written straight into place without copies of the full volume
+def rasterize_rois(rtstruct, dcm_dir, roi_names):
+    if len(roi_names) > 8:
+        raise ValueError("At most 8 ROIs fit in a uint8 label volume.")
+
+    slices = load_series_geometry(dcm_dir)
+    slice_index = {series_slice["uid"]: i for i, series_slice in enumerate(slices)}
+    normal_positions = np.array([series_slice["normal_position"] for series_slice in slices])
+    rows, columns = slices[0]["rows"], slices[0]["columns"]
+    orientation = slices[0]["orientation"]
+    row_direction, column_direction = orientation[:3], orientation[3:] # along a row (increasing column), along a column
+    normal = np.cross(row_direction, column_direction)
+    # Contours further than half a slice from every slice (without a referenced image) belong to none of them
+    slice_spacing = np.median(np.diff(normal_positions)) if len(slices) > 1 else np.inf
+
+    # ROI numbers of requested ROIs
+    roi_numbers = {int(roi.ROINumber): str(roi.ROIName) for roi in rtstruct.StructureSetROISequence}
+    bits = {name: bit for bit, name in enumerate(roi_names)}
+
+    labels = np.zeros((columns, rows, len(slices)), dtype=np.uint8)
+    for roi_contour in rtstruct.ROIContourSequence:
+        name = roi_numbers.get(int(roi_contour.ReferencedROINumber))
+        if name not in bits:
+            continue
+
+        # Group contours by slice
+        slice_polygons = {}
+        for contour in getattr(roi_contour, "ContourSequence", []):
+            points = np.array(contour.ContourData, dtype=np.float64).reshape(-1, 3)
+            if len(points) < 3:
+                continue # Points and lines have no area
+
+            # Slice from referenced image, or nearest slice if the contour doesn't reference one
+            referenced = getattr(contour, "ContourImageSequence", None)
+            uid = str(referenced[0].ReferencedSOPInstanceUID) if referenced else None
+            if uid in slice_index:
+                k = slice_index[uid]
+            else:
+                distances = np.abs(normal_positions - np.dot(normal, points[0]))
+                k = int(np.argmin(distances))
+                if distances[k] > slice_spacing / 2:
+                    print(f"[WARNING] Skipping contour of {name} {distances[k]:.1f} mm away from the nearest slice.")
+                    continue
+
+            # Patient coordinates (mm) to pixel coordinates [column, row]
+            offset = points - slices[k]["position"]
+            pixel_points = np.stack([offset @ row_direction / slices[k]["spacing"][1],
+                                     offset @ column_direction / slices[k]["spacing"][0]], axis=1)
+            slice_polygons.setdefault(k, []).append(pixel_points)
+
+        # Fill slices and write them flipped along x into the label volume
+        for k, polygons in slice_polygons.items():
+            slice_mask = fill_polygons(polygons, rows, columns)
+            labels[::-1, :, k] |= slice_mask.T.astype(np.uint8) << bits[name]
+
+    return labels
@@ -0,0 +1,119 @@
+# Functions for registering CT to MR with ANTs and moving masks between them
+
+## Import necessary packages
+import hashlib
+import shutil
+from pathlib import Path
+import numpy as np
+import pydicom
+import ants
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Mask_Utils import masks_to_labels, labels_to_masks
+
+# Registration settings per mode. "full" uses the ANTs defaults
+# "fast" stops the pyramid at half resolution, samples 10% of voxels for the metric and starts from the DICOM geometry
+registration_modes = {
+    "full": {"dicom_init": False, "ants": {}},
+    "fast": {"dicom_init": True, "ants": {"aff_shrink_factors": (8, 4, 2), "aff_smoothing_sigmas": (3, 2, 1),
+                                          "aff_iterations": (1000, 500, 250), "aff_random_sampling_rate": 0.1}}
+}
+
+# Function to define folder holding saved transforms
+def registration_dir(base_dir):
+    return base_dir / "RayStation" / "Registration"
+
+# Function to get the series instance UID of a DICOM folder (from the first readable file)
+def series_uid(dcm_dir):
+    for file in sorted(dcm_dir.glob("*.dcm")):
+        try:
+            return str(pydicom.dcmread(file, stop_before_pixels=True).SeriesInstanceUID)
+        except Exception:
+            continue # Not a valid DICOM. Try next file
+    return ""
+
+# Function to get the frame of reference UID of a DICOM folder (from the first readable file)
+def frame_of_reference_uid(dcm_dir):
+    for file in sorted(dcm_dir.glob("*.dcm")):
+        try:
+            return str(pydicom.dcmread(file, stop_before_pixels=True).FrameOfReferenceUID)
+        except Exception:
+            continue # Not a valid DICOM or no frame of reference. Try next file
+    return ""
+
+# Function to hash the content of a file
+def file_hash(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+# Function to make the key of a CT to MR transform. Changes if either series, its NIfTI conversion or the settings change
+def transform_key(ct_dcm_dir, mr_dcm_dir, ct_nii_path, mr_nii_path, type_of_transform, mode):
+    digest = hashlib.sha256()
+    for part in [series_uid(ct_dcm_dir), series_uid(mr_dcm_dir), file_hash(ct_nii_path), file_hash(mr_nii_path),
+                 type_of_transform, mode]:
+        digest.update(f"{part}\n".encode('utf-8'))
+    return digest.hexdigest()
+
+# Function to write an identity transform to start registration from
+# Images in the same DICOM frame of reference are already aligned by their ImagePositionPatient/ImageOrientationPatient
+# (kept in the NIfTI header), so this is a better start than the ANTs default of aligning centres of mass
+def identity_transform(path):
+    ants.write_transform(ants.new_ants_transform(precision='float', dimension=3, transform_type='AffineTransform'),
+                         str(path))
+    return str(path)
+
+# Function to register CT to MR in the given mode. initial_transform is a transform file to start from (None for ANTs default)
+def register_ct_to_mr(ct_ants, mr_ants, type_of_transform='Rigid', mode='full', initial_transform=None):
+    return ants.registration(fixed=mr_ants, moving=ct_ants, type_of_transform=type_of_transform,
+                             initial_transform=initial_transform, **registration_modes[mode]["ants"])
+
+# Function to get the transform from CT to MR. Registration is only run if no transform was saved for these images
+def get_ct_to_mr_transform(base_dir, ct_ants, mr_ants, ct_nii_path, mr_nii_path, type_of_transform='Rigid', mode='full'):
+    rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
+    key = transform_key(rs_dir / "CT_DICOM", rs_dir / "MR_DICOM", ct_nii_path, mr_nii_path, type_of_transform, mode)
+    transform_path = registration_dir(base_dir) / f"ct_to_mr_{key[:16]}.mat"
+
+    if transform_path.is_file():
+        print(f"[OK] Using saved CT to MR transform {transform_path.name}.")
+        return [str(transform_path)]
+
+    registration_dir(base_dir).mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+
+    # Start from DICOM geometry if both series share a frame of reference
+    initial_transform = None
+    if registration_modes[mode]["dicom_init"]:
+        ct_for_uid = frame_of_reference_uid(rs_dir / "CT_DICOM")
+        if ct_for_uid and ct_for_uid == frame_of_reference_uid(rs_dir / "MR_DICOM"):
+            initial_transform = identity_transform(registration_dir(base_dir) / "identity.mat")
+        else:
+            print("[WARNING] CT and MR are in different frames of reference. Starting registration from centres of mass.")
+
+    # Register CT to MR (the identity transform is only needed while registering)
+    print(f"Registering CT to MR ({mode} mode)...")
+    try:
+        reg = register_ct_to_mr(ct_ants, mr_ants, type_of_transform=type_of_transform, mode=mode,
+                                initial_transform=initial_transform)
+    finally:
+        if initial_transform is not None:
+            Path(initial_transform).unlink(missing_ok=True)
+
+    # Save transform (replaces transforms of older images)
+    for old_path in registration_dir(base_dir).glob("ct_to_mr_*.mat"):
+        old_path.unlink()
+    with atomic_path(transform_path) as tmp_path:
+        shutil.copyfile(reg['fwdtransforms'][0], tmp_path) # rigid registration gives a single affine transform file
+    return [str(transform_path)]
+
+# Function to move masks from CT to MR space in one pass. Masks must be on the CT grid
+# Nearest neighbour interpolation keeps label values intact, so every mask comes back exactly as separate transforms would give
+def transform_masks(masks, ct_ants, mr_ants, transformlist):
+    labels = masks_to_labels(masks)
+    labels_ants_ct = ants.from_numpy(labels.astype(np.float32), origin=ct_ants.origin, spacing=ct_ants.spacing,
+                                     direction=ct_ants.direction) # same header as CT
+    labels_ants_mr = ants.apply_transforms(fixed=mr_ants, moving=labels_ants_ct, transformlist=transformlist,
+                                           interpolator='nearestNeighbor')
+    return labels_to_masks(np.rint(labels_ants_mr.numpy()).astype(np.uint8), len(masks))
@@ -0,0 +1,271 @@
+# Resource-aware scheduling of pipeline stages for batch runs (see PrimitiveTractography_Batch.py)
+# Every stage has a core and memory footprint. Before a stage starts, its worker takes that many cores and GB from a
+# budget shared by all workers, and waits while they aren't free. Small stages of other cases fill in around big ones,
+# so several cases run at once without more threads than cores or more memory than the machine has
+# Threads used inside a stage (BLAS, tracking) are limited to the cores it got
+
+## Import necessary packages
+import os
+import time
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+from contextlib import contextmanager, nullcontext
+
+# Import necessary functions
+from Subscripts import Tracking_Engines
+from Subscripts.Progress_Utils import emit, set_stage_gate
+
+# threadpoolctl is optional. Without it, BLAS threads stay at the worker's limit (see set_worker_threads) in every stage
+try:
+    from threadpoolctl import threadpool_limits
+except ImportError:
+    threadpool_limits = None
+
+# psutil is optional. Without it, there is no memory budget unless one is given
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+# Footprint of each stage: cores it uses, and memory (GB) it peaks at, as a fixed part plus a multiple of the size of
+# the DWI (GB, as float32). Cores are capped to the budget. Stages not listed use default_footprint
+# Compare with peak_rss_mb and stage times in the batch summary to adjust them to a machine
+stage_footprints = {
+    "dicom_to_nifti": {"cores": 1, "memory_gb": 1.0, "per_dwi": 0},
+    "get_tracts": {"cores": 1, "memory_gb": 2.0, "per_dwi": 0},
+    "get_data": {"cores": 1, "memory_gb": 0.5, "per_dwi": 2}, # float data, then masked copy
+    "get_wm_mask": {"cores": 4, "memory_gb": 0.5, "per_dwi": 3}, # TensorModel fit (BLAS)
+    "load_rois": {"cores": 1, "memory_gb": 1.0, "per_dwi": 1},
+    "roi_interp": {"cores": 4, "memory_gb": 3.0, "per_dwi": 1}, # ANTs registration (ITK threads)
+    "csa_and_sc": {"cores": 4, "memory_gb": 1.0, "per_dwi": 4}, # CSA fit (BLAS) and peaks
+    "seed_gen": {"cores": 1, "memory_gb": 0.5, "per_dwi": 1},
+    "streamline_gen": {"cores": 8, "memory_gb": 2.0, "per_dwi": 2}, # tracking threads
+    "save_tracts": {"cores": 1, "memory_gb": 2.0, "per_dwi": 1},
+    "get_wmpl": {"cores": 1, "memory_gb": 2.0, "per_dwi": 0},
+    "save_wmpl_dicom": {"cores": 1, "memory_gb": 0.5, "per_dwi": 0},
+    "qa_snapshots": {"cores": 3, "memory_gb": 3.0, "per_dwi": 0}, # one process per view
+}
+default_footprint = {"cores": 1, "memory_gb": 1.0, "per_dwi": 0}
+
+# DWI size (GB) assumed before the case has been converted to NIfTI
+default_dwi_gb = 1.0
+
+# Fraction of available memory used as the budget when none is given
+memory_fraction = 0.9
+
+# Seconds a stage waits for resources before other stages stop starting until it fits (so big stages aren't starved)
+reservation_wait = 60
+
+# Environment variables of thread pools, read when the libraries load (so set before workers import them)
+blas_thread_vars = ["OMP_NUM_THREADS", "OPENBLAS_NUM_THREADS", "MKL_NUM_THREADS", "VECLIB_MAXIMUM_THREADS",
+                    "NUMEXPR_NUM_THREADS"]
+itk_thread_var = "ITK_GLOBAL_DEFAULT_NUMBER_OF_THREADS"
+
+# Broker of this worker process (set by init_worker)
+_broker = None
+
+# Function to get the default budget: every core, and memory_fraction of available memory (None if unknown)
+def default_budget():
+    cores = os.cpu_count() or 1
+    memory_gb = memory_fraction * psutil.virtual_memory().available / 2**30 if psutil is not None else None
+    return cores, memory_gb
+
+# Function to get the footprint (cores, GB) of a stage for a DWI of dwi_gb GB
+def stage_footprint(name, dwi_gb):
+    footprint = stage_footprints.get(name, default_footprint)
+    return footprint["cores"], footprint["memory_gb"] + footprint["per_dwi"] * dwi_gb
+
+# Function to get the size (GB, as float32) of the DWI of a case from its NIfTI header. None before conversion
+def dwi_size_gb(base_dir):
+    nifti_dir = Path(base_dir) / "NIfTI"
+    if not nifti_dir.is_dir():
+        return None
+    sizes = [float(np.prod(nib.load(path).header.get_data_shape())) * 4 / 2**30 for path in nifti_dir.glob("*.nii.gz")]
+    return max(sizes) if sizes else None
+
+# Function to set the thread counts of a worker's libraries, before the worker starts (inherited by it)
+# BLAS threads are the most any BLAS stage may get (threadpoolctl lowers them per stage), ITK threads what
+# registration gets
+def set_worker_threads(cores):
+    blas_threads = min(cores, max(stage_footprints[name]["cores"] for name in ["get_wm_mask", "csa_and_sc"]))
+    itk_threads = min(cores, stage_footprints["roi_interp"]["cores"])
+    for var in blas_thread_vars:
+        os.environ[var] = str(blas_threads)
+    os.environ[itk_thread_var] = str(itk_threads)
+    return blas_threads, itk_threads
+
+# Function to check if a Windows process is still running, without psutil
+# os.kill can't be used there: any signal terminates the process. Its exit code is read instead
+def windows_pid_alive(pid):
+    import ctypes
+    from ctypes import wintypes
+    kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+    kernel32.OpenProcess.restype = wintypes.HANDLE
+    kernel32.OpenProcess.argtypes = [wintypes.DWORD, wintypes.BOOL, wintypes.DWORD]
+    kernel32.GetExitCodeProcess.argtypes = [wintypes.HANDLE, ctypes.POINTER(wintypes.DWORD)]
+    kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+    process_query_limited_information = 0x1000
+    still_active = 259
+    error_access_denied = 5
+    handle = kernel32.OpenProcess(process_query_limited_information, False, pid)
+    if not handle:
+        return ctypes.get_last_error() == error_access_denied # Running, as another user
+    try:
+        exit_code = wintypes.DWORD()
+        if not kernel32.GetExitCodeProcess(handle, ctypes.byref(exit_code)):
+            return True # Can't tell, so its resources are kept
+        return exit_code.value == still_active
+    finally:
+        kernel32.CloseHandle(handle)
+
+# Function to check if a process is still running (zombies, dead but not collected yet, count as stopped)
+# Never sends a signal that could stop it (see windows_pid_alive)
+def pid_alive(pid):
+    if psutil is not None:
+        try:
+            return psutil.Process(pid).status() != psutil.STATUS_ZOMBIE
+        except psutil.NoSuchProcess:
+            return False
+    if os.name == "nt":
+        return windows_pid_alive(pid)
+    try: # Signal 0 only checks the process exists on POSIX
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass # Running, as another user
+    return True
+
+# Class for a budget of cores and memory shared by the workers of a batch
+# Made before the workers are started and handed to them (init_worker)
+# What each worker holds is kept by PID, so the resources of a worker which died (killed, out of memory...) are given
+# back the next time a stage waits, instead of being lost for the rest of the batch
+class ResourceBroker:
+    def __init__(self, context, cores, memory_gb=None):
+        # Initialize by defining stuff
+        self.cores = cores
+        self.memory_gb = memory_gb # None for no memory limit
+        self._condition = context.Condition()
+        self._free = context.Array("d", [cores, memory_gb or 0], lock=False) # guarded by _condition
+        self._reserved = context.Value("i", 0, lock=False) # PID of a worker whose stage waited too long
+        # Holdings as (PID, cores, GB) per slot (PID 0 for a free slot). Every holding has a core, so there are never
+        # more holdings than cores
+        self._slots = cores
+        self._held = context.Array("d", 3 * cores, lock=False) # guarded by _condition
+
+    def _find(self, pid):
+        # Slot of a PID (0 to find a free slot). None if there is none
+        for slot in range(self._slots):
+            if int(self._held[3 * slot]) == pid:
+                return slot
+        return None
+
+    def _reclaim(self):
+        # Give back what dead workers held, and drop their reservation. Call with _condition held
+        reclaimed = False
+        for slot in range(self._slots):
+            pid = int(self._held[3 * slot])
+            if pid and not pid_alive(pid):
+                self._free[0] += self._held[3 * slot + 1]
+                self._free[1] += self._held[3 * slot + 2]
+                self._held[3 * slot:3 * slot + 3] = [0, 0, 0]
+                reclaimed = True
+        if self._reserved.value and not pid_alive(self._reserved.value):
+            self._reserved.value = 0
+            reclaimed = True
+        if reclaimed:
+            self._condition.notify_all()
+
+    def fit(self, cores, memory_gb):
+        # Cap a request to the budget, so a stage bigger than the budget runs on its own instead of never
+        cores = max(1, min(cores, self.cores))
+        memory_gb = min(memory_gb, self.memory_gb) if self.memory_gb is not None else 0
+        return cores, memory_gb
+
+    def acquire(self, cores, memory_gb):
+        # Wait until cores and memory are free and take them. Returns what was taken and seconds waited
+        cores, memory_gb = self.fit(cores, memory_gb)
+        pid = os.getpid()
+        start = time.time()
+        with self._condition:
+            while True:
+                self._reclaim()
+                fits = self._free[0] >= cores - 1e-9 and self._free[1] >= memory_gb - 1e-9
+                if fits and self._reserved.value in (0, pid):
+                    break
+                if self._reserved.value == 0 and time.time() - start > reservation_wait:
+                    self._reserved.value = pid # other stages wait until this one has started
+                self._condition.wait(timeout=1.0)
+            if self._reserved.value == pid:
+                self._reserved.value = 0
+            self._free[0] -= cores
+            self._free[1] -= memory_gb
+            slot = self._find(pid)
+            slot = slot if slot is not None else self._find(0)
+            self._held[3 * slot] = pid
+            self._held[3 * slot + 1] += cores
+            self._held[3 * slot + 2] += memory_gb
+        return cores, memory_gb, time.time() - start
+
+    def release(self, cores, memory_gb):
+        # Give cores and memory back and wake up waiting workers
+        with self._condition:
+            self._free[0] += cores
+            self._free[1] += memory_gb
+            slot = self._find(os.getpid())
+            if slot is not None:
+                self._held[3 * slot + 1] -= cores
+                self._held[3 * slot + 2] -= memory_gb
+                if self._held[3 * slot + 1] < 0.5: # holds nothing any more
+                    self._held[3 * slot:3 * slot + 3] = [0, 0, 0]
+            self._condition.notify_all()
+
+# Context manager limiting the threads used inside a stage to its cores (BLAS with threadpoolctl, tracking threads)
+@contextmanager
+def thread_limits(cores):
+    tracking_threads = Tracking_Engines.tracking_threads
+    Tracking_Engines.tracking_threads = cores
+    try:
+        with threadpool_limits(limits=cores) if threadpool_limits is not None else nullcontext():
+            yield
+    finally:
+        Tracking_Engines.tracking_threads = tracking_threads
+
+# Context manager holding the resources of a stage while it runs
+@contextmanager
+def stage_resources(broker, name, dwi_gb):
+    cores, memory_gb, waited = broker.acquire(*stage_footprint(name, dwi_gb))
+    emit("stage_resources", stage=name, cores=cores, memory_gb=round(memory_gb, 2), waited=round(waited, 1))
+    try:
+        with thread_limits(cores):
+            yield
+    finally:
+        broker.release(cores, memory_gb)
+
+# Function to start a worker of a batch: keep the broker its stages take resources from
+def init_worker(broker):
+    global _broker
+    _broker = broker
+
+# Context manager scheduling the stages of a case run in this worker (nothing happens without a broker)
+@contextmanager
+def scheduled(base_dir):
+    if _broker is None:
+        yield
+        return
+    dwi_gb = {} # found once the case has NIfTI files
+
+    def gate(name):
+        if "size" not in dwi_gb:
+            size = dwi_size_gb(base_dir)
+            if size is None:
+                return stage_resources(_broker, name, default_dwi_gb)
+            dwi_gb["size"] = size
+        return stage_resources(_broker, name, dwi_gb["size"])
+
+    set_stage_gate(gate)
+    try:
+        yield
+    finally:
+        set_stage_gate(None)
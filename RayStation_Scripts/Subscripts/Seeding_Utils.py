@@ -0,0 +1,87 @@
+# Seeding strategies for white matter seeds, and a report of how many streamlines reach the GTV
+# WMPL only uses streamlines through the GTV, so seeds far from it are mostly wasted
+
+## Import necessary packages
+import numpy as np
+from scipy.ndimage import distance_transform_edt
+from dipy.tracking.utils import random_seeds_from_mask
+
+# Import necessary functions
+from Subscripts.Progress_Utils import emit
+from Subscripts.Streamline_Utils import touches_mask
+
+# Seeding strategies for white matter
+# "uniform": seeds_per_voxel seeds in every white matter voxel (as in the paper)
+# "gtv_proximal": full density within proximal_distance of the GTV, falling to far_density further away
+# "fa_weighted": density proportional to FA (mean density over white matter stays seeds_per_voxel)
+seeding_strategies = ["uniform", "gtv_proximal", "fa_weighted"]
+
+# Distance from the GTV (mm) seeded at full density ("gtv_proximal")
+proximal_distance = 20.0
+
+# Fraction of the full density far from the GTV ("gtv_proximal"). Density falls linearly over another proximal_distance
+far_density = 0.25
+
+# Seed for random numbers, so seeding is repeatable
+seeding_random_seed = 0
+
+# Function to get the seed density (seeds per voxel, may be fractional) of each white matter voxel
+# FA must be in the same orientation as the white matter mask
+def seed_density(strategy, white_matter_mask, gtv_mask, affine, seeds_per_voxel, FA=None):
+    white_matter = np.asarray(white_matter_mask) != 0
+    if strategy == "gtv_proximal":
+        gtv = np.asarray(gtv_mask) != 0
+        if not gtv.any():
+            return white_matter * float(seeds_per_voxel)
+        voxel_size = np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0))
+        distance = distance_transform_edt(~gtv, sampling=voxel_size) # mm to nearest GTV voxel
+        falloff = np.clip((distance - proximal_distance) / proximal_distance, 0, 1)
+        return white_matter * seeds_per_voxel * (1 - (1 - far_density) * falloff)
+    if strategy == "fa_weighted":
+        if FA is None:
+            raise ValueError("FA is needed for 'fa_weighted' seeding.")
+        weights = np.where(white_matter, FA, 0)
+        mean_weight = weights[white_matter].mean() if white_matter.any() else 1
+        return weights * (seeds_per_voxel / mean_weight)
+    raise ValueError(f"Unknown seeding strategy '{strategy}'. Use one of {seeding_strategies}.")
+
+# Function to place seeds from a density map. Fractional densities are rounded up or down at random
+# Seeds are spread uniformly within their voxel (like random_seeds_from_mask)
+def seeds_from_density(density, affine, rng):
+    counts = np.floor(density).astype(np.int64)
+    counts += rng.random(density.shape) < (density - counts)
+    voxels = np.repeat(np.argwhere(counts > 0), counts[counts > 0], axis=0).astype(np.float64)
+    voxels += rng.random(voxels.shape) - 0.5
+    return voxels @ np.asarray(affine)[:3, :3].T + np.asarray(affine)[:3, 3]
+
+# Function to keep at most max_seeds seeds (random subset)
+def cap_seeds(seeds, max_seeds, rng):
+    if max_seeds is None or len(seeds) <= max_seeds:
+        return seeds
+    print(f"Seed budget: keeping {max_seeds} of {len(seeds)} white matter seeds.")
+    return seeds[np.sort(rng.choice(len(seeds), max_seeds, replace=False))]
+
+# Function to make white matter seeds with a strategy. max_seeds caps their number (GTV seeds are never capped)
+def white_matter_seeds(strategy, white_matter_mask, gtv_mask, affine, seeds_per_voxel, FA=None, max_seeds=None):
+    rng = np.random.default_rng(seeding_random_seed)
+    if strategy == "uniform":
+        seeds = random_seeds_from_mask(white_matter_mask, affine, seeds_count=seeds_per_voxel, seed_count_per_voxel=True)
+    else:
+        seeds = seeds_from_density(seed_density(strategy, white_matter_mask, gtv_mask, affine, seeds_per_voxel, FA),
+                                   affine, rng)
+    return cap_seeds(seeds, max_seeds, rng)
+
+# Function to report how many streamlines pass through the GTV (the ones WMPL uses). Printed and sent as an event
+# counts are the white matter streamlines tracked and kept (see streamline_gen). When they were filtered to the GTV
+# while tracking, only the ones through the GTV are left, so hits are taken from the counts instead
+def gtv_hit_report(streamlines_wm, streamlines_gtv, gtv_mask, affine, strategy="uniform", counts=None):
+    if counts is not None and "kept" in counts:
+        tracked_wm, hits_wm = counts["tracked"], counts["kept"]
+    else:
+        tracked_wm, hits_wm = len(streamlines_wm), int(touches_mask(streamlines_wm, gtv_mask, affine).sum())
+    hits_gtv = int(touches_mask(streamlines_gtv, gtv_mask, affine).sum())
+    fraction = hits_wm / tracked_wm if tracked_wm else 0.0
+    print(f"{hits_wm} of {tracked_wm} white matter streamlines ({100 * fraction:.1f}%) pass through the GTV "
+          f"({strategy} seeding). {hits_gtv} of {len(streamlines_gtv)} GTV streamlines do.")
+    return emit("seeding_report", strategy=strategy, streamlines_wm=tracked_wm, gtv_hits_wm=hits_wm,
+                gtv_hit_fraction=round(fraction, 4), streamlines_gtv=len(streamlines_gtv), gtv_hits_gtv=hits_gtv)
@@ -0,0 +1,62 @@
+# Vectorized functions for streamlines against voxel masks
+# Work on all points at once (ArraySequence data), instead of looping over streamlines in Python
+
+## Import necessary packages
+import numpy as np
+import nibabel as nib
+from itertools import compress
+
+# Number of streamlines tested against a mask at once when filtering during tracking
+filter_batch_size = 10000
+
+# Function to get the points of streamlines as one (N, 3) array and the streamline each point belongs to
+def streamline_points(streamlines):
+    if hasattr(streamlines, "get_data"): # ArraySequence (Streamlines): points are stored together already
+        points = streamlines.get_data()
+        lengths = np.asarray(streamlines._lengths)
+    else:
+        lengths = np.array([len(s) for s in streamlines], dtype=np.int64)
+        points = np.concatenate(list(streamlines)) if len(streamlines) else np.zeros((0, 3))
+    owner = np.repeat(np.arange(len(lengths)), lengths)
+    return points, owner
+
+# Function to get the voxel each point falls in, rounded the way DiPy does it (path_length, streamline mapping)
+def voxel_coords(points, affine):
+    return np.floor(nib.affines.apply_affine(np.linalg.inv(affine), points) + 0.5).astype(np.int64)
+
+# Function to check which streamlines pass through a mask. Returns one bool per streamline
+# Points outside the volume count as outside the mask
+def touches_mask(streamlines, mask, affine):
+    n_streamlines = len(streamlines)
+    if n_streamlines == 0:
+        return np.zeros(0, dtype=bool)
+    points, owner = streamline_points(streamlines)
+    voxels = voxel_coords(points, affine)
+    inside = np.all((voxels >= 0) & (voxels < np.array(mask.shape[:3])), axis=1)
+    hits = np.zeros(len(points), dtype=bool)
+    hits[inside] = np.asarray(mask)[tuple(voxels[inside].T)] != 0
+    return np.bincount(owner[hits], minlength=n_streamlines) > 0
+
+# Function to filter streamlines while they are tracked, keeping those passing through a mask
+# Streamlines are tested in batches, so the ones dropped are never all held in memory
+# If counts (dictionary) is given, the number of streamlines tested ("tracked") and kept ("kept") are added to it
+def filter_touching(streamlines, mask, affine, batch_size=filter_batch_size, counts=None):
+    if counts is None:
+        counts = {}
+    counts.setdefault("tracked", 0)
+    counts.setdefault("kept", 0)
+
+    def keep(batch):
+        touching = touches_mask(batch, mask, affine)
+        counts["tracked"] += len(batch)
+        counts["kept"] += int(touching.sum())
+        return compress(batch, touching)
+
+    batch = []
+    for streamline in streamlines:
+        batch.append(streamline)
+        if len(batch) == batch_size:
+            yield from keep(batch)
+            batch = []
+    if batch:
+        yield from keep(batch)
@@ -0,0 +1,62 @@
+# Tracking engines which streamline_gen can use, with a common seed/stopping criterion interface
+# Every engine tracks from seed positions (world coordinates), stops with a stopping criterion and takes its directions
+# from the CSA peaks of csa_and_sc. Streamlines are yielded as they are tracked (on tracking_threads threads)
+
+## Import necessary packages
+import numpy as np
+from dipy.tracking.tracker import eudx_tracking, deterministic_tracking, probabilistic_tracking, pft_tracking # only available in recent DiPy
+from dipy.tracking.stopping_criterion import ThresholdStoppingCriterion, CmcStoppingCriterion
+
+# FA below which tracking stops (threshold stopping criterion)
+fa_threshold = 0.15 # paper uses FA, 0.15
+
+# Threads used for tracking. 0 uses all cores
+tracking_threads = 0
+
+# Tracking engines
+# function: DiPy tracker. options: passed to it. stopping: kind of stopping criterion the engine needs
+# directions: what of the CSA peaks the tracker gets, the peaks ("pam") or their SH coefficients ("sh")
+# "threshold" stops where FA < fa_threshold. "cmc" is the continuous map criterion particle filtering needs
+# (tissue maps made from FA and the brain mask, see make_stopping_criterion)
+tracking_engines = {
+    "eudx": {"function": eudx_tracking, "stopping": "threshold", "directions": "pam",
+             "options": {"step_size": 0.5, "max_angle": 60}}, # paper uses max_angle of 60
+    "deterministic": {"function": deterministic_tracking, "stopping": "threshold", "directions": "pam",
+                      "options": {"step_size": 0.5, "max_angle": 30}},
+    "probabilistic": {"function": probabilistic_tracking, "stopping": "threshold", "directions": "pam",
+                      "options": {"step_size": 0.5, "max_angle": 30}},
+    "pft": {"function": pft_tracking, "stopping": "cmc", "directions": "sh", # pft_tracking ignores pam
+            "options": {"step_size": 0.2, "max_angle": 20, "particle_count": 15}},
+}
+
+# Function to check an engine name
+def check_engine(engine):
+    if engine not in tracking_engines:
+        raise ValueError(f"Unknown tracking engine '{engine}'. Use one of {list(tracking_engines)}.")
+    return tracking_engines[engine]
+
+# Function to make the stopping criterion an engine needs
+# brain_mask and affine are only needed by "cmc" engines: white matter is FA >= fa_threshold, CSF is outside the brain
+# and the rest of the brain counts as grey matter (where particle filtering may end streamlines)
+def make_stopping_criterion(engine, FA, brain_mask=None, affine=None):
+    settings = check_engine(engine)
+    if settings["stopping"] == "threshold":
+        return ThresholdStoppingCriterion(FA, fa_threshold)
+
+    if brain_mask is None or affine is None:
+        raise ValueError(f"Tracking engine '{engine}' needs the brain mask and affine for its stopping criterion.")
+    brain = np.asarray(brain_mask) != 0
+    wm_map = (brain & (FA >= fa_threshold)).astype(np.float64)
+    csf_map = (~brain).astype(np.float64)
+    gm_map = 1.0 - wm_map - csf_map
+    voxel_size = np.sqrt((np.asarray(affine)[:3, :3] ** 2).sum(axis=0))
+    return CmcStoppingCriterion.from_pve(wm_map, gm_map, csf_map, step_size=settings["options"]["step_size"],
+                                         average_voxel_size=float(voxel_size.mean()))
+
+# Function to start tracking from seeds with an engine. Returns a generator of streamlines
+# Options given here override the engine's defaults
+def track(engine, seeds, stopping_criterion, affine, csa_peaks, **options):
+    settings = check_engine(engine)
+    options = {**settings["options"], "nbr_threads": tracking_threads, **options}
+    directions = {"pam": csa_peaks} if settings["directions"] == "pam" else {"sh": csa_peaks.shm_coeff}
+    return settings["function"](seeds, stopping_criterion, affine, **directions, **options)
@@ -0,0 +1,185 @@
+# Functions for a compressed cache of trk files (next to them, as .npz)
+# Streamlines are compressed (points on a straight line within tolerance are dropped) and stored as uint16 voxel
+# coordinates over the voxel extent of the tractogram. Decoding resamples them back to their original number of points,
+# so they can replace the trk streamlines everywhere (path_length marks voxels at points, so the point spacing matters for WMPL)
+
+## Import necessary packages
+import numpy as np
+import nibabel as nib
+from dipy.tracking.streamline import Streamlines
+from dipy.tracking.streamlinespeed import compress_streamlines
+from dipy.tracking.utils import path_length
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Streamline_Utils import touches_mask, streamline_points
+from Subscripts.Crop_Utils import streamlines_box, crop, crop_affine
+
+# Maximum distance (mm) between a compressed streamline and the original one
+# Voxels are only marked at points by path_length, so larger tolerances shift which voxels a streamline reaches
+# (0.05 mm failed the WMPL check on small phantoms). Kept above the quantization error (below)
+cache_tol_error = 0.005
+cache_max_segment_length = 10 # mm
+
+# Points are stored as uint16 steps over the voxel extent of the tractogram: extent / 65535 voxels per axis, which is
+# extent (voxels) x voxel size (mm, header zooms) / 65535 mm. Rounding moves a point by at most half a step per axis
+# (see quantization_error). A 128 voxel extent of 2 mm voxels (256 mm) gives 0.0039 mm steps, so points move at most
+# 0.0034 mm, below cache_tol_error. A cached streamline is within cache_tol_error + that of the original one
+quantization_levels = 2**16 - 1
+
+# Version of the cache format. Caches of other versions are made again
+cache_version = 2
+
+# WMPL difference (mm, 95th percentile over voxels) allowed between cached and original streamlines, and largest
+# fraction of voxels reached by one but not the other. The cache is dropped if it does worse
+# (not the maximum: a streamline grazing the GTV in one and missing it in the other restarts its whole path length)
+wmpl_tolerance = 1.0
+wmpl_reach_tolerance = 0.03
+
+# Number of streamlines through the GTV the WMPL check is done on (random subset, for speed)
+validation_streamlines = 2000
+
+# Function to define path of the cache of a trk file
+def cache_path(trk_path):
+    return trk_path.with_suffix(".npz")
+
+# Function to make the key of a trk file. The cache is only used for the trk file it was made from
+def trk_key(trk_path):
+    stat = trk_path.stat()
+    return f"{cache_version}|{trk_path.name}|{stat.st_size}|{stat.st_mtime_ns}"
+
+# Function to get the size (voxels) of one quantization step along each axis of a voxel extent
+def quantization_step(bounds):
+    return np.maximum(bounds[1] - bounds[0], 1e-6) / quantization_levels
+
+# Function to get the largest distance (mm) rounding to quantization steps moves a point, from the header zooms
+def quantization_error(bounds, affine):
+    step_mm = quantization_step(bounds) * nib.affines.voxel_sizes(affine)
+    return float(np.linalg.norm(step_mm / 2))
+
+# Function to compress streamlines into arrays (uint16 voxel coordinates over the voxel extent of the original points)
+# Decoded points never fall outside the volume the originals were in
+def encode_streamlines(streamlines, affine):
+    n_points = np.array([len(s) for s in streamlines], dtype=np.int32)
+    if len(streamlines) == 0: # no tracts (nothing reached the GTV). Empty cache
+        return {"points": np.zeros((0, 3), dtype=np.uint16), "lengths": np.zeros(0, dtype=np.int32),
+                "n_points": n_points, "bounds": np.zeros((2, 3))}
+    voxels = nib.affines.apply_affine(np.linalg.inv(affine), streamline_points(streamlines)[0])
+    bounds = np.stack([voxels.min(axis=0), voxels.max(axis=0)])
+    compressed = Streamlines(compress_streamlines(streamlines, tol_error=cache_tol_error,
+                                                  max_segment_length=cache_max_segment_length))
+    voxels = nib.affines.apply_affine(np.linalg.inv(affine), compressed.get_data())
+    steps = np.clip(np.around((voxels - bounds[0]) / quantization_step(bounds)), 0, quantization_levels)
+    return {"points": steps.astype(np.uint16), "lengths": np.asarray(compressed._lengths, dtype=np.int32),
+            "n_points": n_points, "bounds": bounds}
+
+# Function to resample every polyline to n_points points evenly spaced along it (all streamlines at once)
+def resample_streamlines(points, lengths, n_points):
+    n_streamlines = len(lengths)
+    if n_streamlines == 0:
+        return np.zeros((0, 3), dtype=np.float32)
+    points = np.asarray(points, dtype=np.float32)
+    starts = np.concatenate([[0], np.cumsum(lengths)[:-1]]).astype(np.int64)
+
+    # Segment from every point to the next (none from the end of one streamline to the start of the next)
+    delta = np.zeros_like(points)
+    delta[:-1] = np.diff(points, axis=0)
+    delta[starts[1:] - 1] = 0
+    segments = np.linalg.norm(delta, axis=1).astype(np.float64)
+    inverse = np.divide(1, segments, out=np.zeros_like(segments), where=segments > 0)
+
+    # Arc length of every point from the start of its streamline
+    arc = np.concatenate([[0], np.cumsum(segments[:-1])])
+    arc -= np.repeat(arc[starts], lengths)
+    total = arc[starts + lengths - 1]
+
+    # Streamlines laid end to end on one axis (spaced further apart than any is long), so one search finds the segment
+    # every new point falls on, for all streamlines and all three coordinates
+    spacing = total.max() + 1
+    offset = np.arange(n_streamlines) * spacing
+    source = arc + np.repeat(offset, lengths)
+    target_starts = np.concatenate([[0], np.cumsum(n_points)[:-1]]).astype(np.int64)
+    k = np.arange(n_points.sum()) - np.repeat(target_starts, n_points)
+    target = k * np.repeat(total / np.maximum(n_points - 1, 1), n_points) + np.repeat(offset, n_points)
+    left = np.clip(np.searchsorted(source, target, side="right") - 1, 0, len(source) - 1)
+    weight = np.clip((target - source[left]) * inverse[left], 0, 1).astype(np.float32)
+    return points[left] + weight[:, None] * delta[left]
+
+# Function to rebuild streamlines from cached arrays (original number of points per streamline)
+def decode_streamlines(cache):
+    bounds = cache["bounds"]
+    voxels = np.minimum(bounds[0] + cache["points"] * quantization_step(bounds), bounds[1]) # no rounding past the box
+    points = nib.affines.apply_affine(cache["affine"], voxels)
+    lengths = cache["lengths"].astype(np.int64)
+    n_points = cache["n_points"].astype(np.int64)
+    points = resample_streamlines(points, lengths, n_points)
+    streamlines = Streamlines()
+    streamlines._data = points
+    streamlines._offsets = (np.cumsum(n_points) - n_points).astype(np.int64)
+    streamlines._lengths = n_points
+    return streamlines
+
+# Function to save the cache of a trk file
+def save_tract_cache(trk_path, streamlines, affine):
+    encoded = encode_streamlines(streamlines, affine)
+    with atomic_path(cache_path(trk_path)) as tmp_path:
+        with open(tmp_path, "wb") as file: # file object so numpy doesn't change the name
+            np.savez(file, key=trk_key(trk_path), affine=np.asarray(affine, dtype=np.float64), **encoded)
+
+# Function to load streamlines from the cache of a trk file. None if there is no cache for this trk file
+def load_tract_cache(trk_path):
+    path = cache_path(trk_path)
+    if not path.is_file() or not trk_path.is_file():
+        return None
+    cache = np.load(path)
+    if str(cache["key"]) != trk_key(trk_path):
+        return None
+    return decode_streamlines(cache), cache["affine"]
+
+# Function to load streamlines and affine of a trk file, from its cache when there is one
+def load_tracts_file(trk_path):
+    cached = load_tract_cache(trk_path)
+    if cached is not None:
+        return cached
+    trk = nib.streamlines.load(trk_path)
+    return trk.streamlines, trk.affine
+
+# Function to compare WMPL from original and cached streamlines (on streamlines through the GTV)
+# Returns 95th percentile and largest difference (mm), and fraction of voxels reached by only one of them
+def wmpl_error(streamlines, cached, gtv_mask, affine):
+    through_gtv = np.flatnonzero(touches_mask(streamlines, gtv_mask, affine))
+    if len(through_gtv) == 0:
+        return 0.0, 0.0, 0.0
+    rng = np.random.default_rng(0)
+    if len(through_gtv) > validation_streamlines:
+        through_gtv = np.sort(rng.choice(through_gtv, validation_streamlines, replace=False))
+    original, decoded = streamlines[through_gtv], cached[through_gtv]
+
+    box = streamlines_box(Streamlines(list(original) + list(decoded)), affine, gtv_mask.shape)
+    wmpl_original = path_length(original, crop_affine(affine, box), crop(gtv_mask, box))
+    wmpl_cached = path_length(decoded, crop_affine(affine, box), crop(gtv_mask, box))
+    reached = (wmpl_original >= 0) | (wmpl_cached >= 0)
+    both = (wmpl_original >= 0) & (wmpl_cached >= 0)
+    errors = np.abs(wmpl_original - wmpl_cached)[both]
+    p95_error, max_error = (float(np.percentile(errors, 95)), float(errors.max())) if errors.size else (0.0, 0.0)
+    reach_error = float((reached & ~both).sum() / reached.sum()) if reached.any() else 0.0
+    return p95_error, max_error, reach_error
+
+# Function to make the cache of a trk file and check it against WMPL. The cache is removed if it is off by too much
+def make_tract_cache(trk_path, streamlines, affine, gtv_mask=None):
+    save_tract_cache(trk_path, streamlines, affine)
+    if gtv_mask is None:
+        return True
+
+    cached, _ = load_tract_cache(trk_path)
+    p95_error, max_error, reach_error = wmpl_error(streamlines, cached, gtv_mask, affine)
+    with np.load(cache_path(trk_path)) as cache:
+        rounding = quantization_error(cache["bounds"], affine)
+    summary = (f"points rounded by {rounding:.4f} mm at most, WMPL differs by {p95_error:.2f} mm (95th percentile, "
+               f"{max_error:.1f} mm at most), {100 * reach_error:.1f}% of voxels reached differently")
+    if p95_error > wmpl_tolerance or reach_error > wmpl_reach_tolerance:
+        print(f"[WARNING] Compressed tract cache not used: {summary}.")
+        cache_path(trk_path).unlink()
+        return False
+    print(f"[OK] Compressed tract cache saved: {summary}.")
+    return True
@@ -1,56 +1,78 @@
 # Tractography functions
 
 ## Import necessary packages
-import nibabel as nib
 from dipy.io import read_bvals_bvecs
 from dipy.core.gradients import gradient_table
 from dipy.io.image import load_nifti
 from dipy.reconst.shm import CsaOdfModel
 from dipy.direction import peaks_from_model
 from dipy.data import default_sphere
-from dipy.segment.mask import median_otsu
-from dipy.tracking.stopping_criterion import ThresholdStoppingCriterion
 from dipy.reconst.dti import TensorModel
 from dipy.tracking.utils import random_seeds_from_mask
 from dipy.tracking.streamline import Streamlines
-from dipy.tracking.tracker import eudx_tracking # only available in recent DiPy
-# from dipy.tracking.local_tracking import LocalTracking # Use LocalTracking to replace eudx_tracking in older DiPy
 from dipy.io.stateful_tractogram import Space, StatefulTractogram
 from dipy.io.streamline import save_trk
 import numpy as np
+import copy
+import shutil
 
 # Import necessary functions
 # from Subscripts.Preliminaries import load_nifti
+from Subscripts.Progress_Utils import track_progress, progress
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Profile_Utils import profiled
+from Subscripts.Brain_Mask_Utils import get_brain_mask, apply_mask_in_place
+from Subscripts.Volume_Utils import load_volume, MaskedVolume
+from Subscripts.Tracking_Engines import make_stopping_criterion, track
+from Subscripts.Seeding_Utils import white_matter_seeds
+from Subscripts.Streamline_Utils import filter_touching
+from Subscripts.Tract_Cache_Utils import make_tract_cache, load_tracts_file, cache_path
+from Subscripts.Mask_Utils import has_masks, load_masks
 
 # Create necessary functions
 
 # Function to extract data and perform segmentation
-def get_data(nifti_dir, fname):
+# mask_mode is "all" or "b0" (see brain_mask_modes in Brain_Mask_Utils)
+# memmap=True memory-maps an uncompressed copy of the DWI (made once) instead of reading it all into memory.
+# Data is then a MaskedVolume, which the stages read slab by slab
+@profiled
+def get_data(nifti_dir, fname, mask_mode="all", memmap=False):
     # Define file names
     nifti_file = str(nifti_dir / (fname + ".nii.gz"))
     bval_file  = str(nifti_dir / (fname + ".bval"))
     bvec_file  = str(nifti_dir / (fname + ".bvec"))
 
     # Extract data
-    data, affine, hardi_img = load_nifti(nifti_file, return_img = True)
+    if memmap:
+        hardi_img, data = load_volume(nifti_file); affine = hardi_img.affine # stored type, same as load_nifti gives
+    else:
+        data, affine, hardi_img = load_nifti(nifti_file, return_img = True)
     bvals, bvecs = read_bvals_bvecs(bval_file, bvec_file)
 
     # Make gradient table
     gtab = gradient_table(bvals, bvecs = bvecs)
 
-    # Make brain mask
-    data_masked, mask = median_otsu(data, vol_idx=range(data.shape[3]), numpass=1)
+    # Make brain mask (or load the one made before for this series) and mask data in place
+    mask, _ = get_brain_mask(nifti_dir, fname, data, gtab, mode=mask_mode)
+    data_masked = MaskedVolume(data, mask) if memmap else apply_mask_in_place(data, mask)
 
     return data_masked, mask, gtab, affine, hardi_img
 
 # Function to create white matter mask with DTI
+@profiled
 def get_wm_mask(data_masked, gtab):
     # Fit the diffusion tensor model
     tensor_model = TensorModel(gtab)
-    tensor_fit = tensor_model.fit(data_masked)
+    if isinstance(data_masked, MaskedVolume):
+        # One slab at a time (voxels are fitted independently, so FA is the same)
+        FA = np.zeros(data_masked.shape[:3])
+        for z, slab in data_masked.slabs():
+            FA[:, :, z] = tensor_model.fit(slab).fa
+    else:
+        tensor_fit = tensor_model.fit(data_masked)
 
-    # Get FA map
-    FA = tensor_fit.fa
+        # Get FA map
+        FA = tensor_fit.fa
 
     # Generate white matter mask using FA threshold
     # Typical FA threshold for white matter is between 0.2 - 0.3. Can use 0.25
@@ -60,26 +82,57 @@ def get_wm_mask(data_masked, gtab):
     return white_matter_mask, FA
 
 # Function using CSA ODF model and defining stopping criterion
-def csa_and_sc(gtab, data_masked, white_matter_mask, FA):
+# engine is the tracking engine the stopping criterion is made for (see tracking_engines in Tracking_Engines)
+# brain_mask and affine are only needed by particle filtering ("pft")
+@profiled
+def csa_and_sc(gtab, data_masked, white_matter_mask, FA, engine="eudx", brain_mask=None, affine=None):
     # Using CSA (Constant Solid Angle) model then peaks_from_model
     csa_model = CsaOdfModel(gtab, sh_order=4)
-    csa_peaks = peaks_from_model(
-        csa_model, data_masked, default_sphere, relative_peak_threshold=0.5, min_separation_angle=15, mask=white_matter_mask
-    ) # or relative_peak_threshold=0.8, min_seperation_angle=45 (from introduction to basic tracking tutorial)
+    if isinstance(data_masked, MaskedVolume):
+        # One slab at a time, then joined into one set of peaks
+        csa_peaks = stack_peaks([peaks_from_model(
+            csa_model, slab, default_sphere, relative_peak_threshold=0.5, min_separation_angle=15,
+            mask=white_matter_mask[:, :, z]
+        ) for z, slab in data_masked.slabs()])
+    else:
+        csa_peaks = peaks_from_model(
+            csa_model, data_masked, default_sphere, relative_peak_threshold=0.5, min_separation_angle=15, mask=white_matter_mask
+        ) # or relative_peak_threshold=0.8, min_seperation_angle=45 (from introduction to basic tracking tutorial)
     # from paper: relative_peak_threshold=0.5, min_separation_angle=15
 
     # Define stopping criterion
-    stopping_criterion = ThresholdStoppingCriterion(FA, 0.15) 
+    stopping_criterion = make_stopping_criterion(engine, FA, brain_mask, affine) # ThresholdStoppingCriterion(FA, 0.15) for EuDX
     # or csa_peaks.gfa, 0.25 (from introduction to basic tracking tutorial). paper uses FA, 0.15
 
     return csa_peaks, stopping_criterion
 
+# Function to join peaks of consecutive z slabs into the peaks of the whole volume
+# QA is normalized by the largest ODF value of the volume in peaks_from_model, so each slab's QA is rescaled
+@profiled
+def stack_peaks(slab_peaks):
+    odf_max = []
+    for peaks in slab_peaks:
+        sh = peaks.shm_coeff[peaks.gfa > 0] # ODFs of fitted voxels, from their SH coefficients
+        odf_max.append((sh @ peaks.B).max() if sh.size else -np.inf)
+    global_max = max(odf_max)
+
+    csa_peaks = copy.copy(slab_peaks[0])
+    for name in ["peak_dirs", "peak_values", "peak_indices", "gfa", "shm_coeff", "odf"]:
+        if getattr(csa_peaks, name, None) is not None:
+            setattr(csa_peaks, name, np.concatenate([getattr(peaks, name) for peaks in slab_peaks], axis=2))
+    csa_peaks.qa = np.concatenate([peaks.qa * (slab_max / global_max) if np.isfinite(slab_max) else peaks.qa
+                                   for peaks, slab_max in zip(slab_peaks, odf_max)], axis=2)
+    return csa_peaks
+
 # Generate seeds
-def seed_gen(gtv_mask, white_matter_mask, affine, seeds_per_voxel):
+# strategy is how white matter is seeded (see seeding_strategies in Seeding_Utils). FA (same orientation as the
+# white matter mask) is needed for "fa_weighted". max_seeds caps the number of white matter seeds
+@profiled
+def seed_gen(gtv_mask, white_matter_mask, affine, seeds_per_voxel, strategy="uniform", FA=None, max_seeds=None):
     # Generating seeds
 
     # Generating seeds on white matter
-    seeds_wm = random_seeds_from_mask(white_matter_mask, affine, seeds_count=seeds_per_voxel, seed_count_per_voxel=True)
+    seeds_wm = white_matter_seeds(strategy, white_matter_mask, gtv_mask, affine, seeds_per_voxel, FA, max_seeds)
     # paper seeds all white matter voxels. not just the ones which coincide with the GTV (ROI)
     # so can use white_matter_mask or roi_wm_mask
 
@@ -89,57 +142,101 @@ def seed_gen(gtv_mask, white_matter_mask, affine, seeds_per_voxel):
     return seeds_wm, seeds_gtv
 
 # Generate streamliens
-def streamline_gen(seeds_wm, seeds_gtv, csa_peaks, stopping_criterion, affine):
-    # Using EuDX tracking for now. 
+# engine is "eudx", "deterministic", "probabilistic" or "pft" (see tracking_engines in Tracking_Engines)
+# gtv_mask (same grid as affine) keeps only white matter streamlines through the GTV, the ones WMPL uses
+# counts (dictionary) gets the number of white matter streamlines tracked ("tracked") and, when filtered, kept ("kept")
+@profiled
+def streamline_gen(seeds_wm, seeds_gtv, csa_peaks, stopping_criterion, affine, engine="eudx", gtv_mask=None,
+                   counts=None):
+    # Using EuDX tracking by default. The stopping criterion must be made for the same engine (see csa_and_sc)
 
     # Creating streamlines from all white matter and from GTV. First white matter.
-    # Initialization of eudx_tracking. The computation happens in the next step.
-    # eudx_tracking replaced with LocalTracking for older versions of DiPy
-    # For LocalTracking stuff has to be reordered! Also max_angle doesn't exist in LocalTracking
-    streamlines_generator_wm = eudx_tracking(
-        seeds_wm, stopping_criterion, affine, step_size=0.5, pam=csa_peaks, max_angle=60 # paper uses max_angle of 60
-    )
-    # streamlines_generator_wm = LocalTracking(
-    #     csa_peaks, stopping_criterion, seeds_wm, affine, step_size=0.5
-    #     )
+    # Initialization of the tracking generator. The computation happens in the next step.
+    streamlines_generator_wm = track(engine, seeds_wm, stopping_criterion, affine, csa_peaks)
     
-    # Generate streamlines object
+    # Generate streamlines object (reporting progress). Engines make any number of streamlines per seed (none, or one
+    # each way) so there is no total to count towards, only the number of streamlines tracked
+    # Engines take the seeds as one array, so seeds are only counted once each set is done (seeds/s and ETA from them)
+    n_seeds = len(seeds_wm) + len(seeds_gtv)
+    streamlines_generator_wm = track_progress(streamlines_generator_wm, "streamline_gen", unit="streamlines")
+    if counts is None:
+        counts = {}
+    if gtv_mask is not None: # drop streamlines missing the GTV as they come
+        streamlines_generator_wm = filter_touching(streamlines_generator_wm, gtv_mask, affine, counts=counts)
     streamlines_wm = Streamlines(streamlines_generator_wm)
+    if gtv_mask is None:
+        counts["tracked"] = len(streamlines_wm)
+    progress("streamline_gen", len(seeds_wm), n_seeds, unit="seeds", force=True)
 
     # Now creating streamlines from GTV
-    streamlines_generator_gtv = eudx_tracking(
-        seeds_gtv, stopping_criterion, affine, step_size=0.5, pam=csa_peaks, max_angle=60 # paper uses max_angle of 60
-    )
-    # streamlines_generator_gtv = LocalTracking(
-    #     csa_peaks, stopping_criterion, seeds_gtv, affine, step_size=0.5
-    # )
+    streamlines_generator_gtv = track(engine, seeds_gtv, stopping_criterion, affine, csa_peaks)
 
-    # Generate streamlines object
-    streamlines_gtv = Streamlines(streamlines_generator_gtv)
+    # Generate streamlines object (progress continues from the white matter streamlines)
+    streamlines_gtv = Streamlines(track_progress(streamlines_generator_gtv, "streamline_gen", unit="streamlines",
+                                                 offset=counts["tracked"]))
+    progress("streamline_gen", n_seeds, n_seeds, unit="seeds", force=True)
 
     # colors: red--> left to right, green--> front (anterior) to back (posterior), blue--> top to bottom
 
     return streamlines_wm, streamlines_gtv
 
+# Function to define marker file saying white matter tracts were filtered to the GTV (see streamline_gen)
+def gtv_only_marker(base_dir):
+    return base_dir / "Tracts" / "tractogram_EuDX.gtv_only"
+
+# Function to check if saved white matter tracts only hold streamlines through the GTV
+def tracts_filtered(base_dir):
+    return gtv_only_marker(base_dir).is_file()
+
 # Save tracts in trk files
-def save_tracts(base_dir, streamlines_wm, streamlines_gtv, hardi_img):
+# gtv_only marks the white matter tracts as filtered to the GTV, so they are re-tracked when all of them are needed
+# cache also saves compressed uint16 copies (see Tract_Cache_Utils), checked against WMPL, which are read instead
+@profiled
+def save_tracts(base_dir, streamlines_wm, streamlines_gtv, hardi_img, gtv_only=False, cache=False):
     # Define/create folder and path
     trk_dir = base_dir / "Tracts"
     trk_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
     trk_path = trk_dir / "tractogram_EuDX.trk"
 
-    # Define tractogram and save
+    # Marker removed first, so full tracts are never taken for filtered ones (or the other way round)
+    if gtv_only_marker(base_dir).is_file():
+        gtv_only_marker(base_dir).unlink()
+
+    # WMPL map and its DICOM series were made from the tracts being replaced (e.g. re-tracked to show all of them)
+    # Removed first, so they are made again from the new tracts instead of being loaded or skipped
+    wmpl_path_nii = base_dir / "WMPL/NIfTI/WMPL_map.nii.gz"
+    if wmpl_path_nii.is_file():
+        wmpl_path_nii.unlink()
+    if (base_dir / "WMPL/DICOM").is_dir():
+        shutil.rmtree(base_dir / "WMPL/DICOM")
+
+    # Define tractogram and save (renamed into place once fully written)
     sft = StatefulTractogram(streamlines_wm, hardi_img, Space.RASMM)
-    save_trk(sft, str(trk_path), streamlines_wm)
+    with atomic_path(trk_path) as tmp_path:
+        save_trk(sft, str(tmp_path), streamlines_wm)
 
     # Define path for GTV version (i.e. only tracts connected to GTV)
     trk_path_gtv = trk_dir / "tractogram_GTV_EuDX.trk"
 
     # Define tractogram and save
     sft_gtv = StatefulTractogram(streamlines_gtv, hardi_img, Space.RASMM)
-    save_trk(sft_gtv, str(trk_path_gtv), streamlines_gtv)
+    with atomic_path(trk_path_gtv) as tmp_path:
+        save_trk(sft_gtv, str(tmp_path), streamlines_gtv)
+
+    if gtv_only:
+        gtv_only_marker(base_dir).touch()
+
+    # Compressed copies (white matter tracts are checked against WMPL with the saved GTV)
+    for path in [trk_path, trk_path_gtv]:
+        if cache_path(path).is_file():
+            cache_path(path).unlink() # made from the tracts just replaced
+    if cache:
+        gtv_mask = load_masks(base_dir, ["gtv"])[0][0] if has_masks(base_dir, ["gtv"]) else None
+        if make_tract_cache(trk_path, streamlines_wm, hardi_img.affine, gtv_mask):
+            make_tract_cache(trk_path_gtv, streamlines_gtv, hardi_img.affine)
 
 # Load tracts from trk files
+@profiled
 def get_tracts(base_dir):
     # Define paths
     trk_dir = base_dir / "Tracts"
@@ -148,12 +245,10 @@ def get_tracts(base_dir):
     trk_path_gtv = trk_dir / "tractogram_GTV_EuDX.trk"
 
     if trk_path.is_file() and trk_path_gtv.is_file():
-        # Load the streamlines from the trk file
-        trk = nib.streamlines.load(trk_path) # load trk file
-        streamlines_wm = trk.streamlines; trk_aff = trk.affine # streamlines and affine
+        # Load the streamlines from the trk file (or its compressed cache)
+        streamlines_wm, trk_aff = load_tracts_file(trk_path) # streamlines and affine
 
-        trk_gtv = nib.streamlines.load(trk_path_gtv) # load trk file
-        streamlines_gtv = trk_gtv.streamlines; trk_gtv_aff = trk_gtv.affine # streamlines and affine
+        streamlines_gtv, trk_gtv_aff = load_tracts_file(trk_path_gtv) # streamlines and affine
 
         # Check that both affines are equal
         assert np.array_equal(trk_aff, trk_gtv_aff), "Affines from white matter tracts and GTV tracts are not matching."
@@ -0,0 +1,279 @@
+# Functions for chunked, resumable file transfers over the ZeroMQ data port
+
+## Import necessary packages
+import os
+import zmq
+import json
+import zlib
+import time
+import uuid
+from pathlib import Path
+
+# Transfer settings
+chunk_size = 1 << 20 # 1 MiB per chunk
+credit_window = 8 # number of chunks the server may have in flight before the client acknowledges
+transfer_timeout = 15 # seconds without a chunk before the client asks to resume (same as heartbeat timeout)
+max_retries = 3 # consecutive timeouts/bad chunks allowed before giving up
+session_timeout = 300 # seconds before an idle session is dropped by the server
+
+# Frame used to tell transfer messages apart from the other messages on the data port
+transfer_tag = b"TRANSFER"
+
+# Check if a multipart message (without identity and delimiter) belongs to a transfer
+def is_transfer_msg(frames):
+    return len(frames) >= 2 and frames[0] == transfer_tag
+
+# Server side of the transfer protocol. Lives in the thread that owns the ROUTER data socket
+class TransferServer:
+    def __init__(self, socket, case_root):
+        # Initialize by defining stuff
+        self.socket = socket # ROUTER socket
+        self.case_root = Path(case_root).resolve() # Folders outside this one are never served
+        self.roots = {} # client identity -> folders (case folders) that client can request files from
+        self.sessions = {} # transfer_id -> session dictionary
+
+    def add_root(self, identity, root):
+        # Allow a client to download files inside root (its case folder, once it asked to run it)
+        # Returns False (and allows nothing) if root isn't a folder inside the case root
+        root = Path(root).resolve()
+        if root == self.case_root or not root.is_relative_to(self.case_root):
+            return False
+        self.roots.setdefault(identity, set()).add(root)
+        return True
+
+    def _allowed(self, identity, path):
+        # Check if path is inside one of the folders the client is allowed
+        return any(path == root or path.is_relative_to(root) for root in self.roots.get(identity, ()))
+
+    def _send(self, identity, header, data=None):
+        # Send header (and data if any) to client
+        frames = [identity, b'', transfer_tag, json.dumps(header).encode('utf-8')]
+        if data is not None:
+            frames.append(data)
+        self.socket.send_multipart(frames, copy=False)
+
+    def _close(self, transfer_id):
+        # Close file and forget session
+        session = self.sessions.pop(transfer_id, None)
+        if session is not None:
+            session["file"].close()
+
+    def handle(self, identity, frames):
+        # Handle a request from a client. frames are the message frames after the identity and delimiter
+        # A malformed request is answered with an ERROR instead of stopping the thread that serves transfers
+        transfer_id = None
+        try:
+            header = json.loads(frames[1].decode('utf-8'))
+            transfer_id = header.get("transfer_id")
+            self._handle(identity, header)
+        except Exception as e:
+            print(f"[WARNING] Bad transfer request: {e}")
+            self._send(identity, {"cmd": "ERROR", "transfer_id": transfer_id if isinstance(transfer_id, str) else None,
+                                  "error": f"Bad request: {e}"})
+
+    def _handle(self, identity, header):
+        # Handle a parsed request
+        cmd = header.get("cmd")
+        transfer_id = header.get("transfer_id")
+
+        if cmd == "LIST":
+            # List files (recursively) in a folder with their sizes
+            path = Path(header["path"]).resolve()
+            if not self._allowed(identity, path) or not path.is_dir():
+                self._send(identity, {"cmd": "ERROR", "transfer_id": transfer_id, "error": f"Folder not available: {path}"})
+                return
+            files = [{"path": str(file.relative_to(path)).replace("\\", "/"), "size": file.stat().st_size,
+                      "mtime_ns": file.stat().st_mtime_ns} for file in sorted(path.rglob("*")) if file.is_file()]
+            self._send(identity, {"cmd": "LISTING", "transfer_id": transfer_id, "files": files})
+
+        elif cmd == "FETCH":
+            # Start (or resume) sending a file from a given offset
+            path = Path(header["path"]).resolve()
+            if not self._allowed(identity, path) or not path.is_file():
+                self._send(identity, {"cmd": "ERROR", "transfer_id": transfer_id, "error": f"File not available: {path}"})
+                return
+            offset, credit = int(header.get("offset", 0)), int(header.get("credit", credit_window))
+            session_chunk_size = int(header.get("chunk_size", chunk_size))
+            self._close(transfer_id) # Drop anything still in flight from a previous attempt
+            file = open(path, "rb")
+            size = path.stat().st_size
+            offset = min(offset, size)
+            file.seek(offset)
+            self.sessions[transfer_id] = {
+                "identity": identity,
+                "file": file,
+                "size": size,
+                "offset": offset, # next offset to send
+                "credit": credit,
+                "chunk_size": session_chunk_size,
+                "attempt": header.get("attempt", 0), # echoed back so the client can ignore chunks from earlier attempts
+                "last_active": time.time()
+            }
+            self._send(identity, {"cmd": "META", "transfer_id": transfer_id, "attempt": self.sessions[transfer_id]["attempt"],
+                                  "size": size, "offset": offset})
+
+        elif cmd == "CREDIT":
+            # Client acknowledged chunk(s). Allow more chunks to be sent
+            session = self.sessions.get(transfer_id)
+            if session is not None:
+                session["credit"] += int(header.get("credit", 1))
+                session["identity"] = identity # identity may change if the client reconnected
+                session["last_active"] = time.time()
+
+        elif cmd == "CLOSE":
+            self._close(transfer_id)
+
+        else:
+            self._send(identity, {"cmd": "ERROR", "transfer_id": transfer_id, "error": f"Unknown command: {cmd}"})
+
+    def pump(self):
+        # Send as many chunks as the clients' credit allows. Only ever reads one chunk at a time from disk
+        now = time.time()
+        for transfer_id, session in list(self.sessions.items()):
+            if now - session["last_active"] > session_timeout:
+                self._close(transfer_id) # Client went away
+                continue
+            while session["credit"] > 0 and session["offset"] < session["size"]:
+                data = session["file"].read(session["chunk_size"])
+                if not data:
+                    break # File shrank while sending. Client will see the EOF size
+                header = {"cmd": "CHUNK", "transfer_id": transfer_id, "attempt": session["attempt"],
+                          "offset": session["offset"], "size": len(data), "crc32": zlib.crc32(data)}
+                self._send(session["identity"], header, data)
+                session["offset"] += len(data)
+                session["credit"] -= 1
+            if session["offset"] >= session["size"] and not session.get("eof_sent"):
+                self._send(session["identity"], {"cmd": "EOF", "transfer_id": transfer_id, "attempt": session["attempt"],
+                                                 "size": session["size"]})
+                session["eof_sent"] = True # Keep session open until CLOSE in case the client needs to resume
+
+    def busy(self):
+        # True while there are chunks left to send
+        return any(session["credit"] > 0 and session["offset"] < session["size"] for session in self.sessions.values())
+
+    def close(self):
+        # Close all open files
+        for transfer_id in list(self.sessions):
+            self._close(transfer_id)
+
+# Client side of the transfer protocol. Used from the thread that owns the DEALER data socket
+class TransferClient:
+    def __init__(self, socket, on_other_msg=None):
+        # Initialize by defining stuff
+        self.socket = socket # DEALER socket
+        self.poller = zmq.Poller()
+        self.poller.register(self.socket, zmq.POLLIN)
+        self.on_other_msg = on_other_msg # called with frames of any non-transfer message received while transferring
+
+    def _send(self, header):
+        self.socket.send_multipart([b'', transfer_tag, json.dumps(header).encode('utf-8')])
+
+    def _recv(self, transfer_id, timeout):
+        # Receive the next transfer message for transfer_id. Returns (header, data) or (None, None) on timeout
+        deadline = time.time() + timeout
+        while True:
+            remaining = deadline - time.time()
+            if remaining <= 0 or not dict(self.poller.poll(timeout=int(remaining * 1000))):
+                return None, None
+            frames = self.socket.recv_multipart(copy=False)
+            frames = [frame.bytes if i < 3 else frame for i, frame in enumerate(frames)]
+            frames = frames[1:] # drop empty delimiter
+            if not is_transfer_msg(frames):
+                if self.on_other_msg is not None:
+                    self.on_other_msg(frames)
+                continue
+            header = json.loads(frames[1].decode('utf-8'))
+            if header.get("transfer_id") != transfer_id:
+                continue # Stale message from an earlier transfer
+            data = frames[2].buffer if len(frames) > 2 else None
+            return header, data
+
+    def list_dir(self, remote_dir, timeout=transfer_timeout):
+        # Get list of files (relative paths and sizes) in a remote folder
+        transfer_id = str(uuid.uuid4())
+        for _ in range(max_retries):
+            self._send({"cmd": "LIST", "transfer_id": transfer_id, "path": str(remote_dir)})
+            header, _ = self._recv(transfer_id, timeout)
+            if header is None:
+                continue # Try again
+            if header["cmd"] == "ERROR":
+                raise FileNotFoundError(header["error"])
+            return header["files"]
+        raise TimeoutError(f"No reply from server when listing {remote_dir}")
+
+    def fetch_file(self, remote_path, local_path, mtime_ns=None, timeout=transfer_timeout):
+        # Download a file chunk by chunk. Partial downloads are kept as .part files and resumed
+        # With the modification time of the remote file (from list_dir), a partial download is only resumed for the
+        # same version of the file, and the local copy gets that modification time
+        local_path = Path(local_path)
+        local_path.parent.mkdir(parents=True, exist_ok=True)
+        part_name = local_path.name + (f".{mtime_ns}" if mtime_ns is not None else "") + ".part"
+        for stale_path in local_path.parent.glob(local_path.name + ".*part"):
+            if stale_path.name != part_name:
+                stale_path.unlink() # Partial download of an older version of the file
+        part_path = local_path.with_name(part_name)
+        part_path.touch(exist_ok=True)
+        offset = part_path.stat().st_size # Resume from last acknowledged offset
+        transfer_id = str(uuid.uuid4())
+        attempt = 0 # increased every time we ask the server to resume
+        retries = 0
+        size = None
+
+        with open(part_path, "r+b") as file:
+            file.seek(offset)
+            file.truncate() # Remove anything after the last acknowledged offset
+            self._send({"cmd": "FETCH", "transfer_id": transfer_id, "attempt": attempt, "path": str(remote_path),
+                        "offset": offset, "credit": credit_window, "chunk_size": chunk_size})
+            while True:
+                header, data = self._recv(transfer_id, timeout)
+                if header is not None and header.get("attempt", attempt) != attempt:
+                    continue # Sent before the last resume request. Ignore it
+
+                if header is None or (header["cmd"] == "CHUNK" and (header["offset"] > offset or
+                                      len(data) != header["size"] or zlib.crc32(data) != header["crc32"])):
+                    # Timed out, missed chunk(s) or corrupted chunk. Ask to resume from last good offset
+                    retries += 1
+                    if retries > max_retries:
+                        raise TimeoutError(f"Transfer of {remote_path} failed at offset {offset}")
+                    print(f"[WARNING] Transfer of {Path(remote_path).name} interrupted at offset {offset}. Resuming...")
+                    attempt += 1
+                    self._send({"cmd": "FETCH", "transfer_id": transfer_id, "attempt": attempt, "path": str(remote_path),
+                                "offset": offset, "credit": credit_window, "chunk_size": chunk_size})
+                    continue
+
+                if header["cmd"] == "ERROR":
+                    raise FileNotFoundError(header["error"])
+                elif header["cmd"] == "META":
+                    size = header["size"]
+                elif header["cmd"] == "CHUNK":
+                    if header["offset"] < offset:
+                        continue # Duplicate chunk. Ignore it
+                    file.write(data)
+                    offset += header["size"]
+                    retries = 0 # Reset retries after a good chunk
+                    self._send({"cmd": "CREDIT", "transfer_id": transfer_id, "offset": offset, "credit": 1})
+                elif header["cmd"] == "EOF":
+                    if offset != header["size"]:
+                        continue # Chunks still on their way (or lost, timeout will resume)
+                    size = header["size"]
+                    break
+
+            file.flush()
+
+        self._send({"cmd": "CLOSE", "transfer_id": transfer_id})
+        part_path.replace(local_path) # Only show the file once it is complete
+        if mtime_ns is not None:
+            os.utime(local_path, ns=(mtime_ns, mtime_ns)) # so fetch_dir can tell it is up to date
+        return size
+
+    def fetch_dir(self, remote_dir, local_dir, timeout=transfer_timeout):
+        # Download every file in a remote folder. Files already downloaded (same size and modification time) are skipped
+        total = 0
+        for entry in self.list_dir(remote_dir, timeout=timeout):
+            local_path = Path(local_dir) / entry["path"]
+            if (local_path.is_file() and local_path.stat().st_size == entry["size"]
+                    and local_path.stat().st_mtime_ns == entry.get("mtime_ns")):
+                continue
+            total += self.fetch_file(f"{remote_dir}/{entry['path']}", local_path, mtime_ns=entry.get("mtime_ns"),
+                                     timeout=timeout)
+        return total
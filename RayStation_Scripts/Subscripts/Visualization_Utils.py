@@ -4,160 +4,255 @@
 import nibabel as nib
 from dipy.viz import actor, colormap, has_fury, window
 import numpy as np
+import os
+import subprocess
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import get_context
 
 # Import necessary functions
-from Subscripts.Preliminaries import rs_get_info
-
-# Function to visualize tracts using fury
-def show_tracts(base_dir):
-    if has_fury:
-
-        # Define paths for tracts stuff
-        trk_dir = base_dir / "Tracts"
-        trk_path = trk_dir / "tractogram_EuDX.trk"
-        trk_path_gtv = trk_dir / "tractogram_GTV_EuDX.trk"
-
-        # Load the streamlines from the trk file
-        trk = nib.streamlines.load(trk_path) # load trk file
-        streamlines_wm = trk.streamlines; trk_aff = trk.affine # streamlines and affine
-
-        trk_gtv = nib.streamlines.load(trk_path_gtv) # load trk file
-        streamlines_gtv = trk_gtv.streamlines; trk_gtv_aff = trk_gtv.affine # streamlines and affine
-
-        # Check that both affines are equal
-        assert np.array_equal(trk_aff, trk_gtv_aff), "Affines from white matter tracts and GTV tracts are not matching."
-
-        # Set affine matrix
-        affine = trk_aff
-
-        # Define folders/paths
-        rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
-        rs_rois_nii_dir = rs_dir / "ROIs_NIfTI" # Folder containing RS ROIs in NIfTI
-        gtv_mask_nii_path = rs_rois_nii_dir / "gtv_mask.nii.gz" # define file path
-        external_mask_nii_path = rs_rois_nii_dir / "external_mask.nii.gz" # define file path
-        brain_mask_nii_path = rs_rois_nii_dir / "brain_mask.nii.gz" # define file path
-        white_matter_mask_nii_path = rs_rois_nii_dir / "white_matter_mask.nii.gz" # define file path
-
-        # Get masks from pre-defined files
-        gtv_mask_nii = nib.load(gtv_mask_nii_path); gtv_mask = gtv_mask_nii.get_fdata()
-        external_mask_nii = nib.load(external_mask_nii_path); external_mask = external_mask_nii.get_fdata()
-        brain_mask_nii = nib.load(brain_mask_nii_path); brain_mask = brain_mask_nii.get_fdata()
-        white_matter_mask_nii = nib.load(white_matter_mask_nii_path); white_matter_mask = white_matter_mask_nii.get_fdata()
-
-        streamlines_actor_wm = actor.line(
-            streamlines_wm, colors=colormap.line_colors(streamlines_wm, cmap = "rgb_standard"), opacity=0.25
-        )
-
-        streamlines_actor_gtv = actor.line(
-            streamlines_gtv, colors=colormap.line_colors(streamlines_gtv, cmap = "rgb_standard"), opacity=1
-        )
-
-        gtv_actor = actor.contour_from_roi(
-            gtv_mask, affine=affine, opacity=0.95, color = (1,0,0) # red
-        )
-
-        wm_actor = actor.contour_from_roi(
-            white_matter_mask, affine=affine, opacity=0.75, color=(1,1,1) # white
-        )
-
-        # gtv_wm_actor = actor.contour_from_roi(
-        #     gtv_wm_mask, affine=affine, opacity=0.25, color=(0, 1, 0) # green
-        # ) 
-
-        external_actor = actor.contour_from_roi(
-            external_mask, affine=affine, opacity=0.5, color=(0.676, 0.844, 0.898) # light blue
-        ) 
-
-        brain_actor = actor.contour_from_roi(
-            brain_mask, affine=affine, opacity=0.75, color=(1, 0.753, 0.796) # pink
-        ) 
-
-        # Create the 3D display.
-        scene = window.Scene()
-        scene.add(streamlines_actor_wm)
-        # scene.add(streamlines_actor_gtv)
-        scene.add(gtv_actor)
-        # scene.add(wm_actor)
-        # scene.add(gtv_wm_actor)
-        scene.add(external_actor)
-        # scene.add(brain_actor)
-
-        # Define colours to show
-        colours = {
-            'GTV' : (1,0,0), # red 
-            'External' : (0.676, 0.844, 0.898) # light blue 
-        }
-
-        # Add custom legend (text + coloured squares)
-        legend_pos = np.array([150, 30, 0])
-        spacing = 20
-
-        for i, (label, colour) in enumerate(colours.items()):
-            # Add a small square actor as color indicator
-            square_actor = actor.sphere(centers=np.array([legend_pos + [0, -i*spacing, -i*spacing]]),
-                                        colors=np.array([colour]),
-                                        radii=10)
-            scene.add(square_actor)
-            
-            # Add the label as text next to it
-            # direction=None makes label follow camera
-            text_actor = actor.vector_text(text=label, pos=legend_pos + [100, -i*spacing, -i*spacing], scale=(20,20,20), direction=None, align_center=False, extrusion=3)
-            scene.add(text_actor)
-
-        # Add informational text
+from Subscripts.LOD_Utils import get_lod_streamlines, hardware_budget, next_budget
+from Subscripts.Mesh_Utils import roi_contour_actor
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Mask_Utils import load_masks
+from Subscripts.Volume_Utils import load_volume
+from Subscripts.Tract_Cache_Utils import load_tracts_file
+
+# Standard views for snapshots: direction camera looks from (RAS) and camera up direction
+snapshot_views = {
+    "axial": {"direction": (0, 0, 1), "view_up": (0, 1, 0)}, # from above
+    "coronal": {"direction": (0, 1, 0), "view_up": (0, 0, 1)}, # from the front
+    "sagittal": {"direction": (1, 0, 0), "view_up": (0, 0, 1)} # from the right
+}
+
+# Snapshot settings
+snapshot_size = (1000, 1000) # pixels
+snapshot_budget = 50000 # white matter streamlines drawn in tracts snapshots
+
+# Offscreen VTK windows tried (in order) when the default window can't render, e.g. Linux without a display
+# Only present in VTK builds with OSMesa or EGL support (e.g. the vtk-osmesa wheel)
+offscreen_windows = ("vtkEGLRenderWindow", "vtkOSOpenGLRenderWindow")
+
+# Probe run in a child process, since VTK aborts the whole process (not an exception) when it can't open a window
+offscreen_probe = "import vtk; w = vtk.vtkRenderWindow(); w.SetOffScreenRendering(1); " \
+                  "print(type(w).__name__, w.SupportsOpenGL())"
+
+# Function to define folder holding QA snapshots
+def snapshot_dir(base_dir):
+    return base_dir / "QA"
+
+# Function to create actor for white matter streamlines
+def wm_streamlines_actor(streamlines):
+    return actor.line(
+        streamlines, colors=colormap.line_colors(streamlines, cmap = "rgb_standard"), opacity=0.25
+    )
+
+# Function to add legend, information text and title to a scene
+def add_annotations(scene, info_text, title_text):
+    # Define colours to show
+    colours = {
+        'GTV' : (1,0,0), # red
+        'External' : (0.676, 0.844, 0.898) # light blue
+    }
+
+    # Add custom legend (text + coloured squares)
+    legend_pos = np.array([150, 30, 0])
+    spacing = 20
+
+    for i, (label, colour) in enumerate(colours.items()):
+        # Add a small square actor as color indicator
+        square_actor = actor.sphere(centers=np.array([legend_pos + [0, -i*spacing, -i*spacing]]),
+                                    colors=np.array([colour]),
+                                    radii=10)
+        scene.add(square_actor)
+
+        # Add the label as text next to it
+        # direction=None makes label follow camera
+        text_actor = actor.vector_text(text=label, pos=legend_pos + [100, -i*spacing, -i*spacing], scale=(20,20,20), direction=None, align_center=False, extrusion=3)
+        scene.add(text_actor)
+
+    # Add informational text
+    info_actor = actor.vector_text(text=info_text, pos=legend_pos + [100,-100,-100], scale=(5,5,5), direction=None, align_center=False, extrusion=1)
+    scene.add(info_actor)
+
+    # Add title
+    title_actor = actor.vector_text(text=title_text, pos= [0,125,125], scale = (25,25,25), direction=None, align_center=True, extrusion=5)
+    scene.add(title_actor)
+
+# Function to build the tracts scene
+# budget is the number of white matter streamlines shown ("auto" picks one for this machine, None shows all)
+# Returns scene, white matter streamlines actor and budget used
+def tracts_scene(base_dir, budget="auto", annotations=True):
+
+    # Define paths for tracts stuff
+    trk_dir = base_dir / "Tracts"
+    trk_path = trk_dir / "tractogram_EuDX.trk"
+    trk_path_gtv = trk_dir / "tractogram_GTV_EuDX.trk"
+
+    # Load decimated white matter streamlines (compressed and subsampled to the budget)
+    if budget == "auto":
+        budget = hardware_budget()
+    streamlines_wm, trk_aff = get_lod_streamlines(trk_path, budget)
+
+    streamlines_gtv, trk_gtv_aff = load_tracts_file(trk_path_gtv) # streamlines and affine (compressed cache if any)
+
+    # Check that both affines are equal
+    assert np.array_equal(trk_aff, trk_gtv_aff), "Affines from white matter tracts and GTV tracts are not matching."
+
+    # Set affine matrix
+    affine = trk_aff
+
+    # Get masks from ROIs_NIfTI (uint8 for VTK)
+    (gtv_mask, external_mask, brain_mask, white_matter_mask), _ = load_masks(
+        base_dir, ["gtv", "external", "brain", "white_matter"], dtype=np.uint8)
+
+    streamlines_actor_wm = wm_streamlines_actor(streamlines_wm)
+
+    streamlines_actor_gtv = actor.line(
+        streamlines_gtv, colors=colormap.line_colors(streamlines_gtv, cmap = "rgb_standard"), opacity=1
+    )
+
+    # Surfaces of masks are loaded from ROIs_Meshes (computed the first time only)
+    gtv_actor = roi_contour_actor(
+        base_dir, "gtv", gtv_mask, affine=affine, opacity=0.95, color = (1,0,0) # red
+    )
+
+    wm_actor = roi_contour_actor(
+        base_dir, "white_matter", white_matter_mask, affine=affine, opacity=0.75, color=(1,1,1) # white
+    )
+
+    # gtv_wm_actor = actor.contour_from_roi(
+    #     gtv_wm_mask, affine=affine, opacity=0.25, color=(0, 1, 0) # green
+    # )
+
+    external_actor = roi_contour_actor(
+        base_dir, "external", external_mask, affine=affine, opacity=0.5, color=(0.676, 0.844, 0.898) # light blue
+    )
+
+    brain_actor = roi_contour_actor(
+        base_dir, "brain", brain_mask, affine=affine, opacity=0.75, color=(1, 0.753, 0.796) # pink
+    )
+
+    # Create the 3D display.
+    scene = window.Scene()
+    scene.add(streamlines_actor_wm)
+    # scene.add(streamlines_actor_gtv)
+    scene.add(gtv_actor)
+    # scene.add(wm_actor)
+    # scene.add(gtv_wm_actor)
+    scene.add(external_actor)
+    # scene.add(brain_actor)
+
+    if annotations:
         info_text = "In tractography, the direction of streamlines is labelled by red, green, and blue, where..." \
                     "\nRed indicates directions in the X axis: right to left or left to right." \
                     "\nGreen indicates directions in the Y axis: posterior to anterior or from anterior to posterior." \
                     "\nBlue indicates directions in the Z axis: inferior to superior or vice versa."
-        info_actor = actor.vector_text(text=info_text, pos=legend_pos + [100,-100,-100], scale=(5,5,5), direction=None, align_center=False, extrusion=1)
-        scene.add(info_actor)
-
-        # Add title
-        title_text = "Tractography Streamlines"
-        title_actor = actor.vector_text(text=title_text, pos= [0,125,125], scale = (25,25,25), direction=None, align_center=True, extrusion=5)
-        scene.add(title_actor)
+        add_annotations(scene, info_text, "Tractography Streamlines")
 
-        window.show(scene)
+    return scene, streamlines_actor_wm, budget
 
-# Function to visualize WMPL map using fury
-def show_wmpl(base_dir):
+# Function to visualize tracts using fury
+# budget is the number of white matter streamlines shown at first ("auto" picks one for this machine, None shows all)
+def show_tracts(base_dir, budget="auto"):
     if has_fury:
 
-        # Define path
-        wmpl_dir_nii = base_dir / "WMPL/NIfTI"
-        wmpl_path_nii = wmpl_dir_nii / "WMPL_map.nii.gz"
-        rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
-        rs_rois_nii_dir = rs_dir / "ROIs_NIfTI" # Folder containing RS ROIs in NIfTI
-        gtv_mask_nii_path = rs_rois_nii_dir / "gtv_mask.nii.gz" # define file path
-        external_mask_nii_path = rs_rois_nii_dir / "external_mask.nii.gz" # define file path
-
-        # Get masks from pre-defined files
-        gtv_mask_nii = nib.load(gtv_mask_nii_path); gtv_mask = gtv_mask_nii.get_fdata()
-        external_mask_nii = nib.load(external_mask_nii_path); external_mask = external_mask_nii.get_fdata()
-
-        # Define folders/paths
-        rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
-        rs_mr_dcm_dir = rs_dir / "MR_DICOM" # Folder containing RS MR DICOM exports
-
-        files, _ = rs_get_info(rs_mr_dcm_dir, prints=False)
-        slice_thickness = files["MR_Files"][0].SliceThickness # take slice thickness from first MR file
-
-        # Load WMPL map
-        wmpl_img = nib.load(wmpl_path_nii); wmpl_data = wmpl_img.get_fdata(); affine = wmpl_img.affine
-        
-        # mask where WMPL > 0
-        wmpl_mask = wmpl_data > 0
-
-        # wmpl_actor = actor.contour_from_roi(
-        #     wmpl_mask, affine=affine, opacity=0.5, color=(0, 1, 0) # green
-        # ) 
-
+        trk_path = base_dir / "Tracts" / "tractogram_EuDX.trk"
+        scene, streamlines_actor_wm, budget = tracts_scene(base_dir, budget)
+        print(f"Showing {streamlines_actor_wm.GetMapper().GetInput().GetNumberOfLines()} white matter streamlines. "
+              "Press +/- to show more/fewer.")
+
+        show_manager = window.ShowManager(scene=scene)
+
+        # Swap white matter streamlines for the next level of detail when + or - is pressed
+        lod_state = {"budget": budget, "actor": streamlines_actor_wm}
+        def change_lod(obj, event):
+            key = obj.GetKeySym()
+            if key not in ("plus", "equal", "KP_Add", "minus", "KP_Subtract"):
+                return
+            new_budget = next_budget(lod_state["budget"], 1 if key in ("plus", "equal", "KP_Add") else -1)
+            if new_budget == lod_state["budget"]:
+                return # Already at the first/last level
+            streamlines, _ = get_lod_streamlines(trk_path, new_budget)
+            print(f"Showing {len(streamlines)} white matter streamlines.")
+            scene.rm(lod_state["actor"])
+            lod_state["actor"] = wm_streamlines_actor(streamlines)
+            lod_state["budget"] = new_budget
+            scene.add(lod_state["actor"])
+            show_manager.render()
+
+        show_manager.iren.AddObserver("KeyPressEvent", change_lod)
+        show_manager.start()
+
+# Function to create actors for three orthogonal slices (axial, coronal, sagittal) through the WMPL map
+# Cost depends on the number of slices shown, not the number of non-zero voxels
+# Voxels without a path length (WMPL of 0) are transparent. No actors if there are no path lengths at all
+def wmpl_slice_actors(wmpl_data, affine, values, opacity=0.8):
+    if values.size == 0:
+        return {}
+
+    # Jet-like lookup table (blue for short path lengths, red for long ones) over the non-zero WMPL values
+    lut = actor.colormap_lookup_table(
+        scale_range=(values.min(), values.max()), hue_range=(0.667, 0.0), saturation_range=(1, 1), value_range=(1, 1)
+    )
+    lut.SetBelowRangeColor(0, 0, 0, 0) # background (below the shortest path length) fully transparent
+    lut.UseBelowRangeColorOn()
+
+    # One slicer actor, copied for every orientation. Colours are mapped with alpha so the background stays see-through
+    axial_actor = actor.slicer(wmpl_data, affine=affine, lookup_colormap=lut, opacity=opacity, interpolation='nearest')
+    axial_actor.output.SetOutputFormatToRGBA() # fury maps to RGB (no alpha) by default
+    axial_actor.output.Update()
+    coronal_actor = axial_actor.copy()
+    sagittal_actor = axial_actor.copy()
+
+    # Show slices through the middle of the volume
+    x, y, z = (np.array(wmpl_data.shape[:3]) - 1) // 2
+    axial_actor.display(z=z)
+    coronal_actor.display(y=y)
+    sagittal_actor.display(x=x)
+    return {"axial": axial_actor, "coronal": coronal_actor, "sagittal": sagittal_actor}
+
+# Function to build the WMPL scene
+# mode is "slices" (orthogonal slices through the map) or "points" (one sphere per non-zero voxel)
+# slices picks which orthogonal slices are shown in "slices" mode
+def wmpl_scene(base_dir, mode="slices", slices=("axial", "coronal", "sagittal"), annotations=True):
+
+    # Define path
+    wmpl_dir_nii = base_dir / "WMPL/NIfTI"
+    wmpl_path_nii = wmpl_dir_nii / "WMPL_map.nii.gz"
+
+    # Get masks from ROIs_NIfTI (uint8 for VTK)
+    (gtv_mask, external_mask), _ = load_masks(base_dir, ["gtv", "external"], dtype=np.uint8)
+
+    # Load WMPL map
+    wmpl_img, wmpl_data = load_volume(wmpl_path_nii); affine = wmpl_img.affine
+
+    # Voxel size (mm) from NIfTI header
+    voxel_size = wmpl_img.header.get_zooms()[:3]
+
+    # mask where WMPL > 0
+    wmpl_mask = wmpl_data > 0
+
+    # wmpl_actor = actor.contour_from_roi(
+    #     wmpl_mask, affine=affine, opacity=0.5, color=(0, 1, 0) # green
+    # )
+
+    # Get WMPL values where WMPL > 0
+    values = wmpl_data[wmpl_mask]
+
+    if values.size == 0:
+        # No path reaches the GTV. Nothing to colour
+        print("[WARNING] WMPL map is empty. Showing ROIs only.")
+        wmpl_actors = []
+
+    elif mode == "slices":
+        slice_actors = wmpl_slice_actors(wmpl_data, affine, values)
+        wmpl_actors = [slice_actors[orientation] for orientation in slices]
+
+    elif mode == "points":
         # Extract voxel coordinates where WMPL > 0
         voxel_coords = np.array(np.nonzero(wmpl_mask)).T # shape (N,3)
 
-        # Get corresponding WMPL values at these voxels
-        values = wmpl_data[wmpl_mask]
-
         # Map voxel coords to real world coordinates (RASMM)
         ras_coords = nib.affines.apply_affine(wmpl_img.affine, voxel_coords) # affine from wmpl should be same as affines from before
 
@@ -165,62 +260,119 @@ def show_wmpl(base_dir):
         cmap = colormap.create_colormap(values, name='jet', auto=True)
 
         # Create a point cloud actor with colors
-        points_actor = actor.point(
-            ras_coords, cmap, point_radius=slice_thickness, opacity=0.1 # voxels are 1.5 mm (from what ive seen) in x,y,z (isotropic)
-        ) 
-
-        # Create actor for external
-        external_actor = actor.contour_from_roi(
-            external_mask, affine=affine, opacity=0.5, color=(0.676, 0.844, 0.898) # light blue
-        ) 
-
-        # Create actor for GTV
-        gtv_actor = actor.contour_from_roi(
-            gtv_mask, affine=affine, opacity=0.95, color = (1,0,0), # red 
-        )
-
-        # Create the 3D display.
-        scene = window.Scene()
-        scene.add(points_actor)
-        scene.add(external_actor)
-        scene.add(gtv_actor)
-
-        # Define colours to show
-        colours = {
-            'GTV' : (1,0,0), # red 
-            'External' : (0.676, 0.844, 0.898) # light blue 
-        }
-
-        # Add custom legend (text + coloured squares)
-        legend_pos = np.array([150, 30, 0])
-        spacing = 20
-
-        for i, (label, colour) in enumerate(colours.items()):
-            # Add a small square actor as color indicator
-            square_actor = actor.sphere(centers=np.array([legend_pos + [0, -i*spacing, -i*spacing]]),
-                                        colors=np.array([colour]),
-                                        radii=10)
-            scene.add(square_actor)
-            
-            # Add the label as text next to it
-            # direction=None makes label follow camera
-            text_actor = actor.vector_text(text=label, pos=legend_pos + [100, -i*spacing, -i*spacing], scale=(20,20,20), direction=None, align_center=False, extrusion=3)
-            scene.add(text_actor)
-
-        # Add informational text
+        wmpl_actors = [actor.point(
+            ras_coords, cmap, point_radius=voxel_size[2], opacity=0.1 # radius of one slice thickness
+        )]
+
+    else:
+        raise ValueError(f"Unknown WMPL display mode '{mode}'. Use 'slices' or 'points'.")
+
+    # Create actor for external (surface loaded from ROIs_Meshes if computed before)
+    external_actor = roi_contour_actor(
+        base_dir, "external", external_mask, affine=affine, opacity=0.5, color=(0.676, 0.844, 0.898) # light blue
+    )
+
+    # Create actor for GTV
+    gtv_actor = roi_contour_actor(
+        base_dir, "gtv", gtv_mask, affine=affine, opacity=0.95, color = (1,0,0), # red
+    )
+
+    # Create the 3D display.
+    scene = window.Scene()
+    for wmpl_actor in wmpl_actors:
+        scene.add(wmpl_actor)
+    scene.add(external_actor)
+    scene.add(gtv_actor)
+
+    if annotations:
         info_text = "This WMPL (white matter path length) map demonstrates the minimum path length" \
                     "\nfrom different parts of the brain to the GTV via tracts." \
                     "\nThe colourmap goes from blue to red where blue indicates a short path length" \
                     "\nand red indicates a long path length. Feel free to search up 'jet colourmap'" \
                     "\nfor a detailed view."
-        info_actor = actor.vector_text(text=info_text, pos=legend_pos + [100,-100,-100], scale=(5,5,5), direction=None, align_center=False, extrusion=1)
-        scene.add(info_actor)
+        add_annotations(scene, info_text, "WMPL Map")
 
-        # Add title
-        title_text = "WMPL Map"
-        title_actor = actor.vector_text(text=title_text, pos= [0,125,125], scale = (25,25,25), direction=None, align_center=True, extrusion=5)
-        scene.add(title_actor)
+    return scene
+
+# Function to visualize WMPL map using fury
+# mode is "slices" (orthogonal slices through the map) or "points" (one sphere per non-zero voxel)
+def show_wmpl(base_dir, mode="slices"):
+    if has_fury:
+
+        scene = wmpl_scene(base_dir, mode=mode)
 
         # Show plot
         window.show(scene)
-        
\ No newline at end of file
+
+# Function to check if VTK can render offscreen here. Returns the name of the window class used (None if none works)
+# If the default window can't render, the OSMesa/EGL windows are tried and the first working one is picked through
+# VTK_DEFAULT_OPENGL_WINDOW (inherited by the processes rendering the views)
+def offscreen_window():
+    requested = os.environ.get("VTK_DEFAULT_OPENGL_WINDOW")
+    candidates = [requested] if requested else [None, *offscreen_windows]
+    for candidate in candidates:
+        env = dict(os.environ)
+        if candidate is not None:
+            env["VTK_DEFAULT_OPENGL_WINDOW"] = candidate
+        try:
+            result = subprocess.run([sys.executable, "-c", offscreen_probe], env=env, capture_output=True,
+                                    text=True, timeout=60)
+        except subprocess.TimeoutExpired:
+            continue
+        if result.returncode != 0 or not result.stdout.strip():
+            continue
+        name, supported = result.stdout.split()[-2:]
+        # VTK falls back to the default window when the requested one isn't in the build
+        if supported == "1" and (candidate is None or name == candidate):
+            if candidate is not None:
+                os.environ["VTK_DEFAULT_OPENGL_WINDOW"] = candidate
+            return name
+    return None
+
+# Function to render one standard view of the tracts or WMPL map to a PNG without a display
+# Needs VTK built with offscreen support (OSMesa or EGL) on machines without a display or GPU (see offscreen_window)
+def render_snapshot(base_dir, kind, view, out_path, size=snapshot_size, budget=snapshot_budget):
+    if kind == "tracts":
+        scene, _, _ = tracts_scene(base_dir, budget, annotations=False) # reuses decimated streamlines and meshes
+    elif kind == "wmpl":
+        scene = wmpl_scene(base_dir, slices=(view,), annotations=False) # only the slice facing the camera
+    else:
+        raise ValueError(f"Unknown snapshot kind '{kind}'. Use 'tracts' or 'wmpl'.")
+
+    # Point camera at the middle of the scene from the direction of the view. Distance is set by reset_camera
+    bounds = scene.ComputeVisiblePropBounds()
+    centre = np.array([(bounds[0] + bounds[1]) / 2, (bounds[2] + bounds[3]) / 2, (bounds[4] + bounds[5]) / 2])
+    cam_pos = centre + 500 * np.array(snapshot_views[view]["direction"])
+
+    with atomic_path(out_path) as tmp_path:
+        window.record(scene=scene, cam_pos=tuple(cam_pos), cam_focal=tuple(centre),
+                      cam_view=snapshot_views[view]["view_up"], out_path=str(tmp_path), size=size, reset_camera=True)
+    return out_path
+
+# Function to save standard views (axial, coronal, sagittal) of the tracts and WMPL map as PNGs in the QA folder
+# Views are rendered in parallel processes (each builds its own scene, since VTK objects can't be shared)
+def save_snapshots(base_dir, kinds=("tracts", "wmpl"), views=tuple(snapshot_views), size=snapshot_size,
+                   budget=snapshot_budget, processes=None):
+    if not has_fury:
+        print("[WARNING] Fury is not installed. No snapshots saved.")
+        return []
+
+    out_dir = snapshot_dir(base_dir)
+    out_dir.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+
+    # Build scenes once here so decimated tractograms, meshes and the WMPL map are cached before the processes read
+    # them (otherwise every process would make the same files at once)
+    if "tracts" in kinds:
+        tracts_scene(base_dir, budget, annotations=False)
+    if "wmpl" in kinds:
+        wmpl_scene(base_dir, annotations=False)
+
+    jobs = [(kind, view, out_dir / f"{kind}_{view}.png") for kind in kinds for view in views]
+    processes = processes or min(len(jobs), os.cpu_count() or 1)
+    with ProcessPoolExecutor(max_workers=processes, mp_context=get_context("spawn")) as executor:
+        futures = [executor.submit(render_snapshot, base_dir, kind, view, out_path, size, budget)
+                   for kind, view, out_path in jobs]
+        saved = [future.result() for future in futures]
+
+    print(f"[OK] Saved {len(saved)} snapshots to {out_dir}")
+    return saved
@@ -0,0 +1,97 @@
+# Functions for loading NIfTI volumes in their stored data type without float expansion
+
+## Import necessary packages
+import numpy as np
+import nibabel as nib
+from pathlib import Path
+
+# Import necessary functions
+from Subscripts.Job_Utils import atomic_path
+
+# Keep an uncompressed copy (X.nii next to X.nii.gz) which is memory-mapped on later reads
+uncompressed_cache = True
+
+# Volumes already loaded by this process: resolved path -> (modification time of file, image, data)
+_volume_cache = {}
+
+# Number of z slices read at once when a memory-mapped volume is processed slab by slab
+slab_size = 8
+
+# Function to define path of the uncompressed copy of a gzipped NIfTI file
+def uncompressed_path(path):
+    path = Path(path)
+    return path.with_name(path.name[:-len(".gz")]) if path.name.endswith(".nii.gz") else path
+
+# Function to check if a file is the uncompressed copy of a gzipped NIfTI file (and not an input of its own)
+def is_uncompressed_copy(path):
+    path = Path(path)
+    return path.name.endswith(".nii") and path.with_name(path.name + ".gz").is_file()
+
+# Function to load a NIfTI volume. Returns image and data in the stored data type (uint8 masks stay uint8)
+# Data is memory-mapped from the uncompressed copy when there is one, and kept for later calls in this process
+# Pass dtype to convert (only copies if the stored type differs)
+def load_volume(path, dtype=None):
+    path = Path(path)
+    key = str(path.resolve())
+    mtime = path.stat().st_mtime_ns
+
+    if key in _volume_cache and _volume_cache[key][0] == mtime:
+        _, img, data = _volume_cache[key]
+    else:
+        source = path
+        if uncompressed_cache and path.name.endswith(".nii.gz"):
+            nii_path = uncompressed_path(path)
+            if not nii_path.is_file() or nii_path.stat().st_mtime_ns < mtime:
+                with atomic_path(nii_path) as tmp_path:
+                    nib.save(nib.load(path), tmp_path) # decompress once. Data type and scaling are kept
+            source = nii_path
+        img = nib.load(source, mmap='c') # copy-on-write, so callers can change data without touching the file
+        data = np.asanyarray(img.dataobj) # stored data type unless file has scaling
+        _volume_cache[key] = (mtime, img, data)
+
+    if dtype is not None:
+        data = data.astype(dtype, copy=False)
+    return img, data
+
+# Function to drop a volume (and its uncompressed copy) from this process, before the file is replaced or removed
+# Memory-mapped files can't be replaced while they are open on Windows
+def forget_volume(path, remove_copy=False):
+    path = Path(path)
+    _volume_cache.pop(str(path.resolve()), None)
+    nii_path = uncompressed_path(path)
+    _volume_cache.pop(str(nii_path.resolve()), None)
+    if remove_copy and nii_path != path and nii_path.is_file():
+        nii_path.unlink()
+
+# Function to clear every volume loaded by this process
+def clear_volume_cache():
+    _volume_cache.clear()
+
+# Function to get the z ranges of the slabs of a volume with n_slices slices
+def slab_ranges(n_slices, size=slab_size):
+    return [slice(k, min(k + size, n_slices)) for k in range(0, n_slices, size)]
+
+# Class for a memory-mapped 4D volume masked lazily. Voxels outside the mask read as 0, one slab at a time,
+# so the whole volume is never in memory (masking it in place would copy every page of the copy-on-write map)
+class MaskedVolume:
+    def __init__(self, data, mask):
+        # Initialize by defining stuff
+        self.data = data
+        self.mask = np.asarray(mask, dtype=bool)
+        self.shape = data.shape
+        self.dtype = data.dtype
+        self.ndim = data.ndim
+
+    def __getitem__(self, box):
+        # Crop to a box of spatial slices (see Crop_Utils). Still lazy
+        box = tuple(box)[:3]
+        return MaskedVolume(self.data[box], self.mask[box])
+
+    def slab(self, z):
+        # Read slices z (a slice) and mask them. Same values as masking the whole volume
+        return np.asarray(self.data[:, :, z]) * self.mask[:, :, z, None].astype(self.dtype)
+
+    def slabs(self, size=slab_size):
+        # Yield (z range, masked slab) over the volume
+        for z in slab_ranges(self.shape[2], size):
+            yield z, self.slab(z)
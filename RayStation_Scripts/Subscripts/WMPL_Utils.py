@@ -2,15 +2,22 @@
 
 ## Import necessary packages
 import pydicom
-import nibabel as nib
 from dipy.io.image import save_nifti
 from dipy.tracking.utils import path_length
 import numpy as np
 
 # Import necessary functions
 from Subscripts.Preliminaries import rs_get_info
+from Subscripts.Progress_Utils import track_progress
+from Subscripts.Job_Utils import atomic_path
+from Subscripts.Mask_Utils import load_masks
+from Subscripts.Volume_Utils import load_volume
+from Subscripts.Profile_Utils import profiled
+from Subscripts.Crop_Utils import streamlines_box, crop, crop_affine, uncrop
+from Subscripts.Tract_Cache_Utils import load_tracts_file
 
 # Function to create WMPL
+@profiled
 def get_wmpl(base_dir):
 
     # Define where WMPL is saved
@@ -21,8 +28,7 @@ def get_wmpl(base_dir):
     if wmpl_path_nii.is_file():
         print("Found saved WMPL map. Loading WMPL map...")
         # Load WMPL map
-        wmpl_img = nib.load(wmpl_path_nii); wmpl_data = wmpl_img.get_fdata(); affine = wmpl_img.affine
-        wmpl = wmpl_data
+        wmpl_img, wmpl = load_volume(wmpl_path_nii); affine = wmpl_img.affine # stored type, memory-mapped
         print("WMPL map succesfully loaded.")
 
     else:
@@ -30,30 +36,29 @@ def get_wmpl(base_dir):
         # Define folders and paths
         trk_dir = base_dir / "Tracts"
         trk_path = trk_dir / "tractogram_EuDX.trk"
-        rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
-        rs_rois_nii_dir = rs_dir / "ROIs_NIfTI" # Folder containing RS ROIs in NIfTI
-        gtv_mask_nii_path = rs_rois_nii_dir / "gtv_mask.nii.gz" # define file path
 
-        # load the streamlines from the trk file
-        trk = nib.streamlines.load(trk_path) # load trk file
-        streamlines = trk.streamlines; hdr = trk.header; trk_aff = trk.affine # streamlines, header info and affine
+        # load the streamlines from the trk file (or its compressed cache)
+        streamlines, trk_aff = load_tracts_file(trk_path) # streamlines and affine
 
-        # Load the GTV from the NIfTI file
-        gtv_img = nib.load(gtv_mask_nii_path)
-        gtv_mask = gtv_img.get_fdata()
-        gtv_aff = gtv_img.affine
+        # Load the GTV from ROIs_NIfTI
+        (gtv_mask,), gtv_aff = load_masks(base_dir, ["gtv"])
 
         # Compute (minimum) path length per voxel # calculate the WMPL
-        wmpl = path_length(streamlines, trk_aff, gtv_mask) # fill_value = 0 or -1? paper leaves blank
+        # Only on the box the streamlines pass through. Voxels outside it are never reached, so they get the fill value
+        box = streamlines_box(streamlines, trk_aff, gtv_mask.shape)
+        wmpl = path_length(streamlines, crop_affine(trk_aff, box), crop(gtv_mask, box)) # fill_value = 0 or -1? paper leaves blank
+        wmpl = uncrop(wmpl, box, gtv_mask.shape, fill_value=-1) # -1 is the fill value of path_length
 
         # save the WMPL as a NIfTI
-        save_nifti(wmpl_path_nii, wmpl, trk_aff)
+        with atomic_path(wmpl_path_nii) as tmp_path:
+            save_nifti(tmp_path, wmpl, trk_aff)
 
         print("WMPL map successfully created.")
 
     return wmpl
 
 # Function to save WMPL map as DICOM
+@profiled
 def save_wmpl_dicom(base_dir, wmpl):
     # Load in MR data used to make tracks
     # This data should be same size (as in (x,y,z)) as the white matter mask
@@ -62,6 +67,14 @@ def save_wmpl_dicom(base_dir, wmpl):
     # Define folders/paths
     rs_dir = base_dir / "RayStation" # Folder containing RayStation (RS) exports
     rs_mr_dcm_dir = rs_dir / "MR_DICOM" # Folder containing RS MR DICOM exports
+    wmpl_path_nii = base_dir / "WMPL/NIfTI/WMPL_map.nii.gz"
+
+    # Skip if every slice was already written after the WMPL map was last saved
+    saved_slices = list((base_dir / "WMPL/DICOM").glob("WMPL_slice_*.dcm"))
+    if len(saved_slices) == wmpl.shape[2] and wmpl_path_nii.is_file() and \
+        min(path.stat().st_mtime for path in saved_slices) >= wmpl_path_nii.stat().st_mtime:
+        print("[OK] WMPL map already saved as DICOM.")
+        return
 
     files, _ = rs_get_info(rs_mr_dcm_dir)
     # slice_thickness = files["MR_Files"][0].SliceThickness # take slice thickness from first MR file
@@ -72,13 +85,22 @@ def save_wmpl_dicom(base_dir, wmpl):
 
     # Define where to save WMPL
     wmpl_dir_dcm = base_dir / "WMPL/DICOM"
-    wmpl_dir_dcm.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+    wmpl_dir_dcm.parent.mkdir(parents=True, exist_ok=True) # make folder if it doesnt exist yet
+
+    # Write series to a temporary folder which replaces the DICOM folder once every slice is saved
+    with atomic_path(wmpl_dir_dcm) as tmp_dir_dcm:
+        tmp_dir_dcm.mkdir()
+        write_wmpl_slices(wmpl, Sorted_MR_Files, tmp_dir_dcm)
+
+# Function to write WMPL map slices as DICOM files based on the (sorted) MR series
+@profiled
+def write_wmpl_slices(wmpl, Sorted_MR_Files, wmpl_dir_dcm):
 
     # create new series UID and new study UID
     new_series_uid = pydicom.uid.generate_uid()
     new_study_uid = pydicom.uid.generate_uid()
 
-    for i in range(wmpl.shape[2]):  # For each slice
+    for i in track_progress(range(wmpl.shape[2]), "save_wmpl_dicom", wmpl.shape[2], unit="slices"):  # For each slice
         # ensure overlays properly with RayStation. Basically undoing what I did with ROIs.
         slice_data = wmpl[::-1,:,i].astype(np.uint16).T  
 